@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Cold start benchmark of the Cloud Function entry points in main.py.
+
+Every measurement runs in a fresh interpreter, as a new function instance would:
+
+    import      time to import main, paid by every deployed function
+    deps        time to import the modules the entry point imports when called
+                (read from main.py), and the heavy modules they load
+    first_call  first invocation of the entry point, creating its clients
+    warm_call   second invocation in the same interpreter
+    cold_start  import + deps + first_call
+
+Invocations run against the local fakes (benchmarks/fakes.py). The fakes load
+numpy, requests and google.cloud.storage themselves, so first_call does not
+count those imports; deps does.
+
+python -m benchmarks.bench_cold_start [--repeat 5] [--entry-point run_voter_info] [--root /path/to/other/checkout]
+"""
+import argparse
+import ast
+import base64
+import importlib
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+# Modules worth knowing about when they load
+HEAVY_MODULES = ("pandas", "numpy", "requests", "google.cloud.storage", "google.cloud.pubsub_v1", "grpc")
+
+ELECTION = {
+    "id": "5000",
+    "name": "State General Election",
+    "electionDay": "2020-11-03",
+    "ocdDivisionId": "ocd-division/country:us/state:ri",
+}
+# Providence County, RI
+GEO_ID, COUNTY_NAME, STATE_ABBR = "44007", "Providence County", "RI"
+LOCALES_PATH = "/tmp/bench_cold_start_addresses_county.npy"
+
+
+def address(geo_id=GEO_ID, name=COUNTY_NAME, state_abbr=STATE_ABBR):
+    return f"100 Main St, {name}, {state_abbr} {geo_id}"
+
+
+def events():
+    """
+    Returns: dict of entry point -> event of a typical invocation
+    """
+    batch = [{"address": address(), "geo_id": GEO_ID}, {"address": address("44001", "Bristol County"), "geo_id": "44001"}]
+    return {
+        "run_current_elections": {"attributes": {"mode": "full"}},
+        "publish_active_elections": {"name": "current_elections.json"},
+        "publish_active_divisions": {"attributes": {
+            "election_id": ELECTION["id"], "name": ELECTION["name"], "ocdDivisionId": ELECTION["ocdDivisionId"]}},
+        "run_voter_info": {"attributes": {"election_id": ELECTION["id"], "address": address(), "geo_id": GEO_ID}},
+        "run_voter_info_batch": {
+            "attributes": {"election_id": ELECTION["id"]},
+            "data": base64.b64encode(json.dumps(batch).encode("utf-8")).decode("ascii"),
+        },
+        "run_voter_info_probe": {"attributes": {"election_id": ELECTION["id"], "state_abbr": STATE_ABBR}},
+    }
+
+
+def heavy_modules():
+    return sorted(name for name in HEAVY_MODULES if name in sys.modules)
+
+
+def measure_import():
+    """
+    Times `import main` in this (fresh) interpreter.
+    """
+    started = time.perf_counter()
+    import main  # noqa: F401
+    return {"import_s": round(time.perf_counter() - started, 4), "loaded": heavy_modules()}
+
+
+def entry_point_imports(entry_point, filepath="main.py"):
+    """
+    Returns: the modules imported inside an entry point of main.py
+    """
+    with open(filepath) as file:
+        tree = ast.parse(file.read())
+    function = next(node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == entry_point)
+    modules = []
+    for node in ast.walk(function):
+        if isinstance(node, ast.ImportFrom):
+            modules.append(node.module)
+        elif isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+    return modules
+
+
+def measure_deps(entry_point):
+    """
+    Times the imports of an entry point after `import main` in this (fresh) interpreter.
+    """
+    import main  # noqa: F401
+    before = heavy_modules()
+    started = time.perf_counter()
+    for module in entry_point_imports(entry_point):
+        importlib.import_module(module)
+    return {"deps_s": round(time.perf_counter() - started, 4), "loaded": sorted(set(heavy_modules()) - set(before))}
+
+
+def measure_calls(entry_point):
+    """
+    Sets up the fakes, then times the first and second invocation of an entry point.
+    """
+    from benchmarks.fakes import FakeCivicApi, FakePublisher, FakeStorageClient, install_fakes
+
+    api = FakeCivicApi([ELECTION], latency=0.0).start()
+    publisher = FakePublisher()
+    event = events()[entry_point]
+    with install_fakes(api, publisher):
+        # Seed the blobs the entry points read, without loading any pipeline module
+        client = FakeStorageClient()
+        client.bucket("current_elections").blob("current_elections.json").upload_from_string(
+            json.dumps({"elections": [ELECTION]}), content_type="application/json")
+        with open(LOCALES_PATH, "rb") as file:
+            client.bucket("address_locales").blob("addresses_county.npy").upload_from_file(file)
+        preloaded = heavy_modules()
+
+        import main
+        function = getattr(main, entry_point)
+        timings = dict()
+        for call in ("first_call_s", "warm_call_s"):
+            started = time.perf_counter()
+            function(event, SimpleNamespace(event_id=call, timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ")))
+            timings[call] = round(time.perf_counter() - started, 4)
+    api.stop()
+    timings["preloaded"] = preloaded
+    return timings
+
+
+def seed_locales():
+    """
+    Builds the locale store the children upload, once per benchmark run.
+    """
+    from src.county_locator import CountyLocator
+    from src.locale_store import LocaleStore
+
+    locator = CountyLocator.from_gazetteer()
+    store = LocaleStore.from_records(
+        (geoid, usps, address(geoid, name, usps))
+        for geoid, usps, name in zip(locator.geoids.tolist(), locator.usps.tolist(), locator.names.tolist())
+    )
+    store.save(LOCALES_PATH)
+
+
+def child(root, entry_point, phase):
+    """
+    Runs one measurement in a fresh interpreter.
+    Returns: the measurement
+    """
+    command = [sys.executable, "-m", "benchmarks.bench_cold_start", "--child", entry_point, "--phase", phase]
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.path.join(os.path.dirname(__file__), "..")]),
+                   METRICS_EXPORTER="none", CIVICINFO_INITIAL_RATE="1000", CIVICINFO_MAX_RATE="1000")
+    output = subprocess.run(command, cwd=root, env=environ, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(args):
+    seed_locales()
+    entry_points = args.entry_point or list(events())
+    imports = [child(args.root, entry_points[0], "import") for _ in range(args.repeat)]
+    import_s = statistics.median(measurement["import_s"] for measurement in imports)
+    report = {"import_s": round(import_s, 4), "import_loaded": imports[0]["loaded"], "entry_points": dict()}
+    for entry_point in entry_points:
+        deps = [child(args.root, entry_point, "deps") for _ in range(args.repeat)]
+        calls = [child(args.root, entry_point, "call") for _ in range(args.repeat)]
+        deps_s = statistics.median(measurement["deps_s"] for measurement in deps)
+        first_call_s = statistics.median(measurement["first_call_s"] for measurement in calls)
+        report["entry_points"][entry_point] = {
+            "deps_s": round(deps_s, 4),
+            "loaded": deps[0]["loaded"],
+            "first_call_s": round(first_call_s, 4),
+            "warm_call_s": round(statistics.median(measurement["warm_call_s"] for measurement in calls), 4),
+            "cold_start_s": round(import_s + deps_s + first_call_s, 4),
+        }
+    report["preloaded_by_fakes"] = calls[0]["preloaded"]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per measurement, the median is reported.")
+    parser.add_argument("--entry-point", action="append", help="Entry point to measure, all by default. Repeatable.")
+    parser.add_argument("--root", default=os.path.abspath(os.path.join(os.path.dirname(__file__), "..")),
+                        help="Checkout whose main.py is measured, to compare revisions.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--phase", choices=["import", "deps", "call"], help=argparse.SUPPRESS)
+    parser.add_argument("--output", help="Write the report as json to this file.")
+    args = parser.parse_args()
+
+    if args.child:
+        phases = {"import": measure_import, "deps": lambda: measure_deps(args.child), "call": lambda: measure_calls(args.child)}
+        measurement = phases[args.phase]()
+        print(json.dumps(measurement))
+        return
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="ERROR")
+    main()
+# End
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Peak memory of saving a voter info response parsed whole ("json" parse mode)
+and parsed section by section ("stream" parse mode, src/utils_json_stream.py).
+
+Sample payloads are fake responses (benchmarks/fakes.py) scaled up to the
+polling places, early vote sites and contests of larger jurisdictions. Each is
+read from a file in 64 KB chunks, as from the network, and saved the way
+VoterInfo.save_voter_info does: canonical json, sha256, gzip.
+
+Peak memory is the peak of Python allocations (tracemalloc). Streamed sections
+over 1 MB are spooled to /tmp, which is memory on Cloud Functions: spooled_mb
+reports how much.
+
+python -m benchmarks.bench_json_stream [--sizes 1,10,50,100]
+"""
+import argparse
+import copy
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from benchmarks.fakes import FakeCivicApi
+from src.content_store import canonical_json
+from src.utils_json_stream import CanonicalJsonSink, DocumentSink, stream_document, CHUNK_SIZE, SPOOL_SIZE
+
+PAYLOAD_PATH = "/tmp/bench_json_stream_{scale}.json"
+# Providence County, RI
+ADDRESS = "100 Main St, Providence County, RI 44007"
+
+
+def sample_payload(scale):
+    """
+    Writes a fake voter info response with `scale` times the locations and contests.
+    Returns: the file path and its size in bytes
+    """
+    api = FakeCivicApi([{"id": "5000", "name": "General", "electionDay": "2020-11-03",
+                         "ocdDivisionId": "ocd-division/country:us/state:ri"}])
+    status, response = api.voter_info(ADDRESS, "5000")
+    for section, count in (("pollingLocations", 200), ("earlyVoteSites", 40), ("contests", 20)):
+        template = response[section]
+        response[section] = [copy.deepcopy(template[index % len(template)]) for index in range(count * scale)]
+        for index, element in enumerate(response[section]):
+            element["id"] = f"{section}-{index}"
+    filepath = PAYLOAD_PATH.format(scale=scale)
+    with open(filepath, "w") as file:
+        json.dump(response, file, indent=1)
+    return filepath, os.path.getsize(filepath)
+
+
+def chunks(filepath):
+    with open(filepath, "rb") as file:
+        yield from iter(lambda: file.read(CHUNK_SIZE), b"")
+
+
+def save_parsed(filepath):
+    """
+    json parse mode: the body is read whole, parsed, serialised and compressed.
+    """
+    body = b"".join(chunks(filepath))
+    response = json.loads(body)
+    response["geoid"] = {"fips": "44007"}
+    payload = canonical_json(response).encode("utf-8")
+    content_hash = hashlib.sha256(payload).hexdigest()
+    compressed = gzip.compress(payload)
+    return len(payload), content_hash, len(compressed), 0
+
+
+def save_streamed(filepath):
+    """
+    stream parse mode: sections are handed to the sinks element by element.
+    """
+    document, canonical = DocumentSink(keep=("contests",)), CanonicalJsonSink()
+    stream_document(chunks(filepath), [document, canonical])
+    for sink in (document, canonical):
+        sink.member("geoid", {"fips": "44007"})
+    spooled = sum(spool.tell() for spool in canonical._sections.values() if spool.tell() > SPOOL_SIZE)
+    file, size, content_hash = canonical.finish()
+    with file:
+        compressed = file.seek(0, os.SEEK_END)
+    return size, content_hash, compressed, spooled
+
+
+def measure(function, filepath):
+    # Timed without tracing, which slows allocation heavy code several times over
+    started = time.perf_counter()
+    function(filepath)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    size, content_hash, compressed, spooled = function(filepath)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "peak_mb": round(peak / 1024 / 1024, 1),
+        "seconds": round(elapsed, 3),
+        "spooled_mb": round(spooled / 1024 / 1024, 1),
+        "content_hash": content_hash,
+        "compressed_kb": round(compressed / 1024, 1),
+    }
+
+
+def run(args):
+    report = []
+    for scale in args.sizes:
+        filepath, size = sample_payload(scale)
+        parsed, streamed = measure(save_parsed, filepath), measure(save_streamed, filepath)
+        report.append({
+            "scale": scale,
+            "payload_mb": round(size / 1024 / 1024, 1),
+            "json": parsed,
+            "stream": streamed,
+            "same_content": parsed.pop("content_hash") == streamed.pop("content_hash"),
+        })
+        os.remove(filepath)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1, 10, 50, 100],
+                        help="Comma separated scales: x200 polling places, x40 early vote sites, x20 contests.")
+    parser.add_argument("--output", help="Write the report as json to this file.")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="WARNING")
+    main()
+# End
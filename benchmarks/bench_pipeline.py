@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+End-to-end pipeline benchmark against local stand-ins for the Civic API,
+Cloud Storage and Pub/Sub (benchmarks/fakes.py).
+
+Drives run_current_elections -> publish_active_elections ->
+publish_active_divisions -> run_voter_info for a national election over all
+gazetteer counties and reports throughput, latency percentiles, peak memory
+and API call counts.
+
+python -m benchmarks.bench_pipeline [--instances 32] [--latency 0.05] [--throttle-rate 0.01] [--mode single|batch] [--trace-memory]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from benchmarks.fakes import FakeCivicApi, FakePublisher, FakeStorageClient, install_fakes, synthetic_address
+from src.county_locator import CountyLocator
+from src.locale_store import LocaleStore
+
+ELECTIONS = [
+    {"id": "2000", "name": "VIP Test Election", "electionDay": "2021-06-06", "ocdDivisionId": "ocd-division/country:us"},
+    {"id": "5000", "name": "National General Election", "electionDay": "2020-11-03", "ocdDivisionId": "ocd-division/country:us"},
+]
+
+
+def context(event_id):
+    return SimpleNamespace(event_id=str(event_id), timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+
+def seed_locales(client):
+    """
+    Uploads a locale store of synthetic addresses for every gazetteer county.
+    """
+    locator = CountyLocator.from_gazetteer()
+    store = LocaleStore.from_records(
+        (geoid, usps, synthetic_address(geoid, name, usps))
+        for geoid, usps, name in zip(locator.geoids.tolist(), locator.usps.tolist(), locator.names.tolist())
+    )
+    filepath = "/tmp/bench_addresses_county.npy"
+    store.save(filepath)
+    client.upload_file(filepath, "address_locales", "addresses_county.npy")
+    return len(store)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+
+def summarise_metrics(records):
+    """
+    Totals the records flushed by the instrumented entry points: seconds spent
+    in each stage (summed over threads), and retries and errors by tag.
+    """
+    stages, counters = dict(), dict()
+    for record in records:
+        tags = record["tags"]
+        if record["metric"] == "stage_seconds":
+            stages[tags["stage"]] = stages.get(tags["stage"], 0.0) + record["sum"]
+        elif record["type"] == "counter" and record["metric"] in ("retries", "errors"):
+            name = record["metric"] + ":" + ",".join(f"{key}={value}" for key, value in sorted(tags.items()))
+            counters[name] = counters.get(name, 0) + record["value"]
+    return {
+        "stage_seconds": {stage: round(value, 3) for stage, value in sorted(stages.items())},
+        "counters": dict(sorted(counters.items())),
+    }
+
+
+def run(args):
+    import main
+    from src import run_ledger, utils_cache, utils_rate_limit
+    from src.utils_metrics import MemoryExporter, metrics
+    from src.utils_cloud_storage import CloudStorageClient
+
+    api = FakeCivicApi(
+        ELECTIONS,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        quota=args.quota,
+    ).start()
+    publisher = FakePublisher(failure_rate=args.publish_failure_rate)
+    exporter = MemoryExporter()
+    exporters, metrics.exporters = metrics.exporters, [exporter]
+    report = dict()
+
+    with install_fakes(api, publisher):
+        # Start every run cold
+        run_ledger._completed.clear()
+        utils_cache.reference_cache.clear()
+        utils_rate_limit._schedulers.clear()
+        os.environ["CIVICINFO_INITIAL_RATE"] = str(args.initial_rate)
+        os.environ["CIVICINFO_MAX_RATE"] = str(args.max_rate)
+        if args.mode == "batch":
+            os.environ["DIVISION_BATCH_SIZE"] = str(args.batch_size)
+        else:
+            os.environ.pop("DIVISION_BATCH_SIZE", None)
+
+        report["counties"] = seed_locales(CloudStorageClient())
+        if args.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        stages = dict()
+
+        stage = time.perf_counter()
+        main.run_current_elections({"attributes": {"mode": "full"}}, context(1))
+        stages["run_current_elections"] = time.perf_counter() - stage
+
+        stage = time.perf_counter()
+        main.publish_active_elections({"name": "current_elections.json"}, context(2))
+        elections = publisher.take("active-elections")
+        stages["publish_active_elections"] = time.perf_counter() - stage
+
+        stage = time.perf_counter()
+        for index, election in enumerate(elections):
+            main.publish_active_divisions(election, context(100 + index))
+        stages["publish_active_divisions"] = time.perf_counter() - stage
+
+        if args.mode == "batch":
+            messages, entry_point = publisher.take("active-division-batches"), main.run_voter_info_batch
+        else:
+            messages, entry_point = publisher.take("active-divisions"), main.run_voter_info
+
+        latencies = []
+
+        def invoke(indexed):
+            index, message = indexed
+            began = time.perf_counter()
+            entry_point(message, context(1000 + index))
+            latencies.append(time.perf_counter() - began)
+
+        stage = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.instances) as executor:
+            list(executor.map(invoke, enumerate(messages)))
+        stages["run_voter_info"] = time.perf_counter() - stage
+
+        elapsed = time.perf_counter() - started
+        peak = None
+        if args.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    api.stop()
+    metrics.exporters = exporters
+    voterinfo_ok = api.calls[("voterinfo", 200)]
+    report.update({
+        "mode": args.mode,
+        "invocations": len(messages),
+        "elapsed_s": round(elapsed, 3),
+        "stages_s": {name: round(value, 3) for name, value in stages.items()},
+        "divisions_per_s": round(voterinfo_ok / stages["run_voter_info"], 1) if stages["run_voter_info"] else 0,
+        "invocation_latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p99": round(percentile(latencies, 99), 1),
+        },
+        "peak_memory_mb": round(peak / 1024 / 1024, 1) if peak is not None else None,
+        "api_calls": {f"{endpoint}:{status}": count for (endpoint, status), count in sorted(api.calls.items())},
+        "storage": dict(FakeStorageClient.stats),
+        "metrics": summarise_metrics(exporter.records),
+    })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["single", "batch"], default="single",
+                        help="One run_voter_info per division, or run_voter_info_batch per batch.")
+    parser.add_argument("--instances", type=int, default=32, help="Concurrent function instances.")
+    parser.add_argument("--batch-size", type=int, default=100, help="Divisions per batch in batch mode.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean API latency in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API responses that are 500s.")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of API responses that are 429s.")
+    parser.add_argument("--quota", type=float, default=None, help="API requests per second before 403 rateLimitExceeded.")
+    parser.add_argument("--publish-failure-rate", type=float, default=0.0, help="Fraction of publishes that fail.")
+    parser.add_argument("--initial-rate", type=float, default=50, help="Initial Civic API scheduler rate.")
+    parser.add_argument("--max-rate", type=float, default=1000, help="Maximum Civic API scheduler rate.")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Report peak traced memory. Slows the run noticeably.")
+    parser.add_argument("--output", help="Write the report as json to this file.")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="WARNING")
+    main()
+# End
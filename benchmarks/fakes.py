@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+In-process stand-ins for the Google services used by the pipeline, for
+benchmarks on a laptop:
+
+- FakeCivicApi: localhost HTTP server for the Civic Information API
+  /elections and /voterinfo endpoints with configurable latency, errors and 429s
+- FakeStorageClient: in-memory google.cloud.storage.Client
+- FakePublisher: in-memory Pub/Sub publisher that records messages
+
+install_fakes() points the pipeline at them.
+"""
+import contextlib
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+from urllib.parse import urlparse, parse_qs
+
+from google.api_core import exceptions
+
+from src.county_locator import CountyLocator
+
+# Nationwide election served by the fake API in tests
+GENERAL_ELECTION = {"id": "5000", "name": "General Election", "electionDay": "2020-11-03", "ocdDivisionId": "ocd-division/country:us"}
+
+
+def synthetic_address(fips, name, state_abbr):
+    """
+    Address used for a county in benchmarks. The fake API reads the fips back from it.
+    """
+    return f"100 Main St, {name}, {state_abbr} {fips}"
+
+
+class FakeCivicApi():
+    """
+    Localhost Civic Information API.
+    Takes:
+        - elections: list of elections returned by /elections
+        - latency: mean seconds per response (exponentially distributed)
+        - error_rate: fraction of responses that are 500s
+        - throttle_rate: fraction of responses that are 429s
+        - quota: requests per second allowed before answering 403 rateLimitExceeded (None for no quota)
+        - seed: random seed
+    """
+
+    def __init__(self, elections, latency=0.05, error_rate=0.0, throttle_rate=0.0, quota=None, seed=0):
+        self.elections = elections
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.quota = quota
+        self.random = random.Random(seed)
+        self.locator = CountyLocator.from_gazetteer()
+        self.centroids = {
+            geoid: (lat, long, usps, name) for geoid, lat, long, usps, name in zip(
+                self.locator.geoids.tolist(), self.locator.lats.tolist(), self.locator.longs.tolist(),
+                self.locator.usps.tolist(), self.locator.names.tolist())
+        }
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._window = []
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes, avoid waiting on delayed acks
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, body = api.respond(self.path)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header("Retry-After", "0.1")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def _over_quota(self):
+        if not self.quota:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._window and self._window[0] < now - 1:
+                self._window.pop(0)
+            if len(self._window) >= self.quota:
+                return True
+            self._window.append(now)
+            return False
+
+    def respond(self, path):
+        url = urlparse(path)
+        endpoint = url.path.rstrip("/").split("/")[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self._lock:
+            roll = self.random.random()
+            delay = self.random.expovariate(1 / self.latency) if self.latency else 0
+        time.sleep(delay)
+
+        if self._over_quota():
+            status, body = 403, {"error": {"code": 403, "errors": [{"reason": "rateLimitExceeded"}]}}
+        elif roll < self.throttle_rate:
+            status, body = 429, {"error": {"code": 429, "message": "Too many requests"}}
+        elif roll < self.throttle_rate + self.error_rate:
+            status, body = 500, {"error": {"code": 500, "message": "Backend error"}}
+        elif endpoint == "elections":
+            status, body = 200, {"kind": "civicinfo#electionsQueryResponse", "elections": self.elections}
+        elif endpoint == "voterinfo":
+            status, body = self.voter_info(params.get("address", ""), params.get("electionId"))
+        else:
+            status, body = 404, {"error": {"code": 404}}
+
+        with self._lock:
+            self.calls[(endpoint, status)] += 1
+        return status, body
+
+    def voter_info(self, address, election_id):
+        match = re.search(r"(\d{5})$", address)
+        if not match or match.group(1) not in self.centroids:
+            return 400, {"error": {"code": 400, "message": "Failed to parse address"}}
+        fips = match.group(1)
+        lat, long, usps, name = self.centroids[fips]
+        election = next((e for e in self.elections if str(e["id"]) == str(election_id)), self.elections[0])
+        rng = random.Random(int(hashlib.md5(fips.encode()).hexdigest(), 16))
+
+        statewide = [
+            {
+                "type": "General",
+                "office": f"{usps} Statewide Office {i}",
+                "district": {"name": usps, "scope": "statewide", "id": f"ocd-division/country:us/state:{usps.lower()}"},
+                "candidates": [
+                    {"name": f"Candidate {usps}{i}{c}", "party": ["Democratic", "Republican", "Independent"][c % 3],
+                     "channels": [{"type": "Twitter", "id": f"cand{usps}{i}{c}"}]}
+                    for c in range(3)
+                ],
+            }
+            for i in range(6)
+        ]
+        local = [
+            {
+                "type": "General",
+                "office": f"{name} Local Office {i}",
+                "district": {"name": name, "scope": "countywide", "id": f"ocd-division/country:us/state:{usps.lower()}/county:{fips}"},
+                "candidates": [{"name": f"Candidate {fips}{i}{c}", "party": "Nonpartisan"} for c in range(2)],
+            }
+            for i in range(rng.randint(1, 4))
+        ]
+        polling = [
+            {
+                "address": {"locationName": f"Polling Place {p}", "line1": f"{p} Elm St", "city": name, "state": usps, "zip": fips},
+                "latitude": lat + rng.uniform(-0.2, 0.2),
+                "longitude": long + rng.uniform(-0.2, 0.2),
+                "pollingHours": "7am - 8pm",
+            }
+            for p in range(rng.randint(5, 40))
+        ]
+        return 200, {
+            "kind": "civicinfo#voterInfoResponse",
+            "election": election,
+            "normalizedInput": {"line1": "100 Main St", "city": name, "state": usps, "zip": fips},
+            "pollingLocations": polling,
+            "earlyVoteSites": polling[:2],
+            "contests": statewide + local,
+            "state": [{"name": usps, "electionAdministrationBody": {"name": f"{usps} Secretary of State"}}],
+        }
+
+
+class FakeBlob():
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.content_encoding = None
+        self.content_type = None
+        stored = bucket._objects.get(name)
+        self.generation = generation or (stored["generation"] if stored else None)
+        self.etag = stored["etag"] if stored else None
+        self.size = len(stored["data"]) if stored else None
+
+    def upload_from_string(self, data, content_type="text/plain", if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket._store(self, data, content_type, if_generation_match)
+
+    def upload_from_file(self, file, **kwargs):
+        self.upload_from_string(file.read(), **kwargs)
+
+    def upload_from_filename(self, filename, **kwargs):
+        with open(filename, "rb") as file:
+            self.upload_from_file(file, **kwargs)
+
+    def download_as_string(self, **kwargs):
+        stored = self.bucket._load(self.name)
+        self.bucket.client.stats["downloads"] += 1
+        self.bucket.client.stats["bytes_downloaded"] += len(stored["data"])
+        if stored["content_encoding"] == "gzip":
+            return gzip.decompress(stored["data"])
+        return stored["data"]
+
+    download_as_bytes = download_as_string
+
+    def download_to_file(self, file, **kwargs):
+        file.write(self.download_as_string())
+
+    def download_to_filename(self, filename, **kwargs):
+        with open(filename, "wb") as file:
+            self.download_to_file(file)
+
+    def exists(self, **kwargs):
+        return self.name in self.bucket._objects
+
+    def delete(self, **kwargs):
+        with self.bucket.client._lock:
+            if self.bucket._objects.pop(self.name, None) is None:
+                raise exceptions.NotFound(f"{self.name} not found")
+
+
+class FakeBucket():
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._objects = dict()
+
+    def blob(self, name, generation=None, **kwargs):
+        return FakeBlob(self, name, generation)
+
+    def get_blob(self, name, **kwargs):
+        self.client.stats["metadata"] += 1
+        if name not in self._objects:
+            return None
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix=None, delimiter=None, **kwargs):
+        self.client.stats["lists"] += 1
+        prefix = prefix or ""
+        with self.client._lock:
+            names = sorted(name for name in self._objects if name.startswith(prefix))
+        if delimiter:
+            names = [name for name in names if delimiter not in name[len(prefix):]]
+        return [FakeBlob(self, name) for name in names]
+
+    def _store(self, blob, data, content_type, if_generation_match):
+        with self.client._lock:
+            stored = self._objects.get(blob.name)
+            if if_generation_match is not None:
+                current = stored["generation"] if stored else 0
+                if current != if_generation_match:
+                    raise exceptions.PreconditionFailed(f"{blob.name} generation mismatch")
+            self.client._generation += 1
+            self._objects[blob.name] = {
+                "data": bytes(data),
+                "content_type": content_type,
+                "content_encoding": blob.content_encoding,
+                "generation": self.client._generation,
+                "etag": hashlib.md5(data).hexdigest(),
+            }
+            self.client.stats["uploads"] += 1
+            self.client.stats["bytes_uploaded"] += len(data)
+
+    def _load(self, name):
+        with self.client._lock:
+            stored = self._objects.get(name)
+        if stored is None:
+            raise exceptions.NotFound(f"{self.name}/{name} not found")
+        return stored
+
+
+class FakeStorageClient():
+    """
+    In-memory google.cloud.storage.Client. Buckets are created on first use.
+    All instances share the same objects so separate CloudStorageClients see each other's writes.
+    """
+    _buckets = dict()
+    _lock = threading.RLock()
+    _generation = 0
+    stats = Counter()
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._buckets.clear()
+            cls.stats.clear()
+
+    def bucket(self, name):
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(FakeStorageClient, name)
+            return self._buckets[name]
+
+    def get_bucket(self, name):
+        self.stats["metadata"] += 1
+        return self.bucket(name)
+
+    def list_blobs(self, bucket_name, prefix=None, delimiter=None, **kwargs):
+        return self.bucket(bucket_name).list_blobs(prefix=prefix, delimiter=delimiter)
+
+
+class FakePublisher():
+    """
+    In-memory Pub/Sub publisher. Records published messages by topic and
+    resolves futures immediately, failing a configurable fraction.
+    """
+
+    def __init__(self, failure_rate=0.0, seed=0):
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.messages = defaultdict(list)
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def topic_path(self, project_id, topic_name):
+        return f"projects/{project_id}/topics/{topic_name}"
+
+    def publish(self, topic_path, data, **attributes):
+        future = Future()
+        with self._lock:
+            failed = self.random.random() < self.failure_rate
+            if not failed:
+                self._next_id += 1
+                self.messages[topic_path.split("/")[-1]].append({"data": data, "attributes": attributes})
+        if failed:
+            future.set_exception(exceptions.ServiceUnavailable("Publish failed"))
+        else:
+            future.set_result(str(self._next_id))
+        return future
+
+    def take(self, topic_name):
+        """
+        Removes and returns the messages published to a topic as Cloud Function events.
+        """
+        import base64
+        with self._lock:
+            messages = self.messages.pop(topic_name, [])
+        return [
+            {"data": base64.b64encode(message["data"]).decode("ascii"), "attributes": message["attributes"]}
+            for message in messages
+        ]
+
+
+@contextlib.contextmanager
+def install_fakes(api, publisher):
+    """
+    Points the pipeline at the fakes for the duration of the block. The storage
+    client cached by src/utils_cloud_storage.py is replaced with a fake one.
+    """
+    from unittest import mock
+    from src import utils_cloud_storage, utils_pubsub
+
+    environ = {
+        "GOOGLE_CIVIC_API_URL": api.url,
+        "GOOGLE_CIVIC_API_KEY": "fake",
+        "GOOGLE_GEOCODING_API_KEY": "fake",
+    }
+    FakeStorageClient.reset()
+    with mock.patch.dict(os.environ, environ), \
+            mock.patch("google.cloud.storage.Client", FakeStorageClient), \
+            mock.patch.object(utils_cloud_storage, "_client", FakeStorageClient()), \
+            mock.patch.object(utils_pubsub, "get_publisher", lambda *args, **kwargs: publisher):
+        yield
+# End
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Rebuilds the address locales csv (addresses_county.csv) by reverse geocoding
+the county centroids in the gazetteer. Responses are kept in a persistent cache,
+so reruns only geocode the counties that are missing.
+
+python bin/build_address_locales.py [--cache path] [--output path] [--upload]
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.county_locator import CountyLocator, GAZETTEER_PATH
+from src.geocode_pipeline import BulkGeocoder, GeocodeCache
+from src.voter_info_fetcher import ReverseGeocode
+from src.utils_cloud_storage import CloudStorageClient
+
+BUCKET_NAME = "address_locales"
+CSV_BLOB_NAME = "addresses_county.csv"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--gazetteer", default=GAZETTEER_PATH, help="Census county gazetteer file.")
+    parser.add_argument("--cache", default="/tmp/geocode_cache.sqlite", help="Persistent geocoding cache.")
+    parser.add_argument("--output", default=os.path.join("/tmp", CSV_BLOB_NAME), help="Local path of the locales csv.")
+    parser.add_argument("--precision", type=int, default=4, help="Decimal places coordinates are rounded to.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum concurrent requests.")
+    parser.add_argument("--requests-per-second", type=float, default=20, help="Geocoding API request budget.")
+    parser.add_argument("--upload", action="store_true", help="Upload the csv to the address locales bucket.")
+    args = parser.parse_args()
+
+    locator = CountyLocator.from_gazetteer(args.gazetteer)
+    cache = GeocodeCache(args.cache)
+    geocoder = BulkGeocoder(
+        ReverseGeocode(),
+        cache,
+        precision=args.precision,
+        max_workers=args.workers,
+        requests_per_second=args.requests_per_second
+    )
+    found = geocoder.build_locales(locator, args.output)
+    cache.close()
+
+    if found < len(locator):
+        logging.warning(f"{len(locator) - found} counties have no address. Rerun to retry them.")
+
+    if args.upload:
+        client = CloudStorageClient()
+        client.upload_file(args.output, BUCKET_NAME, CSV_BLOB_NAME)
+        logging.info(f"Uploaded locales to gs://{BUCKET_NAME}/{CSV_BLOB_NAME}. Run bin/build_locale_store.py to rebuild the store.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Converts the address locales csv into the indexed locale store read by
+publish_active_divisions and uploads it to Google Cloud Storage.
+Run once whenever addresses_county.csv changes.
+
+python bin/build_locale_store.py [--csv path/to/addresses_county.csv] [--no-upload]
+"""
+
+import os
+import sys
+import argparse
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.locale_store import LocaleStore
+from src.utils_cloud_storage import CloudStorageClient
+
+BUCKET_NAME = "address_locales"
+CSV_BLOB_NAME = "addresses_county.csv"
+STORE_BLOB_NAME = "addresses_county.npy"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--csv", help="Local locales csv. Downloaded from the bucket if not given.")
+    parser.add_argument("--output", default=os.path.join("/tmp", STORE_BLOB_NAME), help="Local path of the store.")
+    parser.add_argument("--no-upload", action="store_true", help="Build the store without uploading it.")
+    args = parser.parse_args()
+
+    client = CloudStorageClient()
+    filepath = args.csv
+    if not filepath:
+        filepath = os.path.join(client.path, CSV_BLOB_NAME)
+        client.download_file(filepath, BUCKET_NAME, CSV_BLOB_NAME)
+
+    store = LocaleStore.from_csv(filepath)
+    store.save(args.output)
+    logging.info(f"Built locale store of {len(store)} locales in {len(store.states)} states: {args.output}")
+
+    if not args.no_upload:
+        client.upload_file(args.output, BUCKET_NAME, STORE_BLOB_NAME)
+        logging.info(f"Uploaded locale store to gs://{BUCKET_NAME}/{STORE_BLOB_NAME}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Builds the spatial index of the polling places, early vote sites and drop off
+locations of an election (src/polling_index.py) from a day's voter info
+responses, and stores it under polling_index/{election_id}/{date}.npy in the bucket.
+Queries a built index:
+
+    build     extracts the sites of the responses recorded for the election in the manifest
+    nearest   the k nearest sites to points given as lat,long
+    county    the sites of a county
+
+Divisions inheriting another division's response (src/probe_sampler.py) are
+indexed with the sites of that response, downloaded once.
+
+python bin/build_polling_index.py build --election-id 5000 [--date 2020-11-03] [--storage-mode full|dedup|delta] [--no-upload]
+python bin/build_polling_index.py nearest --election-id 5000 [--date 2020-11-03] --point 41.82,-71.41 [--point ...] [--k 3] [--kind polling]
+python bin/build_polling_index.py county --election-id 5000 [--date 2020-11-03] --fips 44007 [--kind early_vote]
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+import datetime as dt
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.polling_index import PollingIndex, KINDS
+from src.voter_info_consolidator import VoterInfoConsolidator
+from src.utils_cloud_storage import CloudStorageClient
+
+BUCKET_NAME = "voter_info"
+INDEX_PREFIX = "polling_index/"
+
+
+def index_blob_name(election_id, date):
+    return f"{INDEX_PREFIX}{election_id}/{date}.npy"
+
+
+def build(client, args):
+    consolidator = VoterInfoConsolidator(client, args.bucket, storage_mode=args.storage_mode, max_workers=args.workers)
+    divisions = consolidator.list_divisions(args.date, args.election_id)
+    logging.info(f"Indexing the sites of {len(divisions)} divisions of election {args.election_id} on {args.date}")
+
+    def responses():
+        for geoid, inherited_from, response, error in consolidator.division_responses(divisions, args.date):
+            if error is not None:
+                logging.error(f"Failed to load voter info for {geoid} on {args.date} from {inherited_from or geoid}")
+                logging.error(error)
+                continue
+            yield geoid, response
+
+    index = PollingIndex.from_responses(responses())
+    index.save(args.output)
+    logging.info(f"Built polling index of {len(index)} sites, {len(index.located)} located: {args.output}")
+
+    if not args.no_upload:
+        blob_name = index_blob_name(args.election_id, args.date)
+        if client.upload_file(args.output, args.bucket, blob_name):
+            logging.info(f"Uploaded polling index to gs://{args.bucket}/{blob_name}")
+
+
+def open_index(client, args):
+    if not os.path.exists(args.output):
+        if not client.download_file(args.output, args.bucket, index_blob_name(args.election_id, args.date)):
+            raise SystemExit(f"No polling index for election {args.election_id} on {args.date}")
+    return PollingIndex.load(args.output)
+
+
+def nearest(index, args):
+    lats, longs = zip(*[[float(value) for value in point.split(",")] for point in args.point])
+    positions, distances = index.nearest(lats, longs, k=args.k, kind=args.kind)
+    results = []
+    for point, row, row_distances in zip(args.point, positions, distances):
+        sites = index.records(row)
+        for site, distance in zip(sites, row_distances):
+            site["distance_km"] = round(float(distance), 3)
+        results.append({"point": point, "sites": sites})
+    print(json.dumps(results, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "nearest", "county"])
+    parser.add_argument("--election-id", required=True, help="Election id as returned by Civic Information API.")
+    parser.add_argument("--date", default=str(dt.datetime.now().date()), help="Date of the responses, YYYY-MM-DD.")
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="Bucket of the saved responses and the index.")
+    parser.add_argument("--storage-mode", choices=["full", "dedup", "delta"], default=os.environ.get("VOTER_INFO_STORAGE_MODE", "full"),
+                        help="How run_voter_info stored the responses.")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent downloads.")
+    parser.add_argument("--output", help="Local path of the index. Defaults to /tmp/polling_index_{election_id}_{date}.npy")
+    parser.add_argument("--no-upload", action="store_true", help="Keep the index local.")
+    parser.add_argument("--point", action="append", default=[], help="lat,long to find the nearest sites of. Repeatable.")
+    parser.add_argument("--k", type=int, default=3, help="Sites per point.")
+    parser.add_argument("--fips", help="County fips code.")
+    parser.add_argument("--kind", choices=sorted(KINDS.values()), help="Only sites of this kind.")
+    args = parser.parse_args()
+    args.output = args.output or os.path.join("/tmp", f"polling_index_{args.election_id}_{args.date}.npy")
+
+    client = CloudStorageClient()
+    if args.command == "build":
+        build(client, args)
+    elif args.command == "nearest":
+        if not args.point:
+            parser.error("nearest requires --point")
+        nearest(open_index(client, args), args)
+    else:
+        if not args.fips:
+            parser.error("county requires --fips")
+        print(json.dumps(open_index(client, args).select(args.fips, kind=args.kind), indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
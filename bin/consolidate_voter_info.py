@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Consolidates a day's per-division voter info responses into long-tidy tables
+(contests, candidates, polling_locations, officials) and stores them in the bucket:
+
+    ndjson  one gzipped json lines file per election, consolidated/{election_id}/{date}.jsonl.gz
+    csv     one gzipped csv per table per election, consolidated/{election_id}/{date}/{table}.csv.gz
+
+With --election-id, the shards of the election's voter info manifest for the
+date are first merged into one (see src/voter_info_manifest.py).
+
+python bin/consolidate_voter_info.py --date 2020-11-03 [--election-id 5000] [--storage-mode full|dedup|delta] [--format ndjson|csv] [--workers 16] [--no-compact-manifest] [--no-upload]
+"""
+
+import os
+import sys
+import argparse
+import logging
+import datetime as dt
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.voter_info_consolidator import VoterInfoConsolidator, OUTPUT_FORMATS
+from src.voter_info_manifest import ManifestIndex
+from src.utils_cloud_storage import CloudStorageClient
+
+BUCKET_NAME = "voter_info"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--date", default=str(dt.datetime.now().date()), help="Date of the saved responses, YYYY-MM-DD.")
+    parser.add_argument("--election-id", help="Consolidate one election, found through the voter info manifest.")
+    parser.add_argument("--no-compact-manifest", action="store_true",
+                        help="Leave the manifest shards of the election and date as they are. "
+                             "By default they are merged into one first, as later queries then read a single shard.")
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="Bucket of the saved responses.")
+    parser.add_argument("--storage-mode", choices=["full", "dedup", "delta"], default=os.environ.get("VOTER_INFO_STORAGE_MODE", "full"),
+                        help="How run_voter_info stored the responses.")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="ndjson", help="Output format of the tables.")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent downloads.")
+    parser.add_argument("--directory", default="/tmp/consolidated", help="Local directory of the consolidated files.")
+    parser.add_argument("--no-upload", action="store_true", help="Keep the consolidated files local.")
+    args = parser.parse_args()
+
+    client = CloudStorageClient()
+    if args.election_id and not args.no_compact_manifest:
+        ManifestIndex(client, args.bucket).compact(args.election_id, args.date)
+
+    consolidator = VoterInfoConsolidator(
+        client,
+        args.bucket,
+        storage_mode=args.storage_mode,
+        max_workers=args.workers,
+        output_format=args.format
+    )
+    counts = consolidator.consolidate(
+        args.date,
+        election_id=args.election_id,
+        directory=args.directory,
+        upload=not args.no_upload
+    )
+    for (election_id, table), rows in sorted(counts.items()):
+        logging.info(f"{election_id} {table}: {rows} rows")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
@@ -0,0 +1,36 @@
+### Script for creating the shared rate limit store ###
+# The Civic Information API budget is shared by every FetchVoterInfo* instance 
+# through a Redis token bucket (see src/utils_rate_limit.py). Cloud Functions 
+# reach Memorystore through a Serverless VPC Access connector.
+# Run once before deploying the FetchVoterInfo* functions, then set 
+# RATE_LIMIT_REDIS_HOST in .env to the host printed at the end.
+
+# Load environment variables
+source .env
+export REDIS_INSTANCE_NAME=civic-api-budget
+
+# Set Google Cloud project
+gcloud --quiet config set project $GCP_PROJECT_NAME
+
+# Enable the APIs
+gcloud services enable redis.googleapis.com vpcaccess.googleapis.com
+
+# Create the Memorystore instance on the default network
+# Note: If the instance exists this will generate an error - Ignore
+gcloud redis instances create $REDIS_INSTANCE_NAME \
+--size 1 \
+--region $GCP_COMPUTE_ZONE \
+--network default \
+--redis-version redis_4_0
+
+# Create the VPC connector the functions use to reach it
+# Note: If the connector exists this will generate an error - Ignore
+gcloud compute networks vpc-access connectors create $GCP_VPC_CONNECTOR \
+--region $GCP_COMPUTE_ZONE \
+--network default \
+--range 10.8.0.0/28
+
+# Host to set as RATE_LIMIT_REDIS_HOST
+gcloud redis instances describe $REDIS_INSTANCE_NAME --region $GCP_COMPUTE_ZONE --format "value(host)"
+
+#End
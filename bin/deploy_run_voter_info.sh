@@ -29,6 +29,7 @@ gcloud --quiet config set compute/zone ${GCP_COMPUTE_ZONE}
 # Not Applicable
 
 # Deploy function 
+# The Civic API budget is shared through Memorystore, reached over the VPC connector (see bin/create_rate_limit_store.sh).
 # https://cloud.google.com/sdk/gcloud/reference/functions/deploy
 # Add #--retry \ once tested
 gcloud functions deploy $GCP_FUNCTION_NAME \
@@ -37,6 +38,7 @@ gcloud functions deploy $GCP_FUNCTION_NAME \
 --trigger-topic $TRIGGER_PUBSUB_TOPIC \
 --entry-point $GCP_FUNCTION_ENTRY_POINT \
 --service-account api-requests@election-tracker-268319.iam.gserviceaccount.com \
---set-env-vars GOOGLE_CIVIC_API_KEY=$GOOGLE_CIVIC_API_KEY,GOOGLE_GEOCODING_API_KEY=$GOOGLE_GEOCODING_API_KEY
+--vpc-connector $GCP_VPC_CONNECTOR \
+--set-env-vars GOOGLE_CIVIC_API_KEY=$GOOGLE_CIVIC_API_KEY,GOOGLE_GEOCODING_API_KEY=$GOOGLE_GEOCODING_API_KEY,RATE_LIMIT_REDIS_HOST=$RATE_LIMIT_REDIS_HOST,RATE_LIMIT_REDIS_PORT=$RATE_LIMIT_REDIS_PORT
 
 #End
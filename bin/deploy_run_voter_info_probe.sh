@@ -0,0 +1,48 @@
+### Script for deploying Cloud Function ###
+
+# Load environment variables
+source .env
+export GCP_FUNCTION_NAME=FetchVoterInfoProbe
+export GCP_FUNCTION_ENTRY_POINT=run_voter_info_probe
+export TRIGGER_PUBSUB_TOPIC=active-division-probes
+export GCP_NEW_BUCKET=voter_info
+
+# Create requirements.txt
+# Note: syncs without re-locking and updating packages
+pipenv sync
+pipenv run pip freeze > requirements.txt
+
+# Create Cloud bucket
+# Note: If bucket exist this will generate an error - Ignore
+gsutil mb -p $GCP_PROJECT_NAME -c standard -l $GCP_COMPUTE_ZONE gs://$GCP_NEW_BUCKET
+
+# Set the retention policy for bucket objects
+# Not applicable.
+
+# Set Google Cloud project
+gcloud --quiet config set project $GCP_PROJECT_NAME
+
+# If not default, set region/zone
+gcloud --quiet config set compute/zone ${GCP_COMPUTE_ZONE}
+
+# Create PubSub topic
+# Note: If topic exist this will generate an error - Ignore
+gcloud pubsub topics create $TRIGGER_PUBSUB_TOPIC
+
+# Deploy function 
+# The Civic API budget is shared through Memorystore, reached over the VPC connector (see bin/create_rate_limit_store.sh).
+# https://cloud.google.com/sdk/gcloud/reference/functions/deploy
+# A probe run covers the counties of a state, so allow the maximum timeout. 
+# Set DIVISION_SAMPLING=probe on PubActiveDivisions to route statewide elections to this function.
+# Add #--retry \ once tested
+gcloud functions deploy $GCP_FUNCTION_NAME \
+--source https://source.developers.google.com/projects/$GCP_PROJECT_NAME/repos/$GCP_REPOSITORY_ID \
+--runtime python37 \
+--trigger-topic $TRIGGER_PUBSUB_TOPIC \
+--entry-point $GCP_FUNCTION_ENTRY_POINT \
+--timeout 540s \
+--service-account api-requests@election-tracker-268319.iam.gserviceaccount.com \
+--vpc-connector $GCP_VPC_CONNECTOR \
+--set-env-vars GOOGLE_CIVIC_API_KEY=$GOOGLE_CIVIC_API_KEY,GOOGLE_GEOCODING_API_KEY=$GOOGLE_GEOCODING_API_KEY,RATE_LIMIT_REDIS_HOST=$RATE_LIMIT_REDIS_HOST,RATE_LIMIT_REDIS_PORT=$RATE_LIMIT_REDIS_PORT,VOTER_INFO_MAX_WORKERS=8,PROBE_FRACTION=0.1,PROBE_MIN_COVERAGE=0.0
+
+#End
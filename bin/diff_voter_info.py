@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Diff stage of a day's voter info responses: the changes of every division of
+an election since its previous snapshot (added, removed or modified contests,
+candidates and polling locations, see src/voter_info_diff.py), written as one
+gzipped json line per change record and stored under changes/{election_id}/{date}.jsonl.gz
+
+Each line is a change record with the division it applies to:
+    {"election_id", "geo_id", "date", "previous_date", "entity", "change", "key", ...}
+Divisions without a previous snapshot get a single {"entity": "division", "change": "added"} line.
+
+python bin/diff_voter_info.py --election-id 5000 [--date 2020-11-03] [--workers 16] [--no-upload]
+"""
+
+import os
+import sys
+import gzip
+import json
+import argparse
+import logging
+import datetime as dt
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.voter_info_diff import SnapshotStore, summarise
+from src.utils_cloud_storage import CloudStorageClient
+
+BUCKET_NAME = "voter_info"
+CHANGES_PREFIX = "changes/"
+
+
+def write_changes(store, election_id, date, filepath, workers):
+    """
+    Writes the change records of an election's divisions on a date.
+    Returns: summary dict of the number of divisions and records
+    """
+    summary, records_seen = Counter(), Counter()
+    with gzip.open(filepath, "wt", encoding="utf-8") as file:
+        for geo_id, previous_date, records, error in store.election_changes(election_id, date, max_workers=workers):
+            if error is not None:
+                summary["failed"] += 1
+                logging.error(f"Failed to diff voter info for {election_id}:{geo_id} on {date}")
+                logging.error(error)
+                continue
+            if records is None:
+                summary["new"] += 1
+                records = [{"entity": "division", "change": "added"}]
+            else:
+                summary["changed" if records else "unchanged"] += 1
+            records_seen.update(summarise(records))
+            division = {"election_id": str(election_id), "geo_id": geo_id, "date": str(date), "previous_date": previous_date}
+            for record in records:
+                file.write(json.dumps(dict(division, **record), ensure_ascii=False, separators=(',', ':')) + "\n")
+    return {"divisions": dict(summary), "records": dict(records_seen)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--election-id", required=True, help="Election id as returned by Civic Information API.")
+    parser.add_argument("--date", default=str(dt.datetime.now().date()), help="Date of the snapshots, YYYY-MM-DD.")
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="Bucket of the saved responses.")
+    parser.add_argument("--workers", type=int, default=16, help="Divisions loaded concurrently.")
+    parser.add_argument("--output", help="Local path of the changes. Defaults to /tmp/changes_{election_id}_{date}.jsonl.gz")
+    parser.add_argument("--no-upload", action="store_true", help="Keep the changes local.")
+    args = parser.parse_args()
+
+    client = CloudStorageClient()
+    output = args.output or os.path.join("/tmp", f"changes_{args.election_id}_{args.date}.jsonl.gz")
+    summary = write_changes(SnapshotStore(client, args.bucket), args.election_id, args.date, output, args.workers)
+    logging.info(f"Changes of election {args.election_id} on {args.date}: {json.dumps(summary)}")
+
+    if not args.no_upload:
+        blob_name = f"{CHANGES_PREFIX}{args.election_id}/{args.date}.jsonl.gz"
+        if client.upload_file(output, args.bucket, blob_name):
+            logging.info(f"Uploaded changes to gs://{args.bucket}/{blob_name}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
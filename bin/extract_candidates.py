@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Extracts the deduplicated candidates of a day's voter info responses into one
+gzipped csv, with columns named as the fields of the Candidate model.
+Reads the responses saved by run_voter_info, or local json files. With an
+election id, the responses are found in the voter info manifest instead of
+listing the bucket.
+
+python bin/extract_candidates.py --date 2020-11-03 [--election-id 5000] [--storage-mode full|dedup|delta] [--output path] [--upload]
+python bin/extract_candidates.py --files response1.json response2.json [--output path]
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.candidate_extractor import CandidateExtractor
+from src.utils_cloud_storage import CloudStorageClient
+from src.voter_info_consolidator import VoterInfoConsolidator
+
+BUCKET_NAME = "voter_info"
+CANDIDATES_BUCKET_NAME = "current_candidates"
+
+
+def load_responses(client, bucket_name, date, storage_mode, workers, election_id=None):
+    """
+    Yields the voter info responses saved for a date, each shared response once.
+    Responses that fail to load are logged and skipped.
+    """
+    consolidator = VoterInfoConsolidator(client, bucket_name, storage_mode, max_workers=workers)
+    geoids = consolidator.list_geoids(date, election_id)
+    logging.info(f"Reading {len(geoids)} responses for {date} from gs://{bucket_name}")
+    failed = 0
+    for geoid, response, error in consolidator.responses(geoids, date):
+        if error is not None:
+            failed += 1
+            logging.error(f"Failed to load voter info for {geoid} on {date}")
+            logging.error(error)
+            continue
+        yield response
+    if failed:
+        logging.error(f"Failed to load {failed} of {len(geoids)} responses for {date}")
+
+
+def load_files(filepaths):
+    for filepath in filepaths:
+        with open(filepath, "rb") as file:
+            yield json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--date", help="Date of the saved responses, YYYY-MM-DD.")
+    parser.add_argument("--election-id", help="Only the responses recorded for this election in the manifest.")
+    parser.add_argument("--files", nargs="+", help="Local voter info json files to read instead of the bucket.")
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="Bucket of the saved responses.")
+    parser.add_argument("--storage-mode", choices=["full", "dedup", "delta"], default=os.environ.get("VOTER_INFO_STORAGE_MODE", "full"),
+                        help="How run_voter_info stored the responses.")
+    parser.add_argument("--workers", type=int, default=16, help="Concurrent downloads.")
+    parser.add_argument("--output", help="Local path of the csv. Defaults to /tmp/candidates_{date}.csv.gz")
+    parser.add_argument("--upload", action="store_true", help="Upload the csv to the candidates bucket.")
+    args = parser.parse_args()
+
+    if not args.files and not args.date:
+        parser.error("one of --date or --files is required")
+
+    client = CloudStorageClient()
+    if args.files:
+        responses = load_files(args.files)
+    else:
+        responses = load_responses(client, args.bucket, args.date, args.storage_mode, args.workers, args.election_id)
+
+    extractor = CandidateExtractor().extend(response for response in responses if response)
+    output = args.output or os.path.join("/tmp", f"candidates_{args.date or 'local'}.csv.gz")
+    extractor.write_csv(output)
+
+    if args.upload:
+        blob_name = os.path.basename(output)
+        client.upload_file(output, CANDIDATES_BUCKET_NAME, blob_name)
+        logging.info(f"Uploaded candidates to gs://{CANDIDATES_BUCKET_NAME}/{blob_name}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Reports the progress of the fan-out of an election and resumes its unfinished
+divisions: pending (never fetched, or the fetch died), failed, and stalled in flight.
+
+    progress   N of M divisions done, the number in each state and the failures by reason
+    resume     republishes the unfinished divisions to active-divisions (or batches),
+               or fetches them here with --refetch
+
+Resume on the day of the run: workers record their results under the current date.
+The unfinished divisions of probe runs are resumed one by one, without probing.
+
+python bin/resume_election.py progress --election-id 5000 [--date 2020-11-03]
+python bin/resume_election.py resume --election-id 5000 [--refetch] [--batch-size 100] [--include-in-flight] [--dry-run]
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+import datetime as dt
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from main import division_messages
+from src.run_ledger import RunLedger, STALE_AFTER
+from src.utils_cloud_storage import CloudStorageClient
+
+BUCKET_NAME = "voter_info"
+
+
+def progress(ledger, args):
+    summary = ledger.progress(args.election_id, args.date, stale_after=args.stale_after)
+    logging.info(f"Election {args.election_id} on {args.date}: {summary['done']} of {summary['total']} divisions done.")
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+def resume(ledger, args):
+    divisions = ledger.unfinished(args.election_id, args.date, stale_after=args.stale_after,
+                                  include_in_flight=args.include_in_flight)
+    logging.info(f"Resuming {len(divisions)} unfinished divisions of election {args.election_id} on {args.date}.")
+    if not divisions or args.dry_run:
+        print(json.dumps([geo_id for geo_id, address in divisions]))
+        return
+    if str(dt.datetime.now().date()) != str(args.date):
+        logging.warning(f"Resuming the run of {args.date} today: results are recorded under today's date.")
+
+    if args.refetch:
+        from src.voter_info_fetcher import VoterInfo, civic_scheduler
+        summary = VoterInfo().fetch_voter_info_batch(
+            [{"address": address, "geo_id": geo_id, "election_id": args.election_id} for geo_id, address in divisions],
+            bucket_name=args.bucket,
+            max_workers=args.workers,
+            limiter=civic_scheduler()
+        )
+        summary = {state: len(geo_ids) for state, geo_ids in summary.items()}
+    else:
+        from src.utils_pubsub import publish_messages
+        topic_name, messages = division_messages(args.election_id, divisions, args.batch_size)
+        summary = publish_messages(topic_name, messages)
+    logging.info(f"Resumed election {args.election_id}: {summary}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["progress", "resume"])
+    parser.add_argument("--election-id", required=True, help="Election id as returned by Civic Information API.")
+    parser.add_argument("--date", default=str(dt.datetime.now().date()), help="Date of the run, YYYY-MM-DD.")
+    parser.add_argument("--bucket", default=BUCKET_NAME, help="Bucket of the ledger and responses.")
+    parser.add_argument("--stale-after", type=float, default=STALE_AFTER,
+                        help="Seconds after which a division in flight counts as failed.")
+    parser.add_argument("--include-in-flight", action="store_true", help="Also resume divisions still in flight.")
+    parser.add_argument("--refetch", action="store_true", help="Fetch the unfinished divisions here instead of republishing.")
+    parser.add_argument("--batch-size", type=int, default=int(os.environ.get("DIVISION_BATCH_SIZE", 0)),
+                        help="Republish in batches to active-division-batches.")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent calls with --refetch.")
+    parser.add_argument("--dry-run", action="store_true", help="List the unfinished divisions only.")
+    args = parser.parse_args()
+
+    ledger = RunLedger(CloudStorageClient(), args.bucket)
+    if args.command == "progress":
+        progress(ledger, args)
+    else:
+        resume(ledger, args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level="INFO")
+    main()
+# End
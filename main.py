@@ -2,29 +2,77 @@
 # coding: utf-8
 # Copyright 2020 99 Antennas LLC
 
-import sys
 import os
 import logging
 import json
 import datetime as dt
-import time
 import base64
-from google.cloud import pubsub_v1
-from src.election_fetcher import ElectionsFetcher
-from src.voter_info_fetcher import VoterInfo
-from src.utils_cloud_storage import CloudStorageClient
+from src.utils_metrics import instrumented
+
+# Each entry point imports its own dependencies when it is first called, so a 
+# deployed function only loads what it uses: pandas, Pub/Sub and the gazetteer 
+# are slow to import and most entry points need none of them. 
+# Clients (storage, publishers, sessions, schedulers) are cached at module level 
+# in their modules and reused across warm invocations. 
+# See benchmarks/bench_cold_start.py.
 
 # Local testing only 
 # GOOGLE_APPLICATION_CREDENTIALS = os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
 
+def division_messages(election_id, divisions, batch_size=0): 
+    """
+    Builds the messages of the active divisions of an election, 
+    one per division or one per batch of batch_size divisions. 
+    Takes: divisions as (geo_id, address)
+    Returns: topic name, generator of (key, data, attributes) messages
+    """
+    # publish active divisions in batches if a batch size is configured
+    if batch_size: 
+        rows = [{"address": address, "geo_id": geo_id} for geo_id, address in divisions]
+        return "active-division-batches", (
+            (
+                f"{election_id}:{start}", 
+                json.dumps(rows[start:start + batch_size]).encode("utf-8"), 
+                dict(election_id=election_id)
+            )
+            for start in range(0, len(rows), batch_size)
+        )
+    # publish active division
+    # Data must be a bytestring.
+    return "active-divisions", (
+        (
+            geo_id, 
+            geo_id.encode("utf-8"), 
+            dict(
+                election_id=election_id, 
+                address=address, 
+                geo_id=geo_id
+            )
+        )
+        for geo_id, address in divisions
+    )
+
 # Functions
+# Entry points are @instrumented: stage timings, bytes, retries and errors recorded
+# during an invocation are logged as structured metric records when it returns.
+@instrumented
 def run_current_elections(event, context):
     """
     Cloud function to run job to fetch election data from Google Civic Information API.
     Stores data in a cloud storage bucket as a json file.
+    
+    By default (full mode) current_elections.json, which triggers the fan-out, is 
+    replaced on every run and every election is republished, so each election gets 
+    its daily voter info snapshot. 
+    In incremental mode (attribute mode=incremental or ELECTIONS_MODE=incremental) the 
+    response is compared with the last stored snapshot and the file is only replaced 
+    when elections are new, changed or removed: only new and changed elections are 
+    published. The changes are recorded in the file under 'changes'. 
     """
+    from src.election_fetcher import ElectionsFetcher, diff_elections
+    from src.utils_cloud_storage import CloudStorageClient
+
     date = dt.datetime.now()
-    path = "/tmp/"
     client = CloudStorageClient()
     
     # Job status
@@ -35,26 +83,36 @@ def run_current_elections(event, context):
     get_elections = ElectionsFetcher()
     data = get_elections.fetch_elections()
 
-    # Store data in temp file
-    filename = 'data.json'
-    if data:
-        client.save_tmp_json(filename, data)
-        logging.info("Data saved to temp file.")
-    else:
+    if not data:
         logging.error("Error: No data returned.")
         return
 
-    # Upload temp file to Google Gloud Storage
     bucket_name = "current_elections"
-    filepath = os.path.join(path, filename)
+    
+    # Compare with last snapshot
+    attributes = (event or {}).get('attributes') or {}
+    mode = attributes.get('mode', os.environ.get('ELECTIONS_MODE', 'full'))
+    if mode == 'incremental': 
+        previous = client.download_json(bucket_name, 'current_elections.json') or {}
+        changes = diff_elections(previous.get('elections'), data['elections'])
+    else: 
+        changes = [{"id": str(election['id']), "reason": "full"} for election in data['elections']]
+    logging.info(f"{len(changes)} new, changed or removed elections ({mode} mode).")
+
+    # Upload data to Google Gloud Storage
+    # Store file by date. Snapshots under history/ do not trigger the fan-out.
+    client.upload_json(data, bucket_name, blob_name=f'history/{date}.json')
     # Store file as most current
-    client.upload_file(filepath, bucket_name, blob_name='current_elections.json')
-    # Store file by date
-    client.upload_file(filepath, bucket_name, blob_name=f'{date}.json')
+    if changes: 
+        data['changes'] = changes
+        client.upload_json(data, bucket_name, blob_name='current_elections.json')
+    else: 
+        logging.info("No changes to current elections, skipping fan-out.")
 
     # Job status
     logging.info("Completed job fetch elections.")
     
+@instrumented
 def publish_active_elections(event, context):
     """
     Publishes elections to Pub/Sub topic with an error handler.
@@ -62,23 +120,22 @@ def publish_active_elections(event, context):
             - election_id=election['id'],
             - name=election['name'], 
             - electionDay=election['electionDay'],
-            - ocdDivisionId=election['ocdDivisionId']
+            - ocdDivisionId=election['ocdDivisionId'],
+            - reason="new" | "changed" | "full" # Why the election is published
     
     """
-    def get_callback(f, data):
-        def callback(f):
-            try:
-                logging.info(f.result())
-                futures.pop(data)
-            except:  # noqa
-                logging.info("Please handle {} for {}.".format(f.exception(), data))
+    from src.voter_info_fetcher import VoterInfo
+    from src.utils_pubsub import publish_messages
 
-        return callback
-    
     # Job status
     logging.info("Starting job to publish elections.")
     logging.info("""Trigger: messageId {} published at {}""".format(context.event_id, context.timestamp))
     
+    # Only the current elections file triggers the fan-out
+    if event.get('name', 'current_elections.json') != 'current_elections.json': 
+        logging.info(f"Skipping trigger for {event.get('name')}.")
+        return
+    
     # Initiate job
     civic = VoterInfo()
     date = dt.datetime.now().date()
@@ -86,65 +143,70 @@ def publish_active_elections(event, context):
     # Load elections data
     logging.info("Load list of current elections.")
     elections = civic.load_current_elections("current_elections",  "current_elections.json")
+    changes = civic.load_election_changes("current_elections",  "current_elections.json")
+    
+    # Publish new or changed elections only. Files without changes publish every election.
+    if changes is None: 
+        reasons = {str(election['id']): "full" for election in elections}
+    else: 
+        reasons = {change['id']: change['reason'] for change in changes if change['reason'] != 'removed'}
+    elections = [election for election in elections if str(election['id']) in reasons]
+    if not elections: 
+        logging.info("No new or changed elections to publish.")
+        return
     
-    project_id = "election-tracker-268319"
     topic_name = "active-elections"
 
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(project_id, topic_name)
-
-    futures = dict()
-    
-    for election in elections: 
-        # Set message attributes 
-        
-        data = str(election['id'])
-        
-        logging.info(f"Publishing message to {topic_path}")
-        # When you publish a message, the client returns a future. Data must be a bytestring.
-        futures.update({data: None})
-        
-        future = publisher.publish(
-            topic_path, 
-            data=data.encode("utf-8"),
-            election_id=election['id'],
-            name=election['name'], 
-            electionDay=election['electionDay'],
-            ocdDivisionId=election['ocdDivisionId']
+    # Data must be a bytestring.
+    messages = (
+        (
+            str(election['id']), 
+            str(election['id']).encode("utf-8"), 
+            dict(
+                election_id=election['id'],
+                name=election['name'], 
+                electionDay=election['electionDay'],
+                ocdDivisionId=election['ocdDivisionId'],
+                reason=reasons[str(election['id'])]
+            )
         )
-                                     
-        futures[data] = future
-        # Publish failures shall be handled in the callback function.
-        future.add_done_callback(get_callback(future, data))
-
-    # Wait for all the publish futures to resolve before exiting.
-    while futures:
-        time.sleep(5)
+        for election in elections
+    )
+    
+    # Blocks until all the publish futures resolve or the deadline passes.
+    summary = publish_messages(topic_name, messages)
 
-    logging.info(f"Published active elections for current elections as of {str(date)}")
+    logging.info(f"Published active elections for current elections as of {str(date)}: {summary}")
+    return summary
 
 
+@instrumented
 def publish_active_divisions(event, context):
     """
     Publishes parsed election data by division to a Pub/Sub topic with an error handler.
+    Only the divisions covered by the election's ocdDivisionId are published: 
+    a county, parish or independent city election publishes that county, 
+    a statewide election every county of the state (see src/division_resolver.py).
     
     For each division associated with an election, message includes: 
         - election_id=election_id, # As returned by Civic Information API 
         - address=address, # Address of geo division associated with election parsed from locales data.
         - geo_id=geo_id # Fips code or similar geodivision identifier as parsed from locales data
+    
+    With DIVISION_SAMPLING=probe (or a sampling=probe attribute), a statewide or national 
+    election instead publishes one message per state to active-division-probes, 
+    collected by run_voter_info_probe.
+    
+    Either way the divisions of the election are recorded as a run in the ledger, which tracks 
+    each division as pending, done or failed (see src/run_ledger.py). Probe runs record the 
+    states of the divisions of their state in batches, in flight at the start.
         
     """
-    
-    def get_callback(f, data):
-        def callback(f):
-            try:
-                logging.info(f.result())
-                futures.pop(data)
-            except:  # noqa
-                logging.info("Please handle {} for {}.".format(f.exception(), data))
+    from src.voter_info_fetcher import VoterInfo
+    from src.utils_pubsub import publish_messages
+    from src.division_resolver import resolve_division
+    from src.run_ledger import RunLedger
 
-        return callback
-    
     # Job status
     logging.info("Starting job to parse election.")
     logging.info("""Trigger: messageId {} published at {}""".format(context.event_id, context.timestamp))
@@ -153,15 +215,7 @@ def publish_active_divisions(event, context):
     civic = VoterInfo() 
     
     logging.info("Load addreses by locale")
-    locales = civic.load_address_locales("address_locales",  "addresses_county.csv")
-    
-    project_id = "election-tracker-268319"
-    topic_name = "active-divisions"
-
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(project_id, topic_name)
-
-    futures = dict()
+    locales = civic.load_locale_store("address_locales",  "addresses_county.npy")
     
     # Parse election 
     try: 
@@ -174,8 +228,8 @@ def publish_active_divisions(event, context):
     election_id = election['election_id'] #renamed to avoid conflict
     election_name = election['name']
     election_ocdid = election['ocdDivisionId']
-    # Get state abbr from OCDid
-    election_ocdid = election_ocdid.split("/")[-1].split(":")[-1].upper()
+    # Resolve the OCDid to the counties it covers
+    division = resolve_division(election_ocdid)
 
     logging.debug(f"election_id: {election_id}")
     logging.debug(f"election_ocdid: {election_ocdid}")
@@ -186,44 +240,49 @@ def publish_active_divisions(event, context):
     if election_name == 'VIP Test Election':
         logging.debug("Election name 'VIP Test Election' excluded.")
         return
-    # If election is national, return data for all records
-    elif election_ocdid == 'US':
-        active = locales.copy()
-    # If election is statewide, return data for all records in state. 
+    # If election is within counties (county, parish, independent city...), return data for those counties
+    elif division.fips: 
+        active = list(locales.select_fips(division.fips))
+    # If election is national (state_abbr None), return data for all records
+    # If election is statewide or not mapped below the state, return data for all records in state. 
     else: 
-        active = locales.loc[locales['state_abbr'] == election_ocdid, :].copy()
+        active = locales.select(division.state_abbr)
     # Ensure active elections not null
     try: 
-        assert(active.empty == False)
+        assert((len(active) if division.fips else locales.count(division.state_abbr)) > 0)
     except Exception as e: 
-        logging.error("Unable to subset data by OCDid.")
+        logging.error(f"Unable to subset data by OCDid {election_ocdid}.")
         raise
+    logging.info(f"Election {election_id} resolved to {division.level} {division.state_abbr or 'US'}: {division.fips or 'all counties'}")
 
-    # publish active division
-    for index, row in active.iterrows():
-        data = str(row["fips"])
-        
-        logging.info(f"Publishing message to {topic_path}")
-        futures.update({data: None})
+    # Record the divisions of the run so unfinished ones can be resumed (see bin/resume_election.py)
+    active = list(active)
+    RunLedger(civic.client, "voter_info").start(election_id, civic.date, active)
 
-        # When you publish a message, the client returns a future. Data must be a bytestring.
-        future = publisher.publish(
-            topic_path, 
-            data=data.encode("utf-8"),
-            election_id=election_id, 
-            address=row['address'], 
-            geo_id=str(row["fips"])
+    # publish one probe message per state if probe sampling is configured (see run_voter_info_probe)
+    sampling = election.get('sampling', os.environ.get("DIVISION_SAMPLING", "all"))
+    batch_size = int(os.environ.get("DIVISION_BATCH_SIZE", 0))
+    if sampling == "probe" and not division.fips: 
+        topic_name = "active-division-probes"
+        states = [division.state_abbr] if division.state_abbr else list(locales.states)
+        messages = (
+            (
+                f"{election_id}:{state_abbr}", 
+                state_abbr.encode("utf-8"), 
+                dict(election_id=election_id, state_abbr=state_abbr)
+            )
+            for state_abbr in states
         )
-        futures[data] = future
-        # Publish failures shall be handled in the callback function.
-        future.add_done_callback(get_callback(future, data))
+    else: 
+        topic_name, messages = division_messages(election_id, active, batch_size)
 
-    # Wait for all the publish futures to resolve before exiting.
-    while futures:
-        time.sleep(5)
+    # Blocks until all the publish futures resolve or the deadline passes.
+    summary = publish_messages(topic_name, messages)
 
-    logging.info(f"Published active divisions for election {election_id} to {topic_name}")
+    logging.info(f"Published active divisions for election {election_id} to {topic_name}: {summary}")
+    return summary
 
+@instrumented
 def run_voter_info(event, context): 
     """
     Retrieves voter information from Google Civic API
@@ -235,6 +294,7 @@ def run_voter_info(event, context):
     Makes the API Call 
     Saves the data to Google Cloud Storage
     """
+    from src.voter_info_fetcher import VoterInfo, civic_scheduler
     
     # Job status
     logging.info("Starting job to fetch voter information.")
@@ -254,11 +314,111 @@ def run_voter_info(event, context):
     
     try: 
         logging.info(f"Start VoterInfo call: {election_id}:{geo_id}") 
-        response = civic.fetch_voter_info(address, election_id)
-        response['geoid'] = {"fips":geo_id}
-        civic.save_voter_info(geo_id, response, bucket_name="voter_info")
-        time.sleep(1)
+        # Redelivered messages for completed divisions return without an API call
+        # Calls are paced by the scheduler shared with all other workers
+        civic.fetch_division(address, election_id, geo_id, bucket_name="voter_info", limiter=civic_scheduler())
         logging.debug(f"Completed VoterInfo call: {election_id}:{geo_id}")
     except Exception as error: 
+        # The failure is recorded in the run ledger, from which bin/resume_election.py refetches it
         logging.error(f"Failed to retrieve data for {election_id}:{geo_id}")
-        logging.error(error)
\ No newline at end of file
+        logging.error(error)
+    finally: 
+        civic.flush_manifest()
+
+@instrumented
+def run_voter_info_probe(event, context): 
+    """
+    Collects voter information for the counties of a state by probe-and-expand 
+    sampling (see src/probe_sampler.py): a spread of probe counties is fetched first 
+    and the remaining counties are fetched only where the contests of their nearest 
+    fetched neighbours differ. The others inherit the data of their nearest fetched 
+    county, recorded in the voter info manifest.
+    Takes: 
+        Data returned from the active-division-probes topic message: 
+        - election_id=election_id, # As returned by Civic Information API 
+        - state_abbr=state_abbr # State to collect
+    Settings (environment): PROBE_FRACTION, PROBE_MIN_COVERAGE, PROBE_NEIGHBOURS, VOTER_INFO_MAX_WORKERS
+    """
+    from src.voter_info_fetcher import VoterInfo, civic_scheduler
+    from src.division_resolver import get_resolver
+    from src.probe_sampler import ProbeSampler
+
+    
+    # Job status
+    logging.info("Starting job to probe voter information.")
+    logging.info("""Trigger: messageId {} published at {}""".format(context.event_id, context.timestamp))
+    
+    try: 
+        attributes = event['attributes']
+        election_id = attributes['election_id']
+        state_abbr = attributes['state_abbr']
+    except Exception as error: 
+        logging.error("Error: Message does not contain event attributes.")
+        logging.error(error)
+        raise
+    
+    civic = VoterInfo() 
+    locales = civic.load_locale_store("address_locales",  "addresses_county.npy")
+    divisions = list(locales.select(state_abbr))
+    
+    sampler = ProbeSampler(
+        civic, 
+        get_resolver().locator, 
+        bucket_name="voter_info", 
+        probe_fraction=float(os.environ.get('PROBE_FRACTION', 0.1)), 
+        min_coverage=float(os.environ.get('PROBE_MIN_COVERAGE', 0.0)), 
+        neighbours=int(os.environ.get('PROBE_NEIGHBOURS', 3)), 
+        max_workers=int(os.environ.get('VOTER_INFO_MAX_WORKERS', 8)), 
+        limiter=civic_scheduler()
+    )
+    summary = sampler.run(election_id, divisions)
+    
+    logging.info(f"Completed VoterInfo probe for election {election_id} in {state_abbr}: {len(summary['fetched'])} fetched, {len(summary['inherited'])} inherited of {len(divisions)} divisions.")
+    return summary
+
+@instrumented
+def run_voter_info_batch(event, context): 
+    """
+    Retrieves voter information from Google Civic API for a batch of divisions.
+    Takes: 
+        Data returned from the active-division-batches topic message: 
+        - election_id=election_id, # As returned by Civic Information API 
+        - data: base64 encoded json list of {"address": address, "geo_id": geo_id}
+        - max_workers (optional), # Maximum number of concurrent calls
+        - requests_per_second (optional) # Fixed request budget for the batch, 
+                                         # defaults to the shared Civic API scheduler
+    Makes the API calls concurrently within the budget. 
+    Saves each response to Google Cloud Storage as it completes.
+    """
+    from src.voter_info_fetcher import VoterInfo, civic_scheduler
+
+    
+    # Job status
+    logging.info("Starting job to fetch voter information batch.")
+    logging.info("""Trigger: messageId {} published at {}""".format(context.event_id, context.timestamp))
+    
+    try: 
+        attributes = event['attributes']
+        election_id = attributes['election_id']
+        divisions = json.loads(base64.b64decode(event['data']).decode('utf-8'))
+    except Exception as error: 
+        logging.error("Error: Message does not contain event attributes and divisions data.")
+        logging.error(error)
+        raise
+    
+    max_workers = int(attributes.get('max_workers', os.environ.get('VOTER_INFO_MAX_WORKERS', 8)))
+    requests_per_second = attributes.get('requests_per_second', os.environ.get('VOTER_INFO_REQUESTS_PER_SECOND'))
+    
+    for division in divisions: 
+        division['election_id'] = election_id
+    
+    civic = VoterInfo() 
+    summary = civic.fetch_voter_info_batch(
+        divisions, 
+        bucket_name="voter_info", 
+        max_workers=max_workers, 
+        requests_per_second=float(requests_per_second or 0),
+        limiter=None if requests_per_second else civic_scheduler()
+    )
+    
+    logging.info(f"Completed VoterInfo batch for election {election_id}: {len(summary['succeeded'])} of {len(divisions)} divisions.")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Bulk extraction of candidates from voter info responses.
+
+The same candidates appear in the responses of every county of a state.
+CandidateExtractor reads any number of responses and keeps one record per
+candidate, indexed on the normalised name and office, so a run ends with a
+single bulk insert or a single csv instead of one query per candidate per
+county. Name parsing and channel extraction are memoised across responses.
+"""
+import csv
+import gzip
+import logging
+import re
+from functools import lru_cache
+
+from nameparser import HumanName
+
+# Columns of a candidate record, named as the fields of newsapp.models.Candidate
+CANDIDATE_FIELDS = (
+    "full_name",
+    "first_name",
+    "last_name",
+    "middle_initial",
+    "suffix",
+    "ocd_id",
+    "office",
+    "phone",
+    "email",
+    "twitter_id",
+    "facebook_id",
+    "party",
+)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalise(text):
+    """
+    Case-folds text and strips punctuation and repeated whitespace for matching.
+    """
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub("", text or "").casefold()).strip()
+
+
+@lru_cache(maxsize=65536)
+def parse_name(name):
+    """
+    Parses a candidate name once per distinct spelling.
+    Returns: (full_name, first_name, last_name, middle_initial, suffix)
+    """
+    human_name = HumanName(name)
+    return (
+        human_name.full_name,
+        human_name.first,
+        human_name.last,
+        human_name.middle[0] if human_name.middle else '',
+        human_name.suffix,
+    )
+
+
+@lru_cache(maxsize=65536)
+def _social_channels(channels):
+    twitter_id, fb_id = "", ""
+    for channel_type, channel_id in channels:
+        if channel_type == "Twitter":
+            twitter_id = channel_id
+        elif channel_type == "Facebook":
+            fb_id = channel_id
+    return twitter_id, fb_id
+
+
+def social_channels(channels):
+    """
+    Gets the Twitter and Facebook ids from the channels of a candidate.
+    Returns: (twitter_id, facebook_id), empty strings when missing
+    """
+    if not channels:
+        return "", ""
+    return _social_channels(tuple((channel.get("type"), channel.get("id", "")) for channel in channels))
+
+
+class CandidateExtractor():
+    """
+    Deduplicates the candidates of many voter info responses in memory.
+    Records are keyed on (normalised full name, normalised office). When a
+    candidate repeats, fields missing from the first record are filled in from
+    later ones.
+    """
+
+    def __init__(self):
+        self._index = dict()
+        self.responses = 0
+        self.seen = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def records(self):
+        return list(self._index.values())
+
+    def add_response(self, response):
+        """
+        Adds the candidates of the contests in one response.
+        Contests without an office or candidates, such as referendums, are skipped.
+        """
+        self.responses += 1
+        # a missing key may mean this data hasn't been populated yet
+        for contest in (response or {}).get("contests") or []:
+            self.add_contest(contest)
+
+    def add_contest(self, contest):
+        """
+        Adds the candidates of one contest, such as a contest streamed from a
+        response (see src.utils_json_stream.CallbackSink).
+        """
+        office = contest.get("office")
+        candidates = contest.get("candidates")
+        if not office or not candidates:
+            return
+        district = contest.get("district") or {}
+        # Older responses identify the district by kgForeignKey, current ones by its OCD id
+        ocd_id = district.get("kgForeignKey") or district.get("id", "")
+        for candidate in candidates:
+            self.add_candidate(candidate, office, ocd_id)
+
+    def add_candidate(self, candidate, office, ocd_id=""):
+        """
+        Adds one candidate of a contest.
+        Returns: the record of the candidate
+        """
+        self.seen += 1
+        full_name, first_name, last_name, middle_initial, suffix = parse_name(candidate["name"])
+        key = (normalise(full_name), normalise(office))
+        twitter_id, fb_id = social_channels(candidate.get("channels"))
+        record = {
+            "full_name": full_name,
+            "first_name": first_name,
+            "last_name": last_name,
+            "middle_initial": middle_initial,
+            "suffix": suffix,
+            "ocd_id": ocd_id,
+            "office": office,
+            "phone": candidate.get("phone", ""),
+            "email": candidate.get("email", ""),
+            "twitter_id": twitter_id,
+            "facebook_id": fb_id,
+            "party": candidate.get("party", ""),
+        }
+        existing = self._index.get(key)
+        if existing is None:
+            self._index[key] = record
+            return record
+        for field, value in record.items():
+            if value and not existing[field]:
+                existing[field] = value
+        return existing
+
+    def extend(self, responses):
+        """
+        Adds every response of an iterable.
+        Returns: self
+        """
+        for response in responses:
+            self.add_response(response)
+        return self
+
+    def write_csv(self, filepath, compress=True):
+        """
+        Writes the deduplicated candidates as a csv, gzipped by default.
+        Returns: the number of candidates written
+        """
+        opener = gzip.open if compress else open
+        with opener(filepath, "wt", encoding="utf-8", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=CANDIDATE_FIELDS)
+            writer.writeheader()
+            writer.writerows(self._index.values())
+        logging.info(f"Wrote {len(self)} candidates from {self.seen} listings in {self.responses} responses to {filepath}")
+        return len(self)
+# End
@@ -15,9 +15,10 @@ import requests
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from nameparser import HumanName
 from newsapp.models import Candidate
 
+from src.candidate_extractor import CandidateExtractor, social_channels
+
 
 class District():
     def __init__(self, name, kg_foreign_key):
@@ -38,19 +39,25 @@ class Contest():
 class CandidateCreator():
     """
     Fetches candidate data from the Google Civic API,
-    converts it into Candidate objects, and saves to the db
+    converts it into Candidate objects, and saves to the db.
+    Candidates are collected and deduplicated in memory across responses, 
+    then saved with one lookup and one bulk insert by save_candidates.
     """
 
-    def __init__(self):
+    def __init__(self, batch_size=500):
         self._url = "https://www.googleapis.com/civicinfo/v2/voterinfo"
         self._api_key = os.environ["GOOGLE_CIVIC_API_KEY"]
 
         # ID for the US 2018 Midterm Election
         self._election_id = 6000
 
+        self.extractor = CandidateExtractor()
+        self.batch_size = batch_size
+
     def create_candidates_from_response(self, response):
         """
-        Convert the json response from the api into a candidate list
+        Convert the json response from the api into a candidate list.
+        Call save_candidates once all responses have been added.
         """
 
         try:
@@ -82,33 +89,35 @@ class CandidateCreator():
 
     def create_candidates(self, candidate_list, contest):
         """
-        Construct a list of candidates running for a particular office
+        Collect the candidates running for a particular office
         """
 
         for c in candidate_list:
-            human_name = HumanName(c["name"])
+            self.extractor.add_candidate(
+                c, contest.office, contest.district.kg_foreign_key)
 
-            # get_or_create is failing, and I don't know why
-            try:
-                Candidate.objects.get(full_name=human_name.full_name)
-            except Candidate.DoesNotExist:
-                twitter_id, fb_id = self.get_social_channels(
-                    c.get("channels", ""))
-
-                Candidate(
-                    full_name=human_name.full_name,
-                    first_name=human_name.first,
-                    last_name=human_name.last,
-                    middle_initial=human_name.middle[0] if human_name.middle else '',
-                    suffix=human_name.suffix,
-                    ocd_id=contest.district.kg_foreign_key,
-                    office=contest.office,
-                    phone=c.get("phone", ""),
-                    email=c.get("email", ""),
-                    twitter_id=twitter_id,
-                    facebook_id=fb_id,
-                    party=c.get("party", "")
-                ).save()
+    def save_candidates(self):
+        """
+        Save the collected candidates that are not in the db yet.
+        One query finds the existing names, one bulk insert adds the rest.
+        Returns the number of candidates created.
+        """
+        records = dict()
+        for record in self.extractor.records:
+            # candidates are unique by full name in the db
+            records.setdefault(record["full_name"], record)
+
+        existing = set(
+            Candidate.objects.filter(full_name__in=list(records))
+            .values_list("full_name", flat=True))
+        candidates = [
+            Candidate(**record)
+            for full_name, record in records.items()
+            if full_name not in existing
+        ]
+        Candidate.objects.bulk_create(candidates, batch_size=self.batch_size)
+        logging.info(f"Created {len(candidates)} candidates, {len(existing)} already existed.")
+        return len(candidates)
 
     def fetch_civic_data(self, address):
         """
@@ -126,16 +135,7 @@ class CandidateCreator():
         """
         Get Facebook and Twitter ids from json
         """
-        twitter_id, fb_id = "", ""
-
-        if channels:
-            for channel in channels:
-                if channel["type"] == "Twitter":
-                    twitter_id = channel["id"]
-                elif channel["type"] == "Facebook":
-                    fb_id = channel["id"]
-
-        return twitter_id, fb_id
+        return social_channels(channels)
 
 
 class Command(BaseCommand):
@@ -162,3 +162,5 @@ class Command(BaseCommand):
                 response = creator.fetch_civic_data(address)
                 creator.create_candidates_from_response(
                     json.loads(response.text))
+
+        creator.save_candidates()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Content-addressed storage of voter info responses.
+
+Counties in the same state share most of their statewide contests and election
+officials. Instead of one full json per division, each normalised sub-document
+is stored once under the hash of its content and each division keeps a small
+manifest of hashes:
+
+    blobs/{sha256}.json             shared sub-documents
+    manifests/{geoid}_{date}.json   per division manifest
+"""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+# Sections stored one blob per element: contests are shared element by element
+ELEMENT_SECTIONS = ("contests",)
+# Sections stored as a single blob
+DOCUMENT_SECTIONS = ("state", "pollingLocations", "earlyVoteSites", "dropOffLocations")
+# Sections whose order carries no meaning and is normalised away
+UNORDERED_SECTIONS = ("pollingLocations", "earlyVoteSites", "dropOffLocations")
+
+BLOB_PREFIX = "blobs/"
+MANIFEST_PREFIX = "manifests/"
+
+# (bucket, hash) known to be stored, least recently used first, shared across warm invocations
+_stored_hashes = OrderedDict()
+_stored_hashes_lock = threading.Lock()
+MAX_STORED_HASHES = 100000
+
+
+def canonical_json(doc):
+    """
+    Serialises a document with sorted keys and no whitespace so equal content hashes equally.
+    """
+    return json.dumps(doc, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+
+
+def content_hash(doc):
+    return hashlib.sha256(canonical_json(doc).encode('utf-8')).hexdigest()
+
+
+def normalise_section(name, value):
+    if name in UNORDERED_SECTIONS and isinstance(value, list):
+        return sorted(value, key=canonical_json)
+    return value
+
+
+class ContentStore():
+    """
+    Stores voter info responses as shared content-addressed blobs plus a manifest per division.
+    Takes:
+        - client: CloudStorageClient
+        - bucket name on Google Cloud Storage
+    """
+
+    def __init__(self, client, bucket_name):
+        self.client = client
+        self.bucket_name = bucket_name
+
+    @staticmethod
+    def blob_name(digest):
+        return f"{BLOB_PREFIX}{digest}.json"
+
+    @staticmethod
+    def manifest_name(geoid, date):
+        return f"{MANIFEST_PREFIX}{geoid}_{date}.json"
+
+    def put(self, doc):
+        """
+        Stores a document once under the hash of its content.
+        Returns: the hash
+        """
+        digest = content_hash(doc)
+        key = (self.bucket_name, digest)
+        with _stored_hashes_lock:
+            if key in _stored_hashes:
+                _stored_hashes.move_to_end(key)
+                return digest
+        if not self.client.upload_json(doc, self.bucket_name, self.blob_name(digest), only_if_new=True):
+            raise IOError(f"Failed to store blob {digest} to gs://{self.bucket_name}")
+        with _stored_hashes_lock:
+            _stored_hashes[key] = True
+            while len(_stored_hashes) > MAX_STORED_HASHES:
+                _stored_hashes.popitem(last=False)
+        return digest
+
+    def get(self, digest):
+        doc = self.client.download_json(self.bucket_name, self.blob_name(digest))
+        if doc is None:
+            raise KeyError(f"Blob {digest} not found in gs://{self.bucket_name}")
+        return doc
+
+    def save_voter_info(self, geoid, result, date):
+        """
+        Splits a voter info response into shared blobs and writes the manifest for the division.
+        Takes:
+            - geoid such as a county fips code
+            - the data returned for the geoid
+            - date of the snapshot
+        Returns: the manifest blob name
+        """
+        manifest = {key: value for key, value in result.items()
+                    if key not in ELEMENT_SECTIONS + DOCUMENT_SECTIONS}
+        sections = dict()
+        for name in ELEMENT_SECTIONS:
+            if name in result:
+                sections[name] = [self.put(element) for element in result[name]]
+        for name in DOCUMENT_SECTIONS:
+            if name in result:
+                sections[name] = self.put(normalise_section(name, result[name]))
+        manifest['sections'] = sections
+
+        manifest_name = self.manifest_name(geoid, date)
+        if not self.client.upload_json(manifest, self.bucket_name, manifest_name):
+            raise IOError(f"Failed to store manifest gs://{self.bucket_name}/{manifest_name}")
+        logging.debug(f"Stored manifest for {geoid} with sections {list(sections)}")
+        return manifest_name
+
+    def load_voter_info(self, geoid, date):
+        """
+        Reassembles the voter info response of a division from its manifest and blobs.
+        """
+        manifest_name = self.manifest_name(geoid, date)
+        manifest = self.client.download_json(self.bucket_name, manifest_name)
+        if manifest is None:
+            raise KeyError(f"Manifest gs://{self.bucket_name}/{manifest_name} not found")
+        return self.assemble(manifest)
+
+    def get_many(self, digests, max_workers=8):
+        """
+        Downloads the blobs of several hashes concurrently.
+        Returns: dict of hash -> document
+        """
+        transfers = [(None, self.bucket_name, self.blob_name(digest)) for digest in set(digests)]
+        docs = dict()
+        for result in self.client.download_many(transfers, max_workers):
+            digest = result.blob_name[len(BLOB_PREFIX):-len(".json")]
+            if not result.ok:
+                raise KeyError(f"Failed to load blob {digest} from gs://{self.bucket_name}: {result.error}")
+            docs[digest] = result.data
+        return docs
+
+    def assemble(self, manifest):
+        result = {key: value for key, value in manifest.items() if key != 'sections'}
+        sections = manifest.get('sections', {})
+        digests = [digest for ref in sections.values() for digest in (ref if isinstance(ref, list) else [ref])]
+        docs = self.get_many(digests)
+        for name, ref in sections.items():
+            if isinstance(ref, list):
+                result[name] = [docs[digest] for digest in ref]
+            else:
+                result[name] = docs[ref]
+        return result
+# End
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Offline reverse geocoding of lat/long to U.S. counties using the bundled
+Census county gazetteer (data/Gaz_counties_national.txt).
+
+Points are indexed as unit vectors on the sphere, so the nearest county
+centroid is the one with the largest dot product. With ~3,200 centroids a
+chunked matrix product answers thousands of lookups in milliseconds and is
+faster than walking a tree from Python.
+Nearest centroid is a close approximation of the containing county, not a
+point-in-polygon test.
+"""
+import csv
+import os
+
+import numpy as np
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "Gaz_counties_national.txt")
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vectors(lats, longs):
+    """
+    Converts arrays of latitude and longitude in degrees to an (n, 3) array of unit vectors.
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    longs = np.radians(np.asarray(longs, dtype=np.float64))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(longs), cos_lats * np.sin(longs), np.sin(lats)))
+
+
+def nearest_unit_vectors(points, queries, k=1, chunk_size=256):
+    """
+    Finds the k nearest points to each query by great circle distance.
+    Takes:
+        - points: (n, 3) unit vectors of the index
+        - queries: (m, 3) unit vectors to look up
+        - k: number of neighbours
+        - chunk_size: queries per matrix product, bounds memory to chunk_size * n floats
+    Returns: (indices, distances_km), both of shape (m, k) ordered nearest first
+    """
+    k = min(k, len(points))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    similarity = np.empty((len(queries), k), dtype=np.float64)
+    for start in range(0, len(queries), chunk_size):
+        dots = queries[start:start + chunk_size] @ points.T
+        if k == 1:
+            top = np.argmax(dots, axis=1)[:, np.newaxis]
+        elif k < len(points):
+            top = np.argpartition(-dots, k - 1, axis=1)[:, :k]
+        else:
+            top = np.tile(np.arange(len(points)), (len(dots), 1))
+        top_dots = np.take_along_axis(dots, top, axis=1)
+        order = np.argsort(-top_dots, axis=1)
+        indices[start:start + chunk_size] = np.take_along_axis(top, order, axis=1)
+        similarity[start:start + chunk_size] = np.take_along_axis(top_dots, order, axis=1)
+    distances = np.arccos(np.clip(similarity, -1.0, 1.0)) * EARTH_RADIUS_KM
+    return indices, distances
+
+
+class CountyLocator():
+    """
+    Offline nearest-county lookup over the county gazetteer.
+    Attributes are parallel arrays: geoids (5 digit fips), usps (state abbr), names, lats, longs.
+    """
+
+    def __init__(self, geoids, usps, names, lats, longs):
+        self.geoids = np.asarray(geoids)
+        self.usps = np.asarray(usps)
+        self.names = np.asarray(names)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.longs = np.asarray(longs, dtype=np.float64)
+        self._points = to_unit_vectors(self.lats, self.longs)
+
+    @classmethod
+    def from_gazetteer(cls, filepath=GAZETTEER_PATH):
+        """
+        Loads the tab delimited Census county gazetteer.
+        """
+        columns = {"GEOID": [], "USPS": [], "NAME": [], "INTPTLAT": [], "INTPTLONG": []}
+        with open(filepath, "r", encoding="latin-1", newline="") as file:
+            reader = csv.reader(file, delimiter="\t")
+            header = [name.strip() for name in next(reader)]
+            positions = {name: header.index(name) for name in columns}
+            for row in reader:
+                if not row:
+                    continue
+                for name, position in positions.items():
+                    columns[name].append(row[position].strip())
+        return cls(
+            geoids=[geoid.zfill(5) for geoid in columns["GEOID"]],
+            usps=columns["USPS"],
+            names=columns["NAME"],
+            lats=[float(lat) for lat in columns["INTPTLAT"]],
+            longs=[float(long) for long in columns["INTPTLONG"]],
+        )
+
+    def __len__(self):
+        return len(self.geoids)
+
+    def nearest(self, lats, longs, k=1):
+        """
+        Vectorised k nearest counties for arrays of points.
+        Returns: (indices, distances_km) of shape (n, k) into the locator's arrays
+        """
+        return nearest_unit_vectors(self._points, to_unit_vectors(np.atleast_1d(lats), np.atleast_1d(longs)), k=k)
+
+    def lookup(self, lats, longs):
+        """
+        Vectorised nearest county for arrays of points.
+        Returns: dict of arrays GEOID, USPS, NAME and distance_km, one entry per point
+        """
+        indices, distances = self.nearest(lats, longs, k=1)
+        indices = indices[:, 0]
+        return {
+            "GEOID": self.geoids[indices],
+            "USPS": self.usps[indices],
+            "NAME": self.names[indices],
+            "distance_km": distances[:, 0],
+        }
+
+    def reverse_geocode(self, lat, long):
+        """
+        Nearest county for a single point.
+        Returns: dict with GEOID, USPS, NAME and distance_km
+        """
+        result = self.lookup([lat], [long])
+        return {key: value[0].item() for key, value in result.items()}
+# End
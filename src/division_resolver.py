@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Resolves the OCD division id of an election to the smallest set of county
+locales that covers it, so a county or city election fans out to its own
+divisions rather than to every county of the state.
+
+    ocd-division/country:us                               -> every county
+    ocd-division/country:us/state:va                      -> the counties of VA
+    ocd-division/country:us/state:md/county:baltimore     -> 24005
+    ocd-division/country:us/state:md/place:baltimore      -> 24510 (independent city)
+    ocd-division/country:us/state:la/parish:orleans       -> 22071
+    ocd-division/country:us/state:ca/cd:12                -> the counties of CA
+
+County equivalents (counties, parishes, boroughs, census areas, municipios and
+independent cities) are indexed from the Census county gazetteer. Divisions
+with no county mapping, such as congressional or legislative districts and
+places inside a county, resolve to the narrowest ancestor that has one.
+https://opencivicdata.readthedocs.io/en/latest/ocdids.html
+"""
+import logging
+import re
+import threading
+import unicodedata
+from collections import namedtuple
+
+from src.county_locator import CountyLocator, GAZETTEER_PATH
+
+# OCD types of the top level division below the country, all keyed by state abbreviation
+STATE_TYPES = ("state", "territory", "district")
+
+# OCD types of county equivalents
+COUNTY_TYPES = ("county", "parish", "borough", "census_area", "municipio", "municipality", "city_and_borough")
+
+# Gazetteer name suffixes of county equivalents, longest first
+COUNTY_SUFFIXES = (
+    " City and Borough", " Census Area", " Municipality", " Municipio",
+    " Borough", " Parish", " County",
+)
+# Independent cities are county equivalents named "{name} city" and addressed as places
+CITY_SUFFIX = " city"
+# Consolidated city-counties named "{name} County" whose city is also addressed as a place.
+# Other places are not mapped: a city often lies outside the county of the same name.
+CONSOLIDATED_CITIES = {
+    ("CA", "sanfrancisco"),
+    ("CO", "broomfield"),
+    ("CO", "denver"),
+    ("HI", "honolulu"),
+    ("PA", "philadelphia"),
+}
+
+# Division a resolution stopped at
+Division = namedtuple("Division", ["ocd_id", "state_abbr", "fips", "level"])
+Division.__doc__ = """
+Resolved division.
+    - ocd_id: the id that was resolved
+    - state_abbr: state of the division, None for the whole country
+    - fips: tuple of county fips codes, None for every county of the state (or country)
+    - level: "country", "state" or "county", the narrowest level that could be mapped
+"""
+
+
+def normalise_name(name):
+    """
+    Reduces an OCD id segment or gazetteer name to lowercase ascii letters and digits,
+    so "st._clair", "St. Clair" and "doña_ana" / "Dona Ana" match.
+    """
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def parse_ocd_id(ocd_id):
+    """
+    Splits an OCD division id into its (type, value) segments.
+    Returns: list of (type, value), e.g. [("country", "us"), ("state", "va")]
+    """
+    segments = []
+    for part in (ocd_id or "").strip().split("/"):
+        if ":" not in part:
+            # the ocd-division prefix
+            continue
+        division_type, value = part.split(":", 1)
+        segments.append((division_type.lower(), value.lower()))
+    return segments
+
+
+class DivisionResolver():
+    """
+    Maps OCD division ids to county fips codes with an index of
+    (state_abbr, kind, normalised name) -> fips built once from the gazetteer,
+    where kind is "county" for county equivalents and "place" for independent
+    and consolidated cities.
+    """
+
+    def __init__(self, geoids, usps, names, locator=None):
+        # County centroids the index was built from, when built from the gazetteer
+        self.locator = locator
+        self.index = dict()
+        aliases = dict()
+        for geoid, state_abbr, name in zip(geoids, usps, names):
+            key, alias = self.index_keys(state_abbr, name)
+            if key in self.index:
+                logging.warning(f"Ambiguous division {key}: {self.index[key]} and {geoid}")
+                continue
+            self.index[key] = geoid
+            if alias is not None:
+                aliases[alias] = geoid
+        # Aliases never shadow an independent city of the same name (Baltimore County, Baltimore city)
+        for alias, geoid in aliases.items():
+            self.index.setdefault(alias, geoid)
+
+    @classmethod
+    def from_gazetteer(cls, filepath=GAZETTEER_PATH):
+        locator = CountyLocator.from_gazetteer(filepath)
+        return cls(locator.geoids.tolist(), locator.usps.tolist(), locator.names.tolist(), locator=locator)
+
+    @staticmethod
+    def index_keys(state_abbr, name):
+        """
+        Returns: (key, alias) index keys of a gazetteer county name. 
+        Consolidated city-counties, such as Carson City, Juneau City and Borough
+        or Anchorage Municipality, get a place alias as they are addressed either way.
+        """
+        state_abbr = state_abbr.upper()
+        if name.endswith(CITY_SUFFIX):
+            return (state_abbr, "place", normalise_name(name[:-len(CITY_SUFFIX)])), None
+        consolidated = True
+        for suffix in COUNTY_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                consolidated = suffix in (" City and Borough", " Municipality")
+                break
+        key = (state_abbr, "county", normalise_name(name))
+        if consolidated or key[::2] in CONSOLIDATED_CITIES:
+            return key, (state_abbr, "place", key[2])
+        return key, None
+
+    def lookup(self, state_abbr, kind, name):
+        return self.index.get((state_abbr, kind, normalise_name(name)))
+
+    def resolve(self, ocd_id):
+        """
+        Resolves an OCD division id to the county locales that cover it.
+        Returns: Division
+        """
+        segments = parse_ocd_id(ocd_id)
+        state_abbr = None
+        fips = None
+        level = "country"
+        for division_type, value in segments:
+            if division_type == "country":
+                continue
+            if division_type in STATE_TYPES and state_abbr is None:
+                state_abbr, level = value.upper(), "state"
+                continue
+            if state_abbr is None or fips is not None:
+                # Subdivisions of a county (council districts, precincts...) stay within the county
+                break
+            if division_type in COUNTY_TYPES:
+                match = self.lookup(state_abbr, "county", value)
+            elif division_type == "place":
+                match = self.lookup(state_abbr, "place", value)
+            else:
+                match = None
+            if match is None:
+                logging.debug(f"No county mapping for {division_type}:{value} in {ocd_id}, using {level}.")
+                break
+            fips, level = (match,), "county"
+        return Division(ocd_id, state_abbr, fips, level)
+
+
+# Resolver shared across warm invocations
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """
+    Returns the process-wide DivisionResolver, building its index on first use.
+    """
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = DivisionResolver.from_gazetteer()
+    return _resolver
+
+
+def resolve_division(ocd_id):
+    return get_resolver().resolve(ocd_id)
+# End
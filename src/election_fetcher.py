@@ -10,7 +10,8 @@ import os
 import logging
 import json
 import requests
-from google.cloud import storage
+from src import utils_http
+from src.utils_metrics import metrics
 
 class ElectionsFetcher(): 
     """
@@ -21,7 +22,8 @@ class ElectionsFetcher():
     """
     
     def __init__(self):
-        self._url = "https://www.googleapis.com/civicinfo/v2/elections"
+        # Base url can be pointed at a local stand-in for benchmarks
+        self._url = os.environ.get("GOOGLE_CIVIC_API_URL", "https://www.googleapis.com/civicinfo/v2") + "/elections"
         self._api_key = os.environ["GOOGLE_CIVIC_API_KEY"]
 
     def fetch_elections(self):
@@ -29,15 +31,42 @@ class ElectionsFetcher():
         Make a call to the api to return election info
         """
         payload = {"key": self._api_key} 
-        response = requests.get(self._url, params=payload)
+        response = utils_http.get(self._url, params=payload, endpoint="elections")
         try: 
             response.raise_for_status() 
-            return response.json()
+            with metrics.timer("parse", endpoint="elections"): 
+                return response.json()
         except requests.exceptions.HTTPError as error:
             # Error in request 
             logging.error(error)
         except requests.exceptions.RequestException as error:
             # Catastrophic error 
             logging.error(error)
-            raise    
+            raise
+
+# Election fields that trigger a new fan-out when they change
+ELECTION_FIELDS = ("name", "electionDay", "ocdDivisionId")
+
+def diff_elections(previous, current):
+    """
+    Compares two lists of elections as returned by the API. 
+    Takes: 
+        - previous: elections in the last stored snapshot (or None)
+        - current: elections in the new response
+    Returns: list of {"id": election_id, "reason": "new" | "changed" | "removed"}. 
+             New and changed elections are published, removed ones are no longer current.
+    """
+    previous = {str(election['id']): election for election in previous or []}
+    current_ids = {str(election['id']) for election in current}
+    changes = []
+    for election in current: 
+        old = previous.get(str(election['id']))
+        if old is None: 
+            changes.append({"id": str(election['id']), "reason": "new"})
+        elif any(old.get(field) != election.get(field) for field in ELECTION_FIELDS): 
+            changes.append({"id": str(election['id']), "reason": "changed"})
+    for election_id in previous: 
+        if election_id not in current_ids: 
+            changes.append({"id": election_id, "reason": "removed"})
+    return changes
 # End
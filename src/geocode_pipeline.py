@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Bulk reverse geocoding of county centroids into the address locales table.
+
+Coordinates are rounded to a fixed precision and deduplicated, then looked up
+in a persistent on-disk cache. Only the misses are sent to the Google
+Geocoding API, concurrently and under a rate limit. Failed lookups are not
+cached, so a rerun after a partial failure only pays for the missing rows.
+"""
+import csv
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src.utils_rate_limit import RateLimiter
+
+# Geocoding API statuses that are final answers and safe to cache
+CACHEABLE_STATUSES = ("OK", "ZERO_RESULTS")
+
+LOCALE_COLUMNS = ["state_abbr", "fips", "name", "lat", "long", "address"]
+
+
+class GeocodeCache():
+    """
+    Persistent cache of geocoding responses in a sqlite file.
+    Keeps at most max_entries responses, evicting the least recently used.
+    """
+
+    def __init__(self, filepath="/tmp/geocode_cache.sqlite", max_entries=100000):
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, response TEXT NOT NULL, used REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS geocode_used ON geocode (used)")
+
+    def get_many(self, keys):
+        """
+        Returns: dict of key -> response for the keys found in the cache.
+        """
+        found = dict()
+        keys = list(keys)
+        now = time.time()
+        with self._lock, self._connection:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, response FROM geocode WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update((key, json.loads(response)) for key, response in rows)
+                self._connection.execute(
+                    f"UPDATE geocode SET used = ? WHERE key IN ({placeholders})", [now] + batch
+                )
+        return found
+
+    def put(self, key, response):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO geocode (key, response, used) VALUES (?, ?, ?)",
+                (key, json.dumps(response), time.time())
+            )
+
+    def evict(self):
+        """
+        Removes the least recently used entries above max_entries.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM geocode WHERE key IN "
+                "(SELECT key FROM geocode ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+def coordinate_key(lat, long, precision):
+    return f"{round(float(lat), precision):.{precision}f},{round(float(long), precision):.{precision}f}"
+
+
+def select_address(response):
+    """
+    Picks the address of a locale from a geocoding response.
+    Takes the first formatted address, most likely to be valid, unless it is an
+    'Unnamed Road' and the second is a valid four part address.
+    Returns: the address or None
+    """
+    addresses = [item['formatted_address'] for item in (response or {}).get('results', [])]
+    if not addresses:
+        return None
+    if 'Unnamed Road' in addresses[0] and len(addresses) > 1 and len(addresses[1].split(",")) == 4:
+        return addresses[1]
+    return addresses[0]
+
+
+class BulkGeocoder():
+    """
+    Reverse geocodes many points through a persistent cache.
+    Takes:
+        - geocoder: object with reverse_geocode(lat, long, limiter=...) such as ReverseGeocode
+        - cache: GeocodeCache
+        - precision: decimal places coordinates are rounded to before deduplication
+        - max_workers: maximum number of calls in flight
+        - requests_per_second: request budget shared by all workers
+    """
+
+    def __init__(self, geocoder, cache, precision=4, max_workers=8, requests_per_second=20):
+        self.geocoder = geocoder
+        self.cache = cache
+        self.precision = precision
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(requests_per_second)
+
+    def geocode(self, lats, longs):
+        """
+        Reverse geocodes arrays of points.
+        Returns: dict of coordinate key -> response for every point that resolved
+        """
+        keys = {coordinate_key(lat, long, self.precision) for lat, long in zip(lats, longs)}
+        responses = self.cache.get_many(keys)
+        misses = sorted(keys - set(responses))
+        logging.info(f"{len(keys)} unique points: {len(responses)} cached, {len(misses)} to geocode.")
+
+        def run(key):
+            lat, long = key.split(",")
+            return self.geocoder.reverse_geocode(lat, long, limiter=self.limiter)
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run, key): key for key in misses}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    response = future.result()
+                except Exception as error:
+                    response = None
+                    logging.error(f"Failed to geocode {key}: {error}")
+                if response and response.get('status') in CACHEABLE_STATUSES:
+                    self.cache.put(key, response)
+                    responses[key] = response
+                else:
+                    failed += 1
+
+        self.cache.evict()
+        logging.info(f"Geocoded {len(misses) - failed} points, {failed} failed.")
+        return responses
+
+    def build_locales(self, locator, filepath):
+        """
+        Geocodes every county centroid of a CountyLocator and writes the locales csv in one pass.
+        Counties that failed to geocode are written without an address.
+        Returns: number of counties with an address
+        """
+        responses = self.geocode(locator.lats, locator.longs)
+        found = 0
+        with open(filepath, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(LOCALE_COLUMNS)
+            for state_abbr, fips, name, lat, long in zip(
+                    locator.usps, locator.geoids, locator.names, locator.lats, locator.longs):
+                address = select_address(responses.get(coordinate_key(lat, long, self.precision)))
+                found += address is not None
+                writer.writerow([state_abbr, fips, name, lat, long, address or ""])
+        logging.info(f"Wrote {found} of {len(locator)} locales to {filepath}")
+        return found
+# End
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Compact, indexed store of address locales used for division fan-out.
+
+Locales are kept in a numpy structured array sorted by fips and saved as a
+.npy file, so it can be memory-mapped at runtime. Because county fips codes
+start with the state fips code, each state is a contiguous slice of the
+array: a state is selected by slicing and a fips code is found by binary search.
+"""
+import csv
+import logging
+
+import numpy as np
+
+
+class LocaleStore():
+    """
+    Address locales indexed by state and by fips.
+    Build once from the addresses csv with LocaleStore.from_csv(...).save(...),
+    then open at runtime with LocaleStore.load(...).
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._states = None
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Builds a store from an iterable of (fips, state_abbr, address) tuples.
+        """
+        rows = sorted(
+            (str(fips).zfill(5).encode('utf-8'), state_abbr.upper().encode('utf-8'), address.encode('utf-8'))
+            for fips, state_abbr, address in records
+        )
+        width = max([len(address) for fips, state_abbr, address in rows] or [1])
+        dtype = np.dtype([('fips', 'S5'), ('state_abbr', 'S2'), ('address', f'S{width}')])
+        return cls(np.array(rows, dtype=dtype))
+
+    @classmethod
+    def from_csv(cls, filepath):
+        """
+        Builds a store from a locales csv with 'fips', 'state_abbr' and 'address' columns.
+        Rows without an address are skipped.
+        """
+        records = []
+        with open(filepath, 'r', encoding='utf-8', newline='') as file:
+            for row in csv.DictReader(file):
+                if not row.get('address'):
+                    logging.warning(f"Skipping locale {row.get('fips')}: no address.")
+                    continue
+                records.append((row['fips'], row['state_abbr'], row['address']))
+        logging.info(f"Loaded {len(records)} locales from {filepath}")
+        return cls.from_records(records)
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """
+        Opens a store saved with save(). Memory-mapped unless mmap is False.
+        """
+        return cls(np.load(filepath, mmap_mode='r' if mmap else None, allow_pickle=False))
+
+    def save(self, filepath):
+        with open(filepath, 'wb') as file:
+            np.save(file, self.data, allow_pickle=False)
+        logging.debug(f"Saved {len(self)} locales to {filepath}")
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def states(self):
+        """
+        Index of state abbreviation -> (start, stop) slice of the store.
+        """
+        if self._states is None:
+            abbrs, starts = np.unique(self.data['state_abbr'], return_index=True)
+            order = np.argsort(starts)
+            abbrs, starts = abbrs[order], starts[order]
+            stops = np.append(starts[1:], len(self.data))
+            self._states = {
+                abbr.decode('utf-8'): (int(start), int(stop))
+                for abbr, start, stop in zip(abbrs, starts, stops)
+            }
+        return self._states
+
+    def _rows(self, start, stop):
+        fips = self.data['fips'][start:stop].tolist()
+        addresses = self.data['address'][start:stop].tolist()
+        for geo_id, address in zip(fips, addresses):
+            yield geo_id.decode('utf-8'), address.decode('utf-8')
+
+    def select(self, state_abbr=None):
+        """
+        Iterates (fips, address) for a state, or for all locales if state_abbr is None.
+        """
+        if state_abbr is None:
+            return self._rows(0, len(self.data))
+        start, stop = self.states.get(state_abbr.upper(), (0, 0))
+        return self._rows(start, stop)
+
+    def select_fips(self, fips_codes):
+        """
+        Iterates (fips, address) for the given fips codes found in the store, in fips order.
+        """
+        for fips in sorted(str(fips).zfill(5) for fips in fips_codes):
+            address = self.lookup(fips)
+            if address is not None:
+                yield fips, address
+
+    def count(self, state_abbr=None):
+        if state_abbr is None:
+            return len(self.data)
+        start, stop = self.states.get(state_abbr.upper(), (0, 0))
+        return stop - start
+
+    def lookup(self, fips):
+        """
+        Returns the address for a fips code, or None if it is not in the store.
+        """
+        key = str(fips).zfill(5).encode('utf-8')
+        index = int(np.searchsorted(self.data['fips'], key))
+        if index < len(self.data) and self.data['fips'][index] == key:
+            return self.data['address'][index].decode('utf-8')
+        return None
+# End
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+In-memory spatial index of the polling places, early vote sites and drop off
+locations of an election, extracted from the voter info responses.
+
+Sites are kept in a numpy structured array sorted by fips and saved as a .npy
+file, as the locale store is (src/locale_store.py): the sites of a county are
+a contiguous slice found by binary search. Sites with a latitude and longitude
+are indexed as unit vectors, so the k nearest sites to many points are found
+with chunked matrix products (src/county_locator.py).
+
+A site listed in the responses of several counties, such as a statewide early
+vote site, is stored once per county for county queries and counted once for
+nearest queries.
+"""
+import logging
+
+import numpy as np
+
+from src.county_locator import nearest_unit_vectors, to_unit_vectors
+
+# Response section -> site kind
+KINDS = {"pollingLocations": "polling", "earlyVoteSites": "early_vote", "dropOffLocations": "drop_off"}
+ADDRESS_FIELDS = ("line1", "line2", "line3", "city", "state", "zip")
+
+
+def site_address(address):
+    """
+    Formats the address of a site as one line: "1 Elm St, Providence, RI 02903".
+    """
+    street = ", ".join(str(address[field]) for field in ADDRESS_FIELDS[:4] if address.get(field))
+    region = " ".join(str(address[field]) for field in ADDRESS_FIELDS[4:] if address.get(field))
+    return ", ".join(part for part in (street, region) if part)
+
+
+def extract_sites(geo_id, response):
+    """
+    Yields a (fips, kind, name, address, hours, lat, long) record per site of a voter info response.
+    Latitude and longitude are NaN when the response does not give them.
+    """
+    fips = str(geo_id).zfill(5)
+    for section, kind in KINDS.items():
+        for site in response.get(section) or []:
+            address = site.get("address") or {}
+            try:
+                lat, long = float(site["latitude"]), float(site["longitude"])
+            except (KeyError, TypeError, ValueError):
+                lat, long = np.nan, np.nan
+            name = address.get("locationName") or site.get("name") or ""
+            yield fips, kind, name, site_address(address), site.get("pollingHours") or "", lat, long
+
+
+class PollingIndex():
+    """
+    Sites of an election indexed by county and by location.
+    Build with PollingIndex.from_responses(...).save(...), then open with PollingIndex.load(...).
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._located = None
+        self._points = None
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Builds an index from an iterable of (fips, kind, name, address, hours, lat, long) tuples.
+        """
+        rows = sorted(
+            (fips.encode("utf-8"), kind.encode("utf-8"), name.encode("utf-8"), address.encode("utf-8"),
+             hours.encode("utf-8"), lat, long)
+            for fips, kind, name, address, hours, lat, long in records
+        )
+
+        def width(position):
+            return max([len(row[position]) for row in rows] or [1])
+
+        dtype = np.dtype([
+            ("fips", "S5"), ("kind", f"S{width(1)}"), ("name", f"S{width(2)}"), ("address", f"S{width(3)}"),
+            ("hours", f"S{width(4)}"), ("lat", "f8"), ("long", "f8"),
+        ])
+        return cls(np.array(rows, dtype=dtype))
+
+    @classmethod
+    def from_responses(cls, responses):
+        """
+        Builds an index from an iterable of (geo_id, voter info response).
+        """
+        records = [record for geo_id, response in responses for record in extract_sites(geo_id, response)]
+        logging.info(f"Extracted {len(records)} sites")
+        return cls.from_records(records)
+
+    @classmethod
+    def load(cls, filepath, mmap=True):
+        """
+        Opens an index saved with save(). Memory-mapped unless mmap is False.
+        """
+        return cls(np.load(filepath, mmap_mode="r" if mmap else None, allow_pickle=False))
+
+    def save(self, filepath):
+        with open(filepath, "wb") as file:
+            np.save(file, self.data, allow_pickle=False)
+        logging.debug(f"Saved {len(self)} sites to {filepath}")
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def located(self):
+        """
+        Positions of the distinct sites with a location, the rows nearest queries choose from.
+        """
+        if self._located is None:
+            fields = ["kind", "name", "address", "lat", "long"]
+            rows = np.flatnonzero(np.isfinite(self.data["lat"]) & np.isfinite(self.data["long"]))
+            _, first = np.unique(self.data[fields][rows], return_index=True)
+            self._located = rows[np.sort(first)]
+            self._points = to_unit_vectors(self.data["lat"][self._located], self.data["long"][self._located])
+        return self._located
+
+    def nearest(self, lats, longs, k=1, kind=None):
+        """
+        Vectorised k nearest sites to arrays of points.
+        Takes:
+            - lats, longs: arrays of the points in degrees
+            - k: number of sites per point
+            - kind: "polling", "early_vote" or "drop_off" to only consider one kind of site
+        Returns: (positions, distances_km) of shape (n, k) into the index's rows, nearest first.
+                 Fewer than k columns if the index holds fewer sites.
+        """
+        located, points = self.located, self._points
+        if kind is not None:
+            mask = self.data["kind"][located] == kind.encode("utf-8")
+            located, points = located[mask], points[mask]
+        queries = to_unit_vectors(np.atleast_1d(lats), np.atleast_1d(longs))
+        if not len(located):
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0))
+        indices, distances = nearest_unit_vectors(points, queries, k=k)
+        return located[indices], distances
+
+    def county(self, fips):
+        """
+        Returns: (start, stop) slice of the rows of a county, empty if it has no sites
+        """
+        key = str(fips).zfill(5).encode("utf-8")
+        start = int(np.searchsorted(self.data["fips"], key, side="left"))
+        stop = int(np.searchsorted(self.data["fips"], key, side="right"))
+        return start, stop
+
+    def records(self, positions):
+        """
+        Returns: list of site dicts for row positions
+        """
+        rows = self.data[np.asarray(positions, dtype=np.int64)]
+        return [
+            {
+                "fips": row["fips"].decode("utf-8"),
+                "kind": row["kind"].decode("utf-8"),
+                "name": row["name"].decode("utf-8"),
+                "address": row["address"].decode("utf-8"),
+                "hours": row["hours"].decode("utf-8"),
+                "lat": None if np.isnan(row["lat"]) else float(row["lat"]),
+                "long": None if np.isnan(row["long"]) else float(row["long"]),
+            }
+            for row in rows
+        ]
+
+    def select(self, fips, kind=None):
+        """
+        Returns: the site dicts of a county, optionally of one kind
+        """
+        start, stop = self.county(fips)
+        positions = np.arange(start, stop)
+        if kind is not None:
+            positions = positions[self.data["kind"][start:stop] == kind.encode("utf-8")]
+        return self.records(positions)
+# End
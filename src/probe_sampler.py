@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Probe-and-expand collection of voter info for the counties of a state.
+
+Most counties of a state get the same statewide and district contests and
+differ only in their local races. Instead of calling the API for every
+county, ProbeSampler fetches a geographically spread probe set, compares the
+contests the probes share beyond local races (their signature), and expands:
+
+    1. Fetch the probes, spread across the state by farthest point sampling.
+    2. For every county not fetched, look at its nearest fetched neighbours.
+       If they disagree, the county lies near a boundary (a congressional or
+       legislative district line): fetch it.
+    3. Repeat until the neighbours of every remaining county agree.
+    4. Remaining counties inherit the data of their nearest fetched county,
+       recorded in the voter info manifest with `inherited_from`.
+
+Pub/Sub may deliver a probe message more than once. A run is skipped when the
+run ledger shows every division of the state done, or in flight in another
+delivery, for the day.
+
+Inherited counties share the statewide and district contests of their probe.
+Their local races and polling locations are not collected, so use the
+coverage settings (or the default one-call-per-division fan-out) where those
+matter.
+"""
+import hashlib
+import json
+import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.county_locator import nearest_unit_vectors, to_unit_vectors
+from src.run_ledger import CompletionLedger, RunLedger, IN_FLIGHT, DONE, FAILED, STALE_AFTER
+
+# Contest district scopes shared by many counties. Other scopes (countywide,
+# citywide, schoolBoard, ward...) are local races and left out of the signature.
+SHARED_SCOPES = ("national", "statewide", "congressional", "stateUpper", "stateLower")
+
+
+def contest_signature(response):
+    """
+    Hashes the contests of a response that are shared beyond its own county.
+    Returns: hex digest, equal for responses with the same shared contests
+    """
+    contests = sorted(
+        (
+            (contest.get("district") or {}).get("id", ""),
+            contest.get("office") or contest.get("referendumTitle") or "",
+        )
+        for contest in (response or {}).get("contests") or []
+        if (contest.get("district") or {}).get("scope", "statewide") in SHARED_SCOPES
+    )
+    return hashlib.sha256(json.dumps(contests).encode("utf-8")).hexdigest()
+
+
+def farthest_point_sample(points, count, start=0):
+    """
+    Picks `count` indices of unit vectors, each as far as possible from those already picked.
+    Returns: list of indices into points
+    """
+    count = min(count, len(points))
+    if count <= 0:
+        return []
+    chosen = [start]
+    # Largest dot product with a chosen point = closest chosen point
+    closest = points @ points[start]
+    while len(chosen) < count:
+        index = int(np.argmin(closest))
+        chosen.append(index)
+        closest = np.maximum(closest, points @ points[index])
+    return chosen
+
+
+class ProbeSampler():
+    """
+    Collects voter info for the divisions of a state with as few API calls as
+    the agreement between neighbouring counties allows.
+    Takes:
+        - civic: VoterInfo
+        - locator: CountyLocator with the county centroids
+        - bucket name on Google Cloud Storage
+        - probe_fraction, min_probes: size of the first probe set
+        - neighbours: fetched neighbours compared for each remaining county
+        - min_coverage: fraction of divisions always fetched directly
+        - max_rounds: expansion rounds before the remaining counties inherit
+        - max_workers: concurrent calls
+        - limiter: optional shared limiter, such as the Civic API scheduler
+    """
+
+    def __init__(self, civic, locator, bucket_name, probe_fraction=0.1, min_probes=5, neighbours=3,
+                 min_coverage=0.0, max_rounds=5, max_workers=8, limiter=None):
+        self.civic = civic
+        self.locator = locator
+        self.bucket_name = bucket_name
+        self.probe_fraction = probe_fraction
+        self.min_probes = min_probes
+        self.neighbours = neighbours
+        self.min_coverage = min_coverage
+        self.max_rounds = max_rounds
+        self.max_workers = max_workers
+        self.limiter = limiter
+        self._positions = {geoid: index for index, geoid in enumerate(locator.geoids.tolist())}
+
+    def _fetch(self, election_id, divisions, signatures, failed, reasons):
+        """
+        Fetches and saves divisions concurrently, recording the signature of each response.
+        Probes are fetched even if already completed today, as their contests are compared.
+        Their states are recorded in the ledger by run(), one batch for the run.
+        """
+        def run(division):
+            geo_id, address = division
+            return self.civic.fetch_division(
+                address, election_id, geo_id, self.bucket_name, limiter=self.limiter, skip_completed=False,
+                record_state=False)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run, division): division[0] for division in divisions}
+            for future, geo_id in futures.items():
+                try:
+                    signatures[geo_id] = contest_signature(future.result())
+                except Exception as error:
+                    failed[geo_id] = str(error)
+                    reasons[geo_id] = error.__class__.__name__
+                    logging.error(f"Failed to retrieve data for {election_id}:{geo_id}")
+                    logging.error(error)
+
+    @staticmethod
+    def _neighbours(located, points, signatures, failed, k):
+        """
+        Finds the k nearest fetched divisions of every division not fetched (or failed) yet.
+        Returns: (fetched, remaining, nearest) with fetched and remaining as indices
+                 into located and nearest as rows of indices into fetched
+        """
+        fetched = [index for index, geo_id in enumerate(located) if geo_id in signatures]
+        remaining = [index for index, geo_id in enumerate(located) if geo_id not in signatures and geo_id not in failed]
+        if not fetched or not remaining:
+            return fetched, [], []
+        nearest, distances = nearest_unit_vectors(points[fetched], points[remaining], k=k)
+        return fetched, remaining, nearest.tolist()
+
+    def run(self, election_id, divisions):
+        """
+        Collects voter info for the divisions of one state.
+        Takes:
+            - election_id as returned by Civic Information API
+            - divisions: list of (geo_id, address)
+        Returns: summary dict with
+            - fetched: geo_id -> contest signature
+            - inherited: geo_id -> geo_id of the fetched division it inherits from
+            - failed: geo_id -> error
+            - rounds: expansion rounds run
+            - skipped: True if the divisions were already settled by another delivery
+        The states of the divisions are recorded in the ledger in two writes: all in flight
+        at the start, then each done (fetched or inherited) or failed at the end.
+        """
+        addresses = dict(divisions)
+        signatures, failed, reasons, inherited = dict(), dict(), dict(), dict()
+        records = RunLedger(self.civic.client, self.bucket_name).records(election_id, self.civic.date)
+        if addresses and all(self._settled(records.get(str(geo_id))) for geo_id in addresses):
+            logging.info(
+                f"Skipping probe run of election {election_id}: its {len(addresses)} divisions are "
+                f"done or in flight for {self.civic.date}"
+            )
+            return {"fetched": signatures, "inherited": inherited, "failed": failed, "rounds": 0, "skipped": True}
+        ledger = CompletionLedger(self.civic.client, self.bucket_name)
+        ledger.mark_batch(election_id, self.civic.date, [{"geo_id": geo_id, "status": IN_FLIGHT} for geo_id in addresses])
+
+        # Divisions without a centroid cannot be compared to neighbours and are always fetched
+        located = [geo_id for geo_id in addresses if geo_id in self._positions]
+        unlocated = [geo_id for geo_id in addresses if geo_id not in self._positions]
+        if not located:
+            self._fetch(election_id, [(geo_id, addresses[geo_id]) for geo_id in unlocated], signatures, failed, reasons)
+            self._record(ledger, election_id, signatures, inherited, failed, reasons)
+            return {"fetched": signatures, "inherited": inherited, "failed": failed, "rounds": 0, "skipped": False}
+
+        positions = np.array([self._positions[geo_id] for geo_id in located])
+        points = to_unit_vectors(self.locator.lats[positions], self.locator.longs[positions])
+
+        probes = max(
+            self.min_probes,
+            math.ceil(len(located) * self.probe_fraction),
+            math.ceil(len(located) * self.min_coverage),
+        )
+        batch = [located[index] for index in farthest_point_sample(points, probes)] + unlocated
+        rounds = 0
+        while batch:
+            logging.info(f"Probe round {rounds} for election {election_id}: fetching {len(batch)} divisions")
+            self._fetch(election_id, [(geo_id, addresses[geo_id]) for geo_id in batch], signatures, failed, reasons)
+            rounds += 1
+            fetched, remaining, nearest = self._neighbours(located, points, signatures, failed, self.neighbours)
+            batch = [
+                located[index] for index, row in zip(remaining, nearest)
+                if len({signatures[located[fetched[neighbour]]] for neighbour in row}) > 1
+            ]
+            if batch and rounds >= self.max_rounds:
+                logging.warning(f"Stopped expanding election {election_id} after {rounds} rounds, {len(batch)} divisions still diverge.")
+                break
+
+        # Every division left inherits from its nearest fetched division
+        fetched, remaining, nearest = self._neighbours(located, points, signatures, failed, 1)
+        for index, row in zip(remaining, nearest):
+            inherited[located[index]] = located[fetched[row[0]]]
+
+        # Inherited divisions point at the blob the response of their source was saved to
+        for geo_id, source in inherited.items():
+            self.civic.manifest.add(
+                self.bucket_name,
+                election_id,
+                geo_id,
+                self.civic.date,
+                self.civic.blob_name(source),
+                inherited_from=source
+            )
+        self.civic.flush_manifest()
+        self._record(ledger, election_id, signatures, inherited, failed, reasons)
+
+        logging.info(
+            f"Probed election {election_id}: {len(signatures)} fetched, {len(inherited)} inherited, "
+            f"{len(failed)} failed, {len(set(signatures.values()))} distinct contest sets in {rounds} rounds."
+        )
+        return {"fetched": signatures, "inherited": inherited, "failed": failed, "rounds": rounds, "skipped": False}
+
+    @staticmethod
+    def _settled(record, stale_after=STALE_AFTER):
+        """
+        Returns: True if the ledger record shows the division done, or in flight in a live delivery
+        """
+        if record is None:
+            return False
+        if record["status"] == IN_FLIGHT:
+            return time.time() - record["updated"] <= stale_after
+        return record["status"] == DONE
+
+    def _record(self, ledger, election_id, signatures, inherited, failed, reasons):
+        """
+        Records the outcome of every division of the run in one write.
+        """
+        states = [{"geo_id": geo_id, "status": DONE, "blob_name": self.civic.blob_name(geo_id)} for geo_id in signatures]
+        states += [
+            {"geo_id": geo_id, "status": DONE, "blob_name": self.civic.blob_name(source), "inherited_from": source}
+            for geo_id, source in inherited.items()
+        ]
+        states += [
+            {"geo_id": geo_id, "status": FAILED, "error": error, "reason": reasons.get(geo_id, "unknown")}
+            for geo_id, error in failed.items()
+        ]
+        ledger.mark_batch(election_id, self.civic.date, states)
+# End
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Ledger of voter info fetches, keyed by election, division and date.
+Pub/Sub delivers at least once, so a division message may arrive more than
+once. Workers check the ledger before calling the API and skip divisions
+that already have a result for the day.
+
+Each record holds the outcome of the division's fetch: done or failed (with
+the error). Divisions fetched alone are not recorded in flight, which would
+cost a write per division on top of the response, its manifest shard and its
+outcome: a division whose invocation died stays pending and is resumed.
+publish_active_divisions also
+records the plan of the run, the divisions it published, so RunLedger can
+tell which divisions are still pending and resume only the unfinished ones.
+
+Callers settling many divisions together, such as probe runs (see
+src/probe_sampler.py), record their states in one batch per write instead of
+one record per division: all in flight at the start, then the outcomes. The
+latest record of a division wins. Batches are read through RunLedger.records,
+not is_done.
+
+Records are stored next to the data:
+    ledger/{election_id}/{date}/{geo_id}.json
+    ledger/{election_id}/{date}/_batch-{timestamp}-{uuid}.json
+    ledger/{election_id}/{date}/_run.json
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+LEDGER_PREFIX = "ledger/"
+RUN_NAME = "_run.json"
+BATCH_PREFIX = "_batch-"
+
+# Division states
+PENDING, IN_FLIGHT, DONE, FAILED = "pending", "in_flight", "done", "failed"
+# In flight records older than this belong to an invocation that died (function timeout 540s)
+STALE_AFTER = 600
+
+# Completed keys seen by this process -> expiry time, shared across warm invocations
+_completed = OrderedDict()
+_completed_lock = threading.Lock()
+MAX_COMPLETED = 50000
+
+
+class CompletionLedger():
+    """
+    Records completed (election_id, geo_id, date) fetches on Google Cloud Storage,
+    with an in-process TTL cache in front of it.
+    Takes:
+        - client: CloudStorageClient
+        - bucket name on Google Cloud Storage
+        - ttl: seconds a completion is remembered in process
+    """
+
+    def __init__(self, client, bucket_name, ttl=24 * 60 * 60):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.ttl = ttl
+
+    @staticmethod
+    def record_name(election_id, geo_id, date):
+        return f"{LEDGER_PREFIX}{election_id}/{date}/{geo_id}.json"
+
+    @staticmethod
+    def batch_name(election_id, date):
+        return f"{LEDGER_PREFIX}{election_id}/{date}/{BATCH_PREFIX}{int(time.time() * 1000)}-{uuid.uuid4().hex}.json"
+
+    def _remember(self, key):
+        with _completed_lock:
+            _completed[key] = time.monotonic() + self.ttl
+            _completed.move_to_end(key)
+            while len(_completed) > MAX_COMPLETED:
+                _completed.popitem(last=False)
+
+    def _recalled(self, key):
+        with _completed_lock:
+            expiry = _completed.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                _completed.pop(key)
+                return False
+            return True
+
+    def is_done(self, election_id, geo_id, date):
+        """
+        Returns: True if a result for the division has already been saved for the date.
+        """
+        key = (str(election_id), str(geo_id), str(date))
+        if self._recalled(key):
+            return True
+        record = self.client.download_json(self.bucket_name, self.record_name(*key))
+        if record and record.get('status') == 'done':
+            self._remember(key)
+            return True
+        return False
+
+    def _write(self, key, status, **fields):
+        record = dict({
+            "election_id": key[0],
+            "geo_id": key[1],
+            "date": key[2],
+            "status": status,
+            "updated": time.time(),
+        }, **fields)
+        if self.client.upload_json(record, self.bucket_name, self.record_name(*key), compress=False):
+            return True
+        logging.error(f"Failed to record {status} state of {key[0]}:{key[1]} for {key[2]}")
+        return False
+
+    def mark_in_flight(self, election_id, geo_id, date):
+        """
+        Records that the fetch of the division has started.
+        """
+        self._write((str(election_id), str(geo_id), str(date)), IN_FLIGHT)
+
+    def mark_failed(self, election_id, geo_id, date, error):
+        """
+        Records that the fetch of the division failed, with the error.
+        """
+        self._write((str(election_id), str(geo_id), str(date)), FAILED, error=str(error), reason=error.__class__.__name__)
+
+    def mark_done(self, election_id, geo_id, date, blob_name=None):
+        """
+        Records that the result for the division has been saved.
+        Takes the name of the blob holding the result.
+        """
+        key = (str(election_id), str(geo_id), str(date))
+        if self._write(key, DONE, blob_name=blob_name):
+            self._remember(key)
+
+    def mark_batch(self, election_id, date, states):
+        """
+        Records the states of many divisions in one write.
+        is_done only reads the records of single divisions: use for divisions
+        that are not also fetched from redelivered division messages.
+        Takes: states as dicts with the geo_id and status of a division and the
+               fields of its record (blob_name, error, reason...)
+        Returns: True if the states were recorded
+        """
+        now = time.time()
+        records = []
+        for state in states:
+            record = dict({"election_id": str(election_id), "date": str(date), "updated": now}, **state)
+            record["geo_id"] = str(record["geo_id"])
+            records.append(record)
+        if not records:
+            return True
+        batch_name = self.batch_name(election_id, date)
+        if not self.client.upload_json({"records": records}, self.bucket_name, batch_name, compress=False):
+            logging.error(f"Failed to record the states of {len(records)} divisions of {election_id} for {date}")
+            return False
+        for record in records:
+            if record["status"] == DONE:
+                self._remember((record["election_id"], record["geo_id"], record["date"]))
+        return True
+
+
+class RunLedger():
+    """
+    Progress of the fan-out of an election on a date, read from the plan of the
+    run and the records of its divisions.
+    Takes:
+        - client: CloudStorageClient
+        - bucket name on Google Cloud Storage
+        - max_workers: concurrent record downloads
+    """
+
+    def __init__(self, client, bucket_name, max_workers=32):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+
+    @staticmethod
+    def run_name(election_id, date):
+        return f"{LEDGER_PREFIX}{election_id}/{date}/{RUN_NAME}"
+
+    def start(self, election_id, date, divisions):
+        """
+        Records the plan of a run: the divisions published for the election.
+        Takes: divisions as (geo_id, address)
+        Returns: True if the plan was stored
+        """
+        plan = {
+            "election_id": str(election_id),
+            "date": str(date),
+            "divisions": {str(geo_id): address for geo_id, address in divisions},
+            "created": time.time(),
+        }
+        if self.client.upload_json(plan, self.bucket_name, self.run_name(election_id, date)):
+            return True
+        logging.error(f"Failed to record the run of election {election_id} for {date}")
+        return False
+
+    def plan(self, election_id, date):
+        """
+        Returns: dict of geo_id -> address of the divisions of the run, or None if no run was recorded
+        """
+        plan = self.client.download_json(self.bucket_name, self.run_name(election_id, date))
+        return plan["divisions"] if plan else None
+
+    def records(self, election_id, date):
+        """
+        Returns: dict of geo_id -> latest record of each division with a record,
+                 whether recorded alone or in a batch
+        """
+        prefix = f"{LEDGER_PREFIX}{election_id}/{date}/"
+        names = [name for name in self.client.list_blob_names(self.bucket_name, prefix=prefix, delimiter="/")
+                 if not name.endswith(RUN_NAME)]
+        records = dict()
+        for result in self.client.download_many(((None, self.bucket_name, name) for name in names), self.max_workers):
+            if not result.ok or not result.data:
+                continue
+            for record in result.data.get("records", [result.data]):
+                current = records.get(record["geo_id"])
+                if current is None or record["updated"] >= current["updated"]:
+                    records[record["geo_id"]] = record
+        return records
+
+    def states(self, election_id, date, stale_after=STALE_AFTER):
+        """
+        Returns: (plan, dict of geo_id -> (state, record)) for every division of the run.
+        Divisions in flight for longer than stale_after are reported failed with the reason "Stalled".
+        """
+        plan = self.plan(election_id, date)
+        if plan is None:
+            raise KeyError(f"No run recorded for election {election_id} on {date}")
+        records = self.records(election_id, date)
+        now = time.time()
+        states = dict()
+        for geo_id in plan:
+            record = records.get(geo_id)
+            if record is None:
+                states[geo_id] = (PENDING, None)
+            elif record["status"] == IN_FLIGHT and now - record["updated"] > stale_after:
+                states[geo_id] = (FAILED, dict(record, reason="Stalled", error=f"In flight for over {stale_after}s"))
+            else:
+                states[geo_id] = (record["status"], record)
+        return plan, states
+
+    def progress(self, election_id, date, stale_after=STALE_AFTER):
+        """
+        Returns: summary dict with the total number of divisions, the number in each
+                 state and the failures counted by reason
+        """
+        plan, states = self.states(election_id, date, stale_after)
+        counts = Counter(state for state, record in states.values())
+        failures = Counter(record.get("reason", "unknown") for state, record in states.values() if state == FAILED)
+        summary = {"election_id": str(election_id), "date": str(date), "total": len(plan)}
+        summary.update({state: counts.get(state, 0) for state in (PENDING, IN_FLIGHT, DONE, FAILED)})
+        summary["failures"] = dict(failures.most_common())
+        return summary
+
+    def unfinished(self, election_id, date, stale_after=STALE_AFTER, include_in_flight=False):
+        """
+        Returns: (geo_id, address) of the divisions pending or failed, and stalled in flight,
+                 plus those still in flight if include_in_flight
+        """
+        plan, states = self.states(election_id, date, stale_after)
+        wanted = {PENDING, FAILED} | ({IN_FLIGHT} if include_in_flight else set())
+        return [(geo_id, plan[geo_id]) for geo_id, (state, record) in states.items() if state in wanted]
+# End
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Process-level cache for reference data stored on Google Cloud Storage.
+Module level state survives across warm Cloud Function invocations, so a
+parsed object is only downloaded again when its generation changes.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+
+class ReferenceCache():
+    """
+    Least recently used cache of parsed Cloud Storage objects keyed by (bucket, blob).
+    Each lookup revalidates with a metadata request and reloads the object
+    only if its generation or etag has changed.
+    Bounded by number of entries and by the total stored size of the objects.
+    Cached values are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_entries=8, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, client, bucket_name, blob_name, loader):
+        """
+        Returns the parsed object, loading it on a miss.
+        Takes:
+            - client: CloudStorageClient
+            - bucket name and blob name of the object
+            - loader: function taking the generation to download and returning the parsed object
+        """
+        key = (bucket_name, blob_name)
+        metadata = client.get_metadata(bucket_name, blob_name)
+        if metadata is None:
+            # Unable to revalidate, load without caching
+            return loader(None)
+        version = (metadata.generation, metadata.etag)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                logging.debug(f"Reference cache hit for gs://{bucket_name}/{blob_name}")
+                return entry[1]
+
+        value = loader(metadata.generation)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (version, value, metadata.size or 0)
+            self._entries.move_to_end(key)
+            self._evict()
+        logging.debug(f"Reference cache loaded gs://{bucket_name}/{blob_name} generation {metadata.generation}")
+        return value
+
+    def _evict(self):
+        total = sum(size for version, value, size in self._entries.values())
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            key, (version, value, size) = self._entries.popitem(last=False)
+            total -= size
+            logging.debug(f"Reference cache evicted gs://{key[0]}/{key[1]}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all loaders in the process
+reference_cache = ReferenceCache()
+# End
@@ -6,10 +6,100 @@ import sys
 import os
 import logging
 import json
+import gzip
+import inspect
+import threading
 import datetime as dt
+from collections import namedtuple
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+from google.api_core import exceptions
 from google.cloud import storage
 
+from src.utils_metrics import metrics
+
+# Outcome of one object of upload_many / download_many
+TransferResult = namedtuple("TransferResult", ["bucket_name", "blob_name", "filepath", "ok", "error", "data"])
+TransferResult.__doc__ = """
+Outcome of a transfer.
+    - bucket_name, blob_name: the object transferred
+    - filepath: the local file, None for json downloaded into memory
+    - ok: True if the transfer succeeded
+    - error: the exception raised otherwise
+    - data: the parsed json of an in-memory download
+"""
+
+
+def bounded_map(function, items, max_workers=16, max_pending=64):
+    """
+    Maps a function over items on a thread pool, yielding (item, result, error)
+    as calls complete. At most max_pending calls are queued or running, so
+    results are consumed as fast as they are produced.
+    """
+    items = iter(items)
+    exhausted = object()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = dict()
+        for item in items:
+            pending[executor.submit(function, item)] = item
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    yield item, future.result(), None
+                except Exception as error:
+                    yield item, None, error
+                next_item = next(items, exhausted)
+                if next_item is not exhausted:
+                    pending[executor.submit(function, next_item)] = next_item
+
+
+@lru_cache(maxsize=None)
+def takes_preconditions(blob_type):
+    """
+    True if the blob class accepts generation preconditions on uploads. 
+    They arrived in google-cloud-storage 1.29, the pinned 1.26 does not take them.
+    """
+    return "if_generation_match" in inspect.signature(blob_type.upload_from_string).parameters
+
+
+def upload_blob(blob, upload, data, only_if_new=False):
+    """
+    Uploads data with upload, blob.upload_from_string or blob.upload_from_file. 
+    With only_if_new, raises PreconditionFailed if the blob exists: atomically where 
+    the client takes generation preconditions, with an existence check first otherwise. 
+    The check is not atomic, a concurrent write of the same name may be overwritten, 
+    which only_if_new callers tolerate: their blobs are content addressed or uniquely named.
+    """
+    if only_if_new and takes_preconditions(type(blob)): 
+        return upload(data, content_type='application/json', if_generation_match=0)
+    if only_if_new and blob.exists(): 
+        raise exceptions.PreconditionFailed(f"gs://{blob.bucket.name}/{blob.name} already exists")
+    return upload(data, content_type='application/json')
+
+
+# Google Cloud Storage client, shared across CloudStorageClients and warm invocations
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_storage_client():
+    """
+    Returns the process-wide Google Cloud Storage client, creating it on first use. 
+    Creating a client resolves credentials, which is slow on a cold start.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = storage.Client()
+    return _client
+
+
 class CloudStorageClient():
     """
     Stores files on Google Cloud Storage
@@ -19,8 +109,9 @@ class CloudStorageClient():
         Opens Google Cloud Storage connection. 
         Creates root /tmp/ directory.
         """
+        self._buckets = dict()
         try: 
-            self.client = storage.Client()
+            self.client = get_storage_client()
             logging.debug("Connected to Google Cloud Storage.")
         except Exception as error: 
             logging.error("Error connecting to Google Cloud Storage:")
@@ -34,6 +125,39 @@ class CloudStorageClient():
             logging.error(f"Failed to create dir {self.path}")
             logging.error(error)
             
+    def get_bucket(self, bucket_name):
+        """
+        Returns a cached handle to a bucket. 
+        Creating the handle does not make a request to Google Cloud Storage.
+        """
+        bucket = self._buckets.get(bucket_name)
+        if bucket is None: 
+            bucket = self.client.bucket(bucket_name)
+            self._buckets[bucket_name] = bucket
+        return bucket
+            
+    def _upload_file(self, filepath, bucket_name, blob_name):
+        blob = self.get_bucket(bucket_name).blob(blob_name)
+        with metrics.timer("upload", bucket=bucket_name), open(filepath, 'rb') as file:
+            blob.upload_from_file(file)
+        metrics.observe("bytes_uploaded", os.path.getsize(filepath), bucket=bucket_name)
+        logging.debug(f"Successfully loaded file from {filepath} to {blob_name}")
+
+    def _download_file(self, filepath, bucket_name, blob_name, generation=None):
+        blob = self.get_bucket(bucket_name).blob(blob_name, generation=generation)
+        with metrics.timer("download", expected=exceptions.NotFound, bucket=bucket_name), open(filepath, 'wb') as file:
+            blob.download_to_file(file)
+        metrics.observe("bytes_downloaded", os.path.getsize(filepath), bucket=bucket_name)
+        logging.debug(f"Downloaded file from gs://{bucket_name}/{blob_name} to {filepath}")
+
+    def _download_json(self, bucket_name, blob_name):
+        blob = self.get_bucket(bucket_name).blob(blob_name)
+        with metrics.timer("download", expected=exceptions.NotFound, bucket=bucket_name): 
+            payload = blob.download_as_string()
+        metrics.observe("bytes_downloaded", len(payload), bucket=bucket_name)
+        with metrics.timer("parse", bucket=bucket_name): 
+            return json.loads(payload)
+            
     def upload_file(self, filepath, bucket_name, blob_name):
         """
         Uploads a files from a local directory to Google Cloud Storage. 
@@ -41,18 +165,17 @@ class CloudStorageClient():
         - filepath to the file stored locally 
         - bucket name on Google Cloud Storage 
         - blob_name on Google Cloud Storage
+        Returns: True if the upload succeeded
         """
         try: 
-            bucket = self.client.get_bucket(bucket_name)
-            blob = bucket.blob(blob_name)
-            with open(filepath, 'rb') as file:
-                blob.upload_from_file(file)
-            logging.debug(f"Successfully loaded file from {filepath} to {blob_name}")
+            self._upload_file(filepath, bucket_name, blob_name)
+            return True
         except Exception as error: 
-            logging.error("Error storing the file to Google Cloud Storage:")
+            logging.error(f"Error storing {filepath} to gs://{bucket_name}/{blob_name}:")
             logging.error(error)
+            return False
     
-    def download_file(self, filepath, bucket_name, blob_name):
+    def download_file(self, filepath, bucket_name, blob_name, generation=None):
         """
         Downloads a files from Google Cloud Storage to a local directory. 
         
@@ -60,16 +183,184 @@ class CloudStorageClient():
         - filepath where the file should be stored locally 
         - bucket name on Google Cloud Storage 
         - blob_name on Google Cloud Storage
+        - generation of the blob to download (optional, defaults to latest)
+        Returns: True if the download succeeded
+        """
+        try: 
+            self._download_file(filepath, bucket_name, blob_name, generation=generation)
+            return True
+        except Exception as error: 
+            logging.error(f"Error retreiving gs://{bucket_name}/{blob_name} from Google Cloud Storage.")
+            logging.error(error)
+            return False
+        
+    def upload_many(self, transfers, max_workers=16):
+        """
+        Uploads local files to Google Cloud Storage concurrently over this client. 
+        Takes: 
+        - transfers: iterable of (filepath, bucket name, blob_name), consumed as uploads complete
+        - max_workers: concurrent uploads
+        Returns: generator of TransferResult, in order of completion
+        """
+        def upload(transfer): 
+            filepath, bucket_name, blob_name = transfer
+            self._upload_file(filepath, bucket_name, blob_name)
+            
+        for (filepath, bucket_name, blob_name), _, error in bounded_map(upload, transfers, max_workers, max_workers * 4): 
+            if error is not None: 
+                logging.error(f"Error storing {filepath} to gs://{bucket_name}/{blob_name}:")
+                logging.error(error)
+            yield TransferResult(bucket_name, blob_name, filepath, error is None, error, None)
+        
+    def download_many(self, transfers, max_workers=16):
+        """
+        Downloads objects from Google Cloud Storage concurrently over this client. 
+        Takes: 
+        - transfers: iterable of (filepath, bucket name, blob_name), consumed as downloads complete. 
+          A filepath of None downloads and parses a json blob into memory. 
+        - max_workers: concurrent downloads
+        Returns: generator of TransferResult, in order of completion. 
+        Missing blobs are not ok and carry a NotFound error.
+        """
+        def download(transfer): 
+            filepath, bucket_name, blob_name = transfer
+            if filepath is None: 
+                return self._download_json(bucket_name, blob_name)
+            self._download_file(filepath, bucket_name, blob_name)
+            
+        for (filepath, bucket_name, blob_name), data, error in bounded_map(download, transfers, max_workers, max_workers * 4): 
+            if isinstance(error, exceptions.NotFound): 
+                logging.debug(f"Blob gs://{bucket_name}/{blob_name} not found.")
+            elif error is not None: 
+                logging.error(f"Error retreiving gs://{bucket_name}/{blob_name} from Google Cloud Storage.")
+                logging.error(error)
+            yield TransferResult(bucket_name, blob_name, filepath, error is None, error, data)
+        
+    def upload_json(self, data, bucket_name, blob_name, compress=True, only_if_new=False):
+        """
+        Serialises json compactly in memory and uploads it to Google Cloud Storage. 
+        Takes: 
+        - data to serialise, or json already serialised to bytes
+        - bucket name on Google Cloud Storage 
+        - blob_name on Google Cloud Storage
+        - compress: gzip the content and set its content encoding
+        - only_if_new: do not overwrite an existing blob (counts as success)
+        Returns: True if the upload succeeded
+        """
+        try: 
+            with metrics.timer("serialise", bucket=bucket_name): 
+                if isinstance(data, bytes): 
+                    payload = data
+                else: 
+                    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                if compress: 
+                    payload = gzip.compress(payload)
+            blob = self.get_bucket(bucket_name).blob(blob_name)
+            if compress: 
+                blob.content_encoding = 'gzip'
+            with metrics.timer("upload", expected=exceptions.PreconditionFailed, bucket=bucket_name): 
+                upload_blob(blob, blob.upload_from_string, payload, only_if_new)
+            metrics.observe("bytes_uploaded", len(payload), bucket=bucket_name)
+            logging.debug(f"Successfully uploaded {len(payload)} bytes to gs://{bucket_name}/{blob_name}")
+            return True
+        except exceptions.PreconditionFailed: 
+            logging.debug(f"Blob gs://{bucket_name}/{blob_name} already exists.")
+            return True
+        except Exception as error: 
+            logging.error(f"Error storing json to gs://{bucket_name}/{blob_name}:")
+            logging.error(error)
+            return False
+    
+    def upload_compressed_json(self, file, bucket_name, blob_name, only_if_new=False):
+        """
+        Uploads gzipped json from a file object without reading it into memory, 
+        such as the output of src.utils_json_stream.CanonicalJsonSink. 
+        Takes: 
+        - file positioned at the start of the gzipped json
+        - bucket name on Google Cloud Storage 
+        - blob_name on Google Cloud Storage
+        - only_if_new: do not overwrite an existing blob (counts as success)
+        Returns: True if the upload succeeded
+        """
+        try: 
+            blob = self.get_bucket(bucket_name).blob(blob_name)
+            blob.content_encoding = 'gzip'
+            start = file.tell()
+            with metrics.timer("upload", expected=exceptions.PreconditionFailed, bucket=bucket_name): 
+                upload_blob(blob, blob.upload_from_file, file, only_if_new)
+            metrics.observe("bytes_uploaded", file.tell() - start, bucket=bucket_name)
+            logging.debug(f"Successfully uploaded {file.tell() - start} bytes to gs://{bucket_name}/{blob_name}")
+            return True
+        except exceptions.PreconditionFailed: 
+            logging.debug(f"Blob gs://{bucket_name}/{blob_name} already exists.")
+            return True
+        except Exception as error: 
+            logging.error(f"Error storing json to gs://{bucket_name}/{blob_name}:")
+            logging.error(error)
+            return False
+    
+    def download_json(self, bucket_name, blob_name): 
+        """
+        Downloads a json blob from Google Cloud Storage into memory. 
+        Takes: 
+        - bucket name on Google Cloud Storage 
+        - blob_name on Google Cloud Storage
+        Returns: the parsed json, or None if not found or on error.
+        """
+        try: 
+            return self._download_json(bucket_name, blob_name)
+        except exceptions.NotFound: 
+            logging.debug(f"Blob gs://{bucket_name}/{blob_name} not found.")
+        except Exception as error: 
+            logging.error(f"Error retreiving json from gs://{bucket_name}/{blob_name}.")
+            logging.error(error)
+        
+    def get_metadata(self, bucket_name, blob_name):
+        """
+        Fetches the metadata (generation, etag, size) of a blob without downloading it.
+        
+        Takes: 
+        - bucket name on Google Cloud Storage 
+        - blob_name on Google Cloud Storage
+        Returns: the blob with its metadata loaded, or None if not found or on error.
+        """
+        try: 
+            return self.get_bucket(bucket_name).get_blob(blob_name)
+        except Exception as error: 
+            logging.error(f"Error retreiving metadata for gs://{bucket_name}/{blob_name}.")
+            logging.error(error)
+        
+    def delete_blob(self, bucket_name, blob_name):
+        """
+        Deletes a blob from Google Cloud Storage. 
+        Returns: True if the blob was deleted or did not exist
+        """
+        try: 
+            self.get_bucket(bucket_name).blob(blob_name).delete()
+            return True
+        except exceptions.NotFound: 
+            return True
+        except Exception as error: 
+            logging.error(f"Error deleting gs://{bucket_name}/{blob_name}.")
+            logging.error(error)
+            return False
+        
+    def list_blob_names(self, bucket_name, prefix=None, delimiter=None):
+        """
+        Lists the names of the blobs in a bucket. 
+        Takes: 
+        - bucket name on Google Cloud Storage 
+        - prefix the names start with (optional)
+        - delimiter (optional): "/" lists only the blobs directly under the prefix
+        Returns: list of blob names, empty on error.
         """
         try: 
-            bucket = self.client.get_bucket(bucket_name)
-            blob = bucket.blob(blob_name)
-            with open(filepath, 'wb') as file:
-                blob.download_to_file(file)
-            logging.debug(f"Downloaded file from gs://{bucket_name}/{blob_name} to {filepath}")
+            blobs = self.client.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)
+            return [blob.name for blob in blobs]
         except Exception as error: 
-            logging.error("Error retreiving the file from Google Cloud Storage.")
+            logging.error(f"Error listing gs://{bucket_name}/{prefix or ''}.")
             logging.error(error)
+            return []
         
     def save_tmp_json(self, filename, data):
         """
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Shared HTTP transport for the Google API fetchers.
+A single pooled session is kept at module level so keep-alive connections
+survive across warm Cloud Function invocations.
+"""
+import logging
+import random
+import threading
+import time
+import datetime as dt
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.utils_metrics import metrics
+
+# (connect, read) timeouts in seconds by endpoint
+TIMEOUTS = {
+    "elections": (3.05, 15),
+    "voterinfo": (3.05, 30),
+    "geocode": (3.05, 10),
+}
+DEFAULT_TIMEOUT = (3.05, 30)
+
+# Responses worth retrying: rate limited or transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# 403 error reasons that mean too many requests rather than access denied
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# Seconds a request may take, retries included, well inside the 540s Cloud Function timeout
+DEFAULT_DEADLINE = 240
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the shared requests session, creating it on first use.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def backoff_delay(attempt, backoff=0.5, max_backoff=32):
+    """
+    Exponential backoff with full jitter for the given (zero based) attempt.
+    """
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+def retry_after_delay(response):
+    """
+    Parses the Retry-After header (seconds or HTTP date) of a response.
+    Returns: delay in seconds or None if the header is missing or invalid.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limited(response):
+    """
+    True for 429 responses and 403 responses with a rateLimitExceeded reason.
+    """
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        errors = response.json().get("error", {}).get("errors", [])
+    except (ValueError, AttributeError):
+        return False
+    return any(error.get("reason") in RATE_LIMIT_REASONS for error in errors)
+
+
+def get(url, params=None, endpoint=None, max_retries=4, backoff=0.5, max_backoff=32, limiter=None, stream=False,
+        deadline=DEFAULT_DEADLINE):
+    """
+    Makes a GET request on the shared session, retrying rate limited and
+    transient failures with jittered exponential backoff. Honours Retry-After,
+    capped at max_backoff.
+    Takes:
+        - url and query params of the request
+        - endpoint: key into TIMEOUTS
+        - max_retries: retries after the first attempt
+        - backoff, max_backoff: base and cap of the backoff delay in seconds
+        - limiter: optional RateLimiter or AdaptiveRateLimiter acquired before
+          every attempt and told of each rate limited or successful response
+        - stream: leave the body of a successful response unread, for the caller
+          to read with iter_content and close. Its bytes are not counted here.
+        - deadline: seconds the request may take, retries included. No retry
+          waits past it: the last response (or error) is returned (or raised).
+    Returns: the final response. The caller checks its status.
+    Raises: requests.exceptions.RequestException when the last attempt fails to connect.
+    """
+    session = get_session()
+    timeout = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+    tag = endpoint or "other"
+    deadline_at = time.monotonic() + deadline
+
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = session.get(url, params=params, timeout=timeout, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            metrics.observe("stage_seconds", time.perf_counter() - started, stage="api_call", endpoint=tag)
+            metrics.increment("errors", stage="api_call", endpoint=tag, error=error.__class__.__name__)
+            remaining = deadline_at - time.monotonic()
+            if attempt == max_retries or remaining <= 0:
+                raise
+            metrics.increment("retries", endpoint=tag, reason=error.__class__.__name__)
+            delay = min(backoff_delay(attempt, backoff, max_backoff), remaining)
+            logging.warning(f"Request to {endpoint or url} failed ({error.__class__.__name__}), retrying in {delay:.2f}s")
+        else:
+            metrics.observe("stage_seconds", time.perf_counter() - started, stage="api_call", endpoint=tag)
+            if not stream or response.status_code >= 400:
+                metrics.observe("bytes_received", len(response.content), endpoint=tag)
+            if response.status_code >= 400:
+                metrics.increment("errors", stage="api_call", endpoint=tag, error=f"HTTP{response.status_code}")
+            rate_limited = is_rate_limited(response)
+            # Only rate limit responses and successes tell the limiter about the quota
+            if limiter is not None and (rate_limited or response.status_code < 400):
+                limiter.record(rate_limited)
+            retryable = rate_limited or response.status_code in RETRY_STATUSES
+            remaining = deadline_at - time.monotonic()
+            if not retryable or attempt == max_retries or remaining <= 0:
+                return response
+            metrics.increment("retries", endpoint=tag, reason="rate_limited" if rate_limited else f"HTTP{response.status_code}")
+            delay = retry_after_delay(response)
+            if delay is None:
+                delay = backoff_delay(attempt, backoff, max_backoff)
+            # A large Retry-After must not hold the function until it times out
+            delay = min(delay, max_backoff, remaining)
+            logging.warning(f"Request to {endpoint or url} returned {response.status_code}, retrying in {delay:.2f}s")
+        time.sleep(delay)
+# End
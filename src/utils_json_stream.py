@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Incremental parse of large json documents, one top level member at a time.
+
+A voter info response for a large jurisdiction lists thousands of polling
+places and early vote sites. Parsed whole, the document is held in memory
+several times over: the body, the parsed objects and their serialisation.
+stream_document reads the body in chunks and hands each member of the top
+level object to sinks as soon as it is parsed. The elements of the streamed
+sections (arrays such as pollingLocations) are handed over one by one, so
+only one element is held in memory at a time:
+
+    sink.member(key, value)        top level member, parsed whole
+    sink.section_start(key)        streamed section
+    sink.element(key, element)     each element of the section
+    sink.section_end(key)
+    sink.close()                   end of the document
+
+Sinks:
+    CanonicalJsonSink   gzipped canonical serialisation, spooled to disk, to upload
+    DocumentSink        the document without the sections it does not keep
+    CallbackSink        the elements of a section, to extraction
+"""
+import codecs
+import gzip
+import hashlib
+import json
+import tempfile
+
+# Sections of a voter info response streamed element by element
+STREAMED_SECTIONS = ("pollingLocations", "earlyVoteSites", "dropOffLocations", "contests")
+
+# Bytes read per chunk
+CHUNK_SIZE = 64 * 1024
+
+# Bytes of a spooled section held in memory before it moves to disk
+SPOOL_SIZE = 1024 * 1024
+
+WHITESPACE = " \t\n\r"
+# Characters that may follow a complete value
+DELIMITERS = ",]}:" + WHITESPACE
+
+
+class JsonSink():
+    """
+    Receives the members of a streamed document. Subclasses override what they need.
+    """
+
+    def member(self, key, value):
+        pass
+
+    def section_start(self, key):
+        pass
+
+    def element(self, key, element):
+        pass
+
+    def section_end(self, key):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Reader():
+    """
+    Text buffer over an iterable of byte chunks, read on demand.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def read(self):
+        """
+        Appends the next chunk to the buffer, dropping what was consumed.
+        Returns: False at the end of the input
+        """
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.decoder.decode(b"", final=True)
+        else:
+            self.bytes_read += len(chunk)
+            text = self.decoder.decode(chunk)
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return True
+
+    def peek(self):
+        """
+        Returns: the next character that is not whitespace, without consuming it, or "" at the end
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read():
+                return ""
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters!r} at byte {self.bytes_read}, found {character!r}")
+        self.position += 1
+        return character
+
+    def value(self, decoder=json.JSONDecoder()):
+        """
+        Parses the next json value, reading until the buffer holds all of it.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.read():
+                    raise
+                continue
+            # A number cut by the end of the buffer ("-2." of "-2.5") may continue in the next chunk
+            if not self.eof and (end == len(self.buffer) or self.buffer[end] not in DELIMITERS):
+                self.read()
+                continue
+            self.position = end
+            return value
+
+
+def stream_document(chunks, sinks, sections=STREAMED_SECTIONS):
+    """
+    Parses a json object from byte chunks and hands its members to sinks.
+    Takes:
+        - chunks: iterable of bytes, such as response.iter_content()
+        - sinks: list of JsonSink
+        - sections: top level members streamed element by element when they are arrays
+    Returns: the number of bytes read
+    Raises: ValueError if the document is not a json object
+    """
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.position += 1
+    else:
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key in sections and reader.peek() == "[":
+                reader.position += 1
+                for sink in sinks:
+                    sink.section_start(key)
+                if reader.peek() == "]":
+                    reader.position += 1
+                else:
+                    while True:
+                        element = reader.value()
+                        for sink in sinks:
+                            sink.element(key, element)
+                        if reader.expect(",]") == "]":
+                            break
+                for sink in sinks:
+                    sink.section_end(key)
+            else:
+                value = reader.value()
+                for sink in sinks:
+                    sink.member(key, value)
+            if reader.expect(",}") == "}":
+                break
+    # Drain the input so the byte count is complete
+    while reader.read():
+        pass
+    for sink in sinks:
+        sink.close()
+    return reader.bytes_read
+
+
+class CanonicalJsonSink(JsonSink):
+    """
+    Writes the document as src.content_store.canonical_json would, sorted keys
+    and no whitespace, without holding it in memory: streamed sections are
+    spooled element by element and assembled in key order by finish().
+    """
+
+    def __init__(self, spool_size=SPOOL_SIZE):
+        self.spool_size = spool_size
+        self._members = dict()
+        self._sections = dict()
+
+    @staticmethod
+    def serialise(value):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
+    def member(self, key, value):
+        self._members[key] = self.serialise(value)
+
+    def section_start(self, key):
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        spool.write(b"[")
+        self._sections[key] = spool
+
+    def element(self, key, element):
+        spool = self._sections[key]
+        if spool.tell() > 1:
+            spool.write(b",")
+        spool.write(self.serialise(element))
+
+    def section_end(self, key):
+        self._sections[key].write(b"]")
+
+    def finish(self):
+        """
+        Assembles the canonical document, gzipped.
+        Returns: (file positioned at its start, uncompressed size, sha256 of the uncompressed bytes)
+        """
+        output = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        digest = hashlib.sha256()
+        size = 0
+        with gzip.GzipFile(fileobj=output, mode="wb", mtime=0) as compressed:
+
+            def write(data):
+                nonlocal size
+                digest.update(data)
+                compressed.write(data)
+                size += len(data)
+
+            write(b"{")
+            for index, key in enumerate(sorted(set(self._members) | set(self._sections))):
+                write((b"," if index else b"") + self.serialise(key) + b":")
+                spool = self._sections.pop(key, None)
+                if spool is None:
+                    write(self._members.pop(key))
+                    continue
+                spool.seek(0)
+                for block in iter(lambda: spool.read(CHUNK_SIZE), b""):
+                    write(block)
+                spool.close()
+            write(b"}")
+        output.seek(0)
+        return output, size, digest.hexdigest()
+
+
+class DocumentSink(JsonSink):
+    """
+    Materialises the document, leaving out the streamed sections not kept.
+    """
+
+    def __init__(self, keep=()):
+        self.keep = set(keep)
+        self.document = dict()
+        self.counts = dict()
+
+    def member(self, key, value):
+        self.document[key] = value
+
+    def section_start(self, key):
+        self.counts[key] = 0
+        if key in self.keep:
+            self.document[key] = []
+
+    def element(self, key, element):
+        self.counts[key] += 1
+        if key in self.keep:
+            self.document[key].append(element)
+
+
+class CallbackSink(JsonSink):
+    """
+    Calls a function with each element of a streamed section.
+    """
+
+    def __init__(self, section, function):
+        self.section = section
+        self.function = function
+
+    def element(self, key, element):
+        if key == self.section:
+            self.function(element)
+
+# End
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Lightweight instrumentation for the Cloud Functions.
+
+Code records stage durations (download, parse, api_call, serialise, upload,
+publish), bytes moved, retries and errors into the process-wide `metrics`
+registry:
+
+    with metrics.timer("upload", bucket=bucket_name):
+        blob.upload_from_string(payload)
+    metrics.observe("bytes_uploaded", len(payload), bucket=bucket_name)
+
+Entry points wrapped with @instrumented flush the registry to the configured
+exporters when they return, one structured record per metric. Set
+METRICS_EXPORTER=none to disable the log records. Tests and benchmarks use
+MemoryExporter to read the records back.
+"""
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Values kept per histogram to estimate percentiles
+RESERVOIR_SIZE = 1024
+
+
+class Histogram():
+    """
+    Count, sum, min and max of observed values, with a uniform reservoir
+    sample of them for percentiles.
+    """
+
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._sample = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._sample) < self.size:
+            self._sample.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self._sample[index] = value
+
+    def percentile(self, q):
+        if not self._sample:
+            return None
+        values = sorted(self._sample)
+        return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class MetricsRegistry():
+    """
+    Thread-safe counters and histograms keyed by metric name and tags.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        self.exporters = []
+
+    @staticmethod
+    def _key(name, tags):
+        return (name, tuple(sorted((key, str(value)) for key, value in tags.items())))
+
+    def increment(self, name, value=1, **tags):
+        """
+        Adds to a counter, e.g. retries or errors.
+        """
+        key = self._key(name, tags)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **tags):
+        """
+        Adds a value to a histogram, e.g. a duration or a size in bytes.
+        """
+        key = self._key(name, tags)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.add(value)
+
+    @contextmanager
+    def timer(self, stage, expected=(), **tags):
+        """
+        Times the block as `stage_seconds` tagged with the stage.
+        An exception leaving the block is counted under `errors` with its class name,
+        unless it is one of the `expected` exception classes (such as NotFound on a lookup).
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except expected:
+            raise
+        except Exception as error:
+            self.increment("errors", stage=stage, error=error.__class__.__name__, **tags)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage, **tags)
+
+    def snapshot(self):
+        """
+        Returns: list of metric records as dicts
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, histogram.summary()) for key, histogram in self._histograms.items()]
+        records = [
+            {"metric": name, "type": "counter", "tags": dict(tags), "value": value}
+            for (name, tags), value in counters
+        ]
+        records.extend(
+            dict({"metric": name, "type": "histogram", "tags": dict(tags)}, **summary)
+            for (name, tags), summary in histograms
+        )
+        return records
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def flush(self, **context):
+        """
+        Sends a snapshot to every exporter and resets the registry.
+        Takes keyword context added to every record, such as the entry point.
+        Returns: the exported records
+        """
+        records = self.snapshot()
+        self.reset()
+        for record in records:
+            record.update(context)
+        for exporter in self.exporters:
+            try:
+                exporter.export(records)
+            except Exception as error:
+                logging.error(f"Failed to export metrics with {exporter.__class__.__name__}")
+                logging.error(error)
+        return records
+
+
+class LogExporter():
+    """
+    Writes each record as a single json log line, which Cloud Logging
+    indexes as a structured payload.
+    """
+
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def export(self, records):
+        for record in records:
+            logging.log(self.level, json.dumps(dict(record, message="metric"), default=str))
+
+
+class MemoryExporter():
+    """
+    Keeps exported records in memory for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def export(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def find(self, metric, **tags):
+        """
+        Returns: the records of a metric whose tags include the given tags
+        """
+        tags = {key: str(value) for key, value in tags.items()}
+        return [
+            record for record in self.records
+            if record["metric"] == metric and tags.items() <= record["tags"].items()
+        ]
+
+    def clear(self):
+        with self._lock:
+            self.records = []
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
+if os.environ.get("METRICS_EXPORTER", "log") == "log":
+    metrics.exporters.append(LogExporter())
+
+
+def instrumented(function):
+    """
+    Decorator for Cloud Function entry points taking (event, context).
+    Times the invocation and flushes the metrics recorded during it, tagged
+    with the entry point and the triggering event id.
+    """
+    @functools.wraps(function)
+    def wrapper(event, context):
+        try:
+            with metrics.timer("invocation", entry_point=function.__name__):
+                return function(event, context)
+        finally:
+            metrics.flush(entry_point=function.__name__, event_id=getattr(context, "event_id", None))
+
+    return wrapper
+# End
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Publishes messages to Pub/Sub topics and waits for them to complete.
+"""
+import logging
+import threading
+import time
+
+from src.utils_metrics import metrics
+
+PROJECT_ID = "election-tracker-268319"
+
+# Publisher clients by batch settings, reused across warm invocations
+_publishers = dict()
+
+
+def get_publisher(max_messages=100, max_bytes=1024 * 1024, max_latency=0.05):
+    """
+    Returns a publisher client with the given batch settings, creating it on first use.
+    The Pub/Sub library is imported here so entry points that never publish do not load it.
+    """
+    from google.cloud import pubsub_v1
+
+    key = (max_messages, max_bytes, max_latency)
+    if key not in _publishers:
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=max_messages,
+            max_bytes=max_bytes,
+            max_latency=max_latency,
+        )
+        _publishers[key] = pubsub_v1.PublisherClient(batch_settings)
+    return _publishers[key]
+
+
+class PublishSummary():
+    """
+    Outcome of a publish job.
+        - succeeded: message key -> message id
+        - failed: message key -> (error, message) where message is (key, data, attributes)
+    Failed messages can be passed back to publish_messages to retry them.
+    """
+
+    def __init__(self):
+        self.succeeded = dict()
+        self.failed = dict()
+
+    def failed_messages(self):
+        return [message for error, message in self.failed.values()]
+
+    def __repr__(self):
+        return f"PublishSummary(succeeded={len(self.succeeded)}, failed={len(self.failed)})"
+
+
+class _Pending():
+    """
+    Counts outstanding publish futures and wakes the waiter when all have resolved.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def add(self):
+        with self.condition:
+            self.count += 1
+
+    def done(self):
+        with self.condition:
+            self.count -= 1
+            if self.count == 0:
+                self.condition.notify_all()
+
+    def wait(self, deadline):
+        with self.condition:
+            while self.count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+def publish_messages(topic_name, messages, project_id=PROJECT_ID, publisher=None, timeout=120, retries=1):
+    """
+    Publishes messages to a topic and blocks until every publish has resolved
+    or the deadline has passed.
+    Takes:
+        - topic_name: name of the Pub/Sub topic
+        - messages: iterable of (key, data, attributes) with data as bytes
+        - project_id: Google Cloud project of the topic
+        - publisher: optional publisher client, defaults to get_publisher()
+        - timeout: overall deadline in seconds, retries included
+        - retries: number of times failed messages are republished
+    Returns: PublishSummary
+    """
+    publisher = publisher or get_publisher()
+    topic_path = publisher.topic_path(project_id, topic_name)
+    started = time.monotonic()
+    deadline = started + timeout
+    summary = PublishSummary()
+    published_bytes = 0
+    lock = threading.Lock()
+
+    def get_callback(message, pending, outstanding):
+        def callback(future):
+            key = message[0]
+            try:
+                message_id = future.result()
+                with lock:
+                    summary.succeeded[key] = message_id
+                    summary.failed.pop(key, None)
+            except Exception as error:  # noqa
+                with lock:
+                    summary.failed[key] = (error, message)
+            finally:
+                with lock:
+                    outstanding.pop(key, None)
+                pending.done()
+
+        return callback
+
+    for attempt in range(retries + 1):
+        pending = _Pending()
+        outstanding = dict()
+        logging.info(f"Publishing messages to {topic_path}")
+        for message in messages:
+            key, data, attributes = message
+            published_bytes += len(data)
+            pending.add()
+            try:
+                future = publisher.publish(topic_path, data=data, **attributes)
+            except Exception as error:  # noqa
+                with lock:
+                    summary.failed[key] = (error, message)
+                pending.done()
+                continue
+            with lock:
+                outstanding[key] = message
+            future.add_done_callback(get_callback(message, pending, outstanding))
+
+        if not pending.wait(deadline):
+            # Messages still outstanding at the deadline are reported as failed
+            logging.error(f"Publish to {topic_path} did not complete before the deadline.")
+            with lock:
+                for key, message in outstanding.items():
+                    summary.failed[key] = (TimeoutError("Publish deadline exceeded"), message)
+            break
+        if not summary.failed or time.monotonic() >= deadline:
+            break
+        messages = summary.failed_messages()
+        metrics.increment("retries", len(messages), topic=topic_name, reason="publish")
+        logging.info(f"Retrying {len(messages)} failed messages to {topic_path}")
+
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="publish", topic=topic_name)
+    metrics.observe("bytes_published", published_bytes, topic=topic_name)
+    metrics.increment("messages_published", len(summary.succeeded), topic=topic_name)
+    for key, (error, message) in summary.failed.items():
+        metrics.increment("errors", stage="publish", topic=topic_name, error=error.__class__.__name__)
+        logging.error(f"Failed to publish {key} to {topic_path}: {error}")
+    logging.info(f"Published {len(summary.succeeded)} messages to {topic_path}, {len(summary.failed)} failed.")
+    return summary
+# End
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Client-side rate limiting for Google API calls.
+
+RateLimiter spaces the calls of one process. AdaptiveRateLimiter enforces a
+request budget shared by every worker through a token bucket kept in a shared
+store, and adapts the budget to the quota: the rate grows additively while
+calls succeed and is cut multiplicatively when the API answers
+429 / 403 rateLimitExceeded.
+"""
+import logging
+import os
+import threading
+import time
+
+
+class RateLimiter():
+    """
+    Thread-safe limiter that spaces calls evenly to at most `requests_per_second`.
+    Shared by the worker threads of a batch so the whole batch, not each thread,
+    stays within the budget. A rate of 0 or None disables limiting.
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.requests_per_second = requests_per_second
+        self._interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        """
+        Blocks until the caller may make its next request.
+        """
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        wait = slot - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, rate_limited):
+        """
+        Fixed rate: responses do not change the budget.
+        """
+        pass
+
+
+class LocalTokenStore():
+    """
+    In-process token bucket store. Stand-in for the shared store when workers
+    run in a single process (local runs, tests, benchmarks).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = dict()
+        self._rates = dict()
+
+    def take(self, key, rate, capacity):
+        """
+        Takes one token from the bucket refilled at `rate` tokens per second.
+        Returns: 0 if a token was taken, otherwise seconds to wait before trying again
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def get_rate(self, key, default):
+        with self._lock:
+            return self._rates.get(key, (default, 0.0))[0]
+
+    def increase_rate(self, key, default, step, maximum):
+        with self._lock:
+            rate, decreased = self._rates.get(key, (default, 0.0))
+            self._rates[key] = (min(maximum, rate + step / rate), decreased)
+
+    def decrease_rate(self, key, default, factor, minimum, cooldown):
+        """
+        Cuts the rate at most once per cooldown so one burst of errors counts once.
+        Returns: the new rate
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate, decreased = self._rates.get(key, (default, 0.0))
+            if decreased and now - decreased < cooldown:
+                return rate
+            rate = max(minimum, rate * factor)
+            self._rates[key] = (rate, now)
+            return rate
+
+
+# Lua scripts run atomically in Redis. Time is taken from the Redis server so
+# workers with drifting clocks share one bucket.
+_TAKE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+_INCREASE_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[1])
+rate = math.min(tonumber(ARGV[3]), rate + tonumber(ARGV[2]) / rate)
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 86400)
+return tostring(rate)
+"""
+
+_DECREASE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'rate', 'decreased')
+local rate = tonumber(state[1]) or tonumber(ARGV[1])
+local decreased = tonumber(state[2]) or 0
+if decreased > 0 and now - decreased < tonumber(ARGV[4]) then
+    return tostring(rate)
+end
+rate = math.max(tonumber(ARGV[3]), rate * tonumber(ARGV[2]))
+redis.call('HSET', KEYS[1], 'rate', rate, 'decreased', now)
+redis.call('EXPIRE', KEYS[1], 86400)
+return tostring(rate)
+"""
+
+
+class RedisTokenStore():
+    """
+    Token bucket store shared by all workers through Redis (e.g. Memorystore).
+    Requires the redis package.
+    While Redis cannot be reached, calls go to an in-process store for
+    retry_after seconds rather than failing the API calls they pace.
+    """
+
+    def __init__(self, host, port=6379, retry_after=30):
+        import redis
+        self.host = host
+        self.retry_after = retry_after
+        self._redis = redis.Redis(host=host, port=port, socket_timeout=2)
+        self._take = self._redis.register_script(_TAKE_SCRIPT)
+        self._increase = self._redis.register_script(_INCREASE_SCRIPT)
+        self._decrease = self._redis.register_script(_DECREASE_SCRIPT)
+        self._errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+        self._local = LocalTokenStore()
+        self._unavailable_until = 0.0
+
+    def _call(self, shared, local):
+        """
+        Returns: the result of shared(), or of local() while Redis is unavailable
+        """
+        if time.monotonic() < self._unavailable_until:
+            return local()
+        try:
+            return shared()
+        except self._errors as error:
+            self._unavailable_until = time.monotonic() + self.retry_after
+            logging.warning(
+                f"Redis at {self.host} unavailable, rate limiting per instance for {self.retry_after}s: {error}"
+            )
+            return local()
+
+    def take(self, key, rate, capacity):
+        return self._call(
+            lambda: float(self._take(keys=[f"{key}:bucket"], args=[rate, capacity])),
+            lambda: self._local.take(key, rate, capacity),
+        )
+
+    def get_rate(self, key, default):
+        def shared():
+            rate = self._redis.hget(f"{key}:rate", "rate")
+            return float(rate) if rate is not None else default
+        return self._call(shared, lambda: self._local.get_rate(key, default))
+
+    def increase_rate(self, key, default, step, maximum):
+        self._call(
+            lambda: self._increase(keys=[f"{key}:rate"], args=[default, step, maximum]),
+            lambda: self._local.increase_rate(key, default, step, maximum),
+        )
+
+    def decrease_rate(self, key, default, factor, minimum, cooldown):
+        return self._call(
+            lambda: float(self._decrease(keys=[f"{key}:rate"], args=[default, factor, minimum, cooldown])),
+            lambda: self._local.decrease_rate(key, default, factor, minimum, cooldown),
+        )
+
+
+class AdaptiveRateLimiter():
+    """
+    Quota-aware scheduler: a token bucket in a shared store whose rate adapts
+    to rate limit responses (additive increase, multiplicative decrease).
+    Takes:
+        - store: LocalTokenStore or RedisTokenStore
+        - key: name of the budget in the store, one per API
+        - initial_rate, min_rate, max_rate: requests per second
+        - increase: rate added per second of successful calls
+        - decrease: factor applied to the rate on a rate limit response
+        - cooldown: seconds during which further rate limit responses do not cut again
+        - burst: bucket capacity in seconds of the current rate
+    """
+
+    def __init__(self, store, key, initial_rate=5, min_rate=0.5, max_rate=50,
+                 increase=0.5, decrease=0.5, cooldown=2.0, burst=1.0):
+        self.store = store
+        self.key = key
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.burst = burst
+
+    @property
+    def rate(self):
+        return self.store.get_rate(self.key, self.initial_rate)
+
+    def acquire(self):
+        """
+        Blocks until the shared budget grants a request.
+        """
+        while True:
+            rate = self.rate
+            wait = self.store.take(self.key, rate, max(1.0, rate * self.burst))
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def record(self, rate_limited):
+        """
+        Adapts the rate to the outcome of a call: True for a rate limit response,
+        False for a successful one. Other errors say nothing about the quota and
+        are not recorded (see src/utils_http.py).
+        """
+        if rate_limited:
+            rate = self.store.decrease_rate(self.key, self.initial_rate, self.decrease, self.min_rate, self.cooldown)
+            logging.warning(f"Rate limited by {self.key}: rate now {rate:.2f} requests per second")
+        else:
+            self.store.increase_rate(self.key, self.initial_rate, self.increase, self.max_rate)
+
+
+# Schedulers by API, shared by all callers in the process
+_schedulers = dict()
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(key):
+    """
+    Returns the process-wide AdaptiveRateLimiter for an API, creating it on first use.
+    Uses Redis at RATE_LIMIT_REDIS_HOST to share the budget across workers when set
+    (Memorystore reached through a VPC connector, see bin/create_rate_limit_store.sh).
+    Otherwise, or if the redis package is missing, falls back to an in-process store:
+    each instance then has a budget of its own and the global budget is not enforced.
+    Budget settings are read from {KEY}_INITIAL_RATE, {KEY}_MIN_RATE and {KEY}_MAX_RATE.
+    """
+    with _schedulers_lock:
+        if key not in _schedulers:
+            host = os.environ.get("RATE_LIMIT_REDIS_HOST")
+            store = None
+            if host:
+                try:
+                    store = RedisTokenStore(host, int(os.environ.get("RATE_LIMIT_REDIS_PORT", 6379)))
+                except ImportError as error:
+                    logging.error(f"RATE_LIMIT_REDIS_HOST is set but the redis package is missing: {error}")
+            if store is None:
+                logging.warning(
+                    f"No shared store for the {key} budget: rate limiting per instance, "
+                    f"the global budget is not enforced. Set RATE_LIMIT_REDIS_HOST to share it."
+                )
+                store = LocalTokenStore()
+            prefix = key.upper()
+            _schedulers[key] = AdaptiveRateLimiter(
+                store,
+                key,
+                initial_rate=float(os.environ.get(f"{prefix}_INITIAL_RATE", 5)),
+                min_rate=float(os.environ.get(f"{prefix}_MIN_RATE", 0.5)),
+                max_rate=float(os.environ.get(f"{prefix}_MAX_RATE", 50)),
+            )
+        return _schedulers[key]
+# End
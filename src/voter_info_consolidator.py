@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Consolidates the per-division voter info responses of a day into long-tidy
+tables (contests, candidates, polling_locations, officials). By default one
+gzipped json lines file per election holds the rows of every table, each row
+tagged with its table:
+
+    consolidated/{election_id}/{date}.jsonl.gz
+    {"table": "candidates", "election_id": ..., "date": ..., "geoid": ..., "name": ...}
+
+or, with output_format="csv", one gzipped csv per table per election:
+
+    consolidated/{election_id}/{date}/contests.csv.gz
+    consolidated/{election_id}/{date}/candidates.csv.gz
+    consolidated/{election_id}/{date}/polling_locations.csv.gz
+    consolidated/{election_id}/{date}/officials.csv.gz
+
+Responses are downloaded in parallel and streamed through the flattening
+stage, so only the downloads in flight are held in memory.
+
+Divisions inheriting the response of a fetched division (src/probe_sampler.py)
+get the rows of that response under their own geoid, with inherited_from set
+to the fetched division. The shared response is downloaded once.
+"""
+import csv
+import gzip
+import json
+import logging
+import os
+import shutil
+
+from src.candidate_extractor import social_channels
+from src.content_store import ContentStore, MANIFEST_PREFIX
+from src.voter_info_manifest import ManifestIndex
+from src.voter_info_diff import SnapshotStore, DELTA_PREFIX
+from src.utils_cloud_storage import bounded_map
+
+CONSOLIDATED_PREFIX = "consolidated/"
+OUTPUT_FORMATS = ("ndjson", "csv")
+
+# Columns of each table. Every row starts with the election, date and division it came from,
+# and the division whose response it inherits, if any.
+KEY_FIELDS = ("election_id", "date", "geoid", "inherited_from")
+TABLES = {
+    "contests": KEY_FIELDS + (
+        "contest_index", "type", "office", "level", "roles", "district_name", "district_scope",
+        "district_id", "number_elected", "number_voting_for", "ballot_placement",
+        "referendum_title", "referendum_subtitle",
+    ),
+    "candidates": KEY_FIELDS + (
+        "contest_index", "office", "district_id", "name", "party", "candidate_url",
+        "phone", "email", "twitter_id", "facebook_id", "order_on_ballot",
+    ),
+    "polling_locations": KEY_FIELDS + (
+        "location_type", "location_name", "line1", "city", "state", "zip",
+        "latitude", "longitude", "polling_hours", "start_date", "end_date",
+    ),
+    "officials": KEY_FIELDS + (
+        "jurisdiction", "jurisdiction_name", "body_name", "election_info_url",
+        "official_name", "title", "phone", "email",
+    ),
+}
+
+# Response sections flattened into polling_locations, by location type
+LOCATION_SECTIONS = {
+    "pollingLocations": "polling",
+    "earlyVoteSites": "early_vote",
+    "dropOffLocations": "drop_off",
+}
+
+
+def flatten_contests(response, keys):
+    """
+    Yields (table, row) for the contests of a response and their candidates.
+    """
+    for index, contest in enumerate(response.get("contests") or []):
+        district = contest.get("district") or {}
+        yield "contests", dict(
+            keys,
+            contest_index=index,
+            type=contest.get("type", ""),
+            office=contest.get("office", ""),
+            level="|".join(contest.get("level") or []),
+            roles="|".join(contest.get("roles") or []),
+            district_name=district.get("name", ""),
+            district_scope=district.get("scope", ""),
+            district_id=district.get("id", ""),
+            number_elected=contest.get("numberElected", ""),
+            number_voting_for=contest.get("numberVotingFor", ""),
+            ballot_placement=contest.get("ballotPlacement", ""),
+            referendum_title=contest.get("referendumTitle", ""),
+            referendum_subtitle=contest.get("referendumSubtitle", ""),
+        )
+        for candidate in contest.get("candidates") or []:
+            twitter_id, fb_id = social_channels(candidate.get("channels"))
+            yield "candidates", dict(
+                keys,
+                contest_index=index,
+                office=contest.get("office", ""),
+                district_id=district.get("id", ""),
+                name=candidate.get("name", ""),
+                party=candidate.get("party", ""),
+                candidate_url=candidate.get("candidateUrl", ""),
+                phone=candidate.get("phone", ""),
+                email=candidate.get("email", ""),
+                twitter_id=twitter_id,
+                facebook_id=fb_id,
+                order_on_ballot=candidate.get("orderOnBallot", ""),
+            )
+
+
+def flatten_locations(response, keys):
+    """
+    Yields (table, row) for the polling places, early vote sites and drop off locations of a response.
+    """
+    for section, location_type in LOCATION_SECTIONS.items():
+        for location in response.get(section) or []:
+            address = location.get("address") or {}
+            yield "polling_locations", dict(
+                keys,
+                location_type=location_type,
+                location_name=address.get("locationName", location.get("name", "")),
+                line1=address.get("line1", ""),
+                city=address.get("city", ""),
+                state=address.get("state", ""),
+                zip=address.get("zip", ""),
+                latitude=location.get("latitude", ""),
+                longitude=location.get("longitude", ""),
+                polling_hours=location.get("pollingHours", ""),
+                start_date=location.get("startDate", ""),
+                end_date=location.get("endDate", ""),
+            )
+
+
+def flatten_officials(response, keys):
+    """
+    Yields (table, row) for the election administration bodies of a response and their officials.
+    Bodies without listed officials get a single row.
+    """
+    for state in response.get("state") or []:
+        jurisdictions = [("state", state)]
+        if state.get("local_jurisdiction"):
+            jurisdictions.append(("local", state["local_jurisdiction"]))
+        for jurisdiction, administration in jurisdictions:
+            body = administration.get("electionAdministrationBody") or {}
+            row = dict(
+                keys,
+                jurisdiction=jurisdiction,
+                jurisdiction_name=administration.get("name", ""),
+                body_name=body.get("name", ""),
+                election_info_url=body.get("electionInfoUrl", ""),
+            )
+            officials = body.get("electionOfficials") or [{}]
+            for official in officials:
+                yield "officials", dict(
+                    row,
+                    official_name=official.get("name", ""),
+                    title=official.get("title", ""),
+                    phone=official.get("officePhoneNumber", ""),
+                    email=official.get("emailAddress", ""),
+                )
+
+
+def flatten_response(response, geoid, date, inherited_from=None):
+    """
+    Flattens one voter info response into rows of the consolidated tables.
+    Takes:
+        - response as returned by the Civic Information API
+        - geoid of the division the response is for
+        - date of the snapshot
+        - inherited_from: geoid of the fetched division, when the division inherits its response
+    Returns: election id, generator of (table, row)
+    """
+    election_id = str((response.get("election") or {}).get("id", "unknown"))
+    keys = {"election_id": election_id, "date": str(date), "geoid": geoid, "inherited_from": inherited_from or ""}
+
+    def rows():
+        yield from flatten_contests(response, keys)
+        yield from flatten_locations(response, keys)
+        yield from flatten_officials(response, keys)
+
+    return election_id, rows()
+
+
+class TableWriter():
+    """
+    Writes the rows of every table of every election under a local directory,
+    opening each file on its first row: one gzipped json lines file per election
+    ("ndjson") or one gzipped csv per table per election ("csv").
+    """
+
+    def __init__(self, directory, date, output_format="ndjson"):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}")
+        self.directory = directory
+        self.date = date
+        self.output_format = output_format
+        self.counts = dict()
+        self._files = dict()
+        self._writers = dict()
+
+    def filepath(self, election_id, table):
+        if self.output_format == "ndjson":
+            return os.path.join(self.directory, election_id, f"{self.date}.jsonl.gz")
+        return os.path.join(self.directory, election_id, str(self.date), f"{table}.csv.gz")
+
+    def blob_names(self):
+        """
+        Returns: dict of local filepath -> blob name under consolidated/ of the files written
+        """
+        filepaths = {self.filepath(election_id, table) for election_id, table in self.counts}
+        return {
+            filepath: CONSOLIDATED_PREFIX + os.path.relpath(filepath, self.directory).replace(os.sep, "/")
+            for filepath in sorted(filepaths)
+        }
+
+    def _open(self, filepath, table):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        file = gzip.open(filepath, "wt", encoding="utf-8", newline="")
+        self._files[filepath] = file
+        if self.output_format == "csv":
+            writer = csv.DictWriter(file, fieldnames=TABLES[table])
+            writer.writeheader()
+            return writer.writerow
+
+        def write_line(row):
+            file.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + "\n")
+        return write_line
+
+    def write(self, election_id, table, row):
+        filepath = self.filepath(election_id, table)
+        write_row = self._writers.get(filepath)
+        if write_row is None:
+            write_row = self._writers[filepath] = self._open(filepath, table)
+        key = (election_id, table)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self.output_format == "ndjson":
+            row = dict(row, table=table)
+        write_row(row)
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+        self._writers.clear()
+
+
+class VoterInfoConsolidator():
+    """
+    Builds the consolidated tables of a day from the responses saved by run_voter_info.
+    Takes:
+        - client: CloudStorageClient
+        - bucket name of the saved responses
+        - storage_mode: "full" (one json per division), "dedup" (ContentStore manifests)
+          or "delta" (deltas and checkpoints, see src/voter_info_diff.py)
+        - max_workers: concurrent downloads
+        - output_format: "ndjson" (one file per election) or "csv" (one file per table per election)
+    """
+
+    def __init__(self, client, bucket_name, storage_mode="full", max_workers=16, output_format="ndjson"):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.storage_mode = storage_mode
+        self.max_workers = max_workers
+        self.output_format = output_format
+
+    def list_divisions(self, date, election_id=None):
+        """
+        Returns: dict of geoid -> geoid of the response saved for the division on the date,
+                 its own or, for a division inheriting another's response, the fetched division's.
+        For an election, read from the voter info manifest instead of listing the bucket,
+        which only holds the responses of fetched divisions.
+        """
+        if election_id is not None:
+            entries = ManifestIndex(self.client, self.bucket_name).entries(election_id, date)
+            if entries:
+                return {entry["geo_id"]: entry.get("inherited_from") or entry["geo_id"] for entry in entries}
+            logging.warning(f"No manifest entries for election {election_id} on {date}, listing the bucket.")
+        suffix = f"_{date}.json"
+        prefixes = {"dedup": [MANIFEST_PREFIX], "delta": [None, DELTA_PREFIX]}.get(self.storage_mode, [None])
+        geoids = set()
+        for prefix in prefixes:
+            names = self.client.list_blob_names(self.bucket_name, prefix=prefix, delimiter="/")
+            geoids.update(name[len(prefix or ""):-len(suffix)] for name in names if name.endswith(suffix))
+        return {geoid: geoid for geoid in geoids}
+
+    def list_geoids(self, date, election_id=None):
+        """
+        Returns: the sorted geoids of the responses saved for the date, one per response
+        """
+        return sorted(set(self.list_divisions(date, election_id).values()))
+
+    def load(self, geoid, date):
+        if self.storage_mode == "dedup":
+            return ContentStore(self.client, self.bucket_name).load_voter_info(geoid, date)
+        if self.storage_mode == "delta":
+            store = SnapshotStore(self.client, self.bucket_name)
+            try:
+                return store.load(store.delta_name(geoid, date))
+            except KeyError:
+                return store.load(store.checkpoint_name(geoid, date))
+        response = self.client.download_json(self.bucket_name, f"{geoid}_{date}.json")
+        if response is None:
+            raise KeyError(f"No voter info saved for {geoid} on {date}")
+        return response
+
+    def responses(self, geoids, date):
+        """
+        Downloads the responses of the divisions concurrently.
+        Returns: generator of (geoid, response, error) in order of completion
+        """
+        if self.storage_mode in ("dedup", "delta"):
+            yield from bounded_map(lambda geoid: self.load(geoid, date), geoids, self.max_workers)
+            return
+        transfers = ((None, self.bucket_name, f"{geoid}_{date}.json") for geoid in geoids)
+        for result in self.client.download_many(transfers, self.max_workers):
+            geoid = result.blob_name[:-len(f"_{date}.json")]
+            yield geoid, result.data, result.error
+
+    def division_responses(self, divisions, date):
+        """
+        Downloads the responses of the divisions concurrently, each shared response once.
+        Takes: dict of geoid -> geoid of its response, as returned by list_divisions
+        Returns: generator of (geoid, inherited_from, response, error) in order of completion,
+                 inherited_from None for the divisions whose own response it is
+        """
+        sharing = dict()
+        for geoid, source in sorted(divisions.items()):
+            sharing.setdefault(source, []).append(geoid)
+        for source, response, error in self.responses(sorted(sharing), date):
+            for geoid in sharing[source]:
+                yield geoid, (source if geoid != source else None), response, error
+
+    def consolidate(self, date, election_id=None, directory="/tmp/consolidated", upload=True):
+        """
+        Downloads and flattens every response saved for the date.
+        Takes:
+            - date of the snapshot
+            - election_id: only the responses recorded for this election in the manifest
+            - directory: local directory of the consolidated files, cleared first
+            - upload: store the files in the bucket under consolidated/
+        Returns: dict of (election_id, table) -> number of rows
+        """
+        divisions = self.list_divisions(date, election_id)
+        logging.info(
+            f"Consolidating the voter info of {len(divisions)} divisions for {date} from gs://{self.bucket_name}, "
+            f"{len(set(divisions.values()))} responses"
+        )
+        shutil.rmtree(directory, ignore_errors=True)
+        writer = TableWriter(directory, date, self.output_format)
+        failed = 0
+        try:
+            for geoid, inherited_from, response, error in self.division_responses(divisions, date):
+                if error is not None:
+                    failed += 1
+                    logging.error(f"Failed to load voter info for {geoid} on {date} from {inherited_from or geoid}")
+                    logging.error(error)
+                    continue
+                election_id, rows = flatten_response(response, geoid, date, inherited_from)
+                for table, row in rows:
+                    writer.write(election_id, table, row)
+        finally:
+            writer.close()
+
+        if upload:
+            transfers = [(filepath, self.bucket_name, blob_name) for filepath, blob_name in writer.blob_names().items()]
+            uploaded = sum(result.ok for result in self.client.upload_many(transfers, self.max_workers))
+            if uploaded < len(transfers):
+                logging.error(f"Failed to upload {len(transfers) - uploaded} of {len(transfers)} consolidated files.")
+        logging.info(f"Consolidated {len(divisions) - failed} divisions into {len(writer.counts)} tables, {failed} failed.")
+        return dict(writer.counts)
+# End
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Day over day changes of the voter info response of a division.
+
+diff_documents compares a response with the previous snapshot of the same
+election and division and returns compact change records, one per added,
+removed or modified element:
+
+    {"entity": "contest", "section": "contests", "change": "added", "key": "...", "value": {...}}
+    {"entity": "candidate", "section": "contests", "parent": "<contest key>", "change": "removed", "key": "..."}
+    {"entity": "polling_location", "section": "pollingLocations", "change": "modified", "key": "...",
+     "changed": {"pollingHours": "7am-8pm"}, "previous": {"pollingHours": "7am-7pm"}, "dropped": []}
+    {"entity": "member", "change": "modified", "key": "state", "value": [...]}
+    {"entity": "order", "section": "pollingLocations", "parent": null, "keys": [...]}
+
+Elements are matched by key rather than position: contests by district and
+office (or referendum title), candidates by normalised name within their
+contest, locations by normalised name (or address), so a moved polling place
+is a modified address. Other top level members ("state", "election"...) are
+compared whole. Order records are only emitted when the order changed beyond
+the removals and additions; consumers of the changes may ignore them.
+
+The records are lossless: apply_changes(previous, diff_documents(previous, current))
+rebuilds current. SnapshotStore uses that for the "delta" storage mode of
+VoterInfo.save_voter_info, which stores the changes since the previous day
+and a full checkpoint every few days:
+
+    {geoid}_{date}.json          checkpoint, the full response as in "full" storage mode
+    deltas/{geoid}_{date}.json   {"base_date", "base_blob", "changes"} since the previous snapshot
+    heads/{election_id}/{geoid}.json   latest snapshot of the division and its distance to a checkpoint
+
+SnapshotStore.election_changes is the diff stage of a day: the changes of
+every division of an election since its previous snapshot in the manifest,
+read from the stored deltas when there are some and diffed otherwise.
+"""
+import copy
+import logging
+from collections import Counter, OrderedDict
+
+from src.candidate_extractor import normalise
+from src.content_store import ContentStore, MANIFEST_PREFIX as CONTENT_MANIFEST_PREFIX
+from src.voter_info_manifest import ManifestIndex
+from src.utils_cloud_storage import bounded_map
+
+DELTA_PREFIX = "deltas/"
+HEAD_PREFIX = "heads/"
+
+# Days of deltas stored between two checkpoints
+CHECKPOINT_EVERY = 7
+
+CONTESTS = "contests"
+CANDIDATES = "candidates"
+# Sections diffed element by element -> entity of their elements
+SECTION_ENTITIES = OrderedDict([
+    (CONTESTS, "contest"),
+    ("pollingLocations", "polling_location"),
+    ("earlyVoteSites", "early_vote_site"),
+    ("dropOffLocations", "drop_off_location"),
+])
+ADDRESS_FIELDS = ("line1", "line2", "city", "state", "zip")
+
+
+def contest_key(contest):
+    district = contest.get("district") or {}
+    title = contest.get("office") or contest.get("referendumTitle") or contest.get("type") or ""
+    return f"{district.get('id', '')}|{normalise(title)}"
+
+
+def candidate_key(candidate):
+    return normalise(candidate.get("name"))
+
+
+def location_key(location):
+    address = location.get("address") or {}
+    name = address.get("locationName") or location.get("name")
+    if name:
+        return normalise(name)
+    return normalise(" ".join(str(address.get(field) or "") for field in ADDRESS_FIELDS))
+
+
+def section_key(section):
+    return contest_key if section == CONTESTS else location_key
+
+
+def keyed(elements, key):
+    """
+    Indexes a list by element key. Repeated keys get an occurrence suffix: "name", "name#1"...
+    Returns: OrderedDict of key -> element, in list order
+    """
+    index, seen = OrderedDict(), Counter()
+    for element in elements:
+        base = key(element) if isinstance(element, dict) else normalise(str(element))
+        index[f"{base}#{seen[base]}" if seen[base] else base] = element
+        seen[base] += 1
+    return index
+
+
+def diff_fields(previous, current, skip=()):
+    """
+    Returns: (changed fields -> current value, their previous values, dropped fields)
+    """
+    changed = {field: value for field, value in current.items()
+               if field not in skip and (field not in previous or previous[field] != value)}
+    before = {field: previous[field] for field in changed if field in previous}
+    dropped = [field for field in previous if field not in current and field not in skip]
+    return changed, before, dropped
+
+
+def diff_elements(entity, section, previous, current, key, parent=None):
+    """
+    Diffs two lists of elements matched by key.
+    Returns: (change records, list of (key, previous, current) of the elements in both)
+    """
+    before, after = keyed(previous, key), keyed(current, key)
+    common = dict(parent=parent) if parent is not None else dict()
+    records, matched = [], []
+    for element_key in before:
+        if element_key not in after:
+            records.append(dict(entity=entity, section=section, change="removed", key=element_key, **common))
+    for element_key, element in after.items():
+        if element_key not in before:
+            records.append(dict(entity=entity, section=section, change="added", key=element_key, value=element, **common))
+            continue
+        matched.append((element_key, before[element_key], element))
+        if not isinstance(element, dict) or not isinstance(before[element_key], dict):
+            if element != before[element_key]:
+                records.append(dict(entity=entity, section=section, change="modified", key=element_key, value=element, **common))
+            continue
+        skip = (CANDIDATES,) if entity == "contest" and nested_candidates(before[element_key], element) else ()
+        changed, previous_values, dropped = diff_fields(before[element_key], element, skip)
+        if changed or dropped:
+            records.append(dict(entity=entity, section=section, change="modified", key=element_key,
+                                changed=changed, previous=previous_values, dropped=dropped, **common))
+
+    # Order left by applying the changes: kept elements in previous order, then the added ones
+    applied = [element_key for element_key in before if element_key in after]
+    applied += [element_key for element_key in after if element_key not in before]
+    if applied != list(after):
+        records.append(dict(entity="order", section=section, parent=parent, keys=list(after)))
+    return records, matched
+
+
+def nested_candidates(previous, current):
+    """
+    Returns: True if both versions of a contest list candidates, diffed one by one
+    """
+    return isinstance(previous.get(CANDIDATES), list) and isinstance(current.get(CANDIDATES), list)
+
+
+def diffed_sections(previous, current):
+    return [section for section in SECTION_ENTITIES
+            if isinstance(previous.get(section), list) and isinstance(current.get(section), list)]
+
+
+def diff_documents(previous, current):
+    """
+    Compares a voter info response with the previous snapshot of the division.
+    Takes:
+        - previous: the previous response
+        - current: the new response
+    Returns: list of change records, empty if nothing changed
+    """
+    sections = diffed_sections(previous, current)
+    records = []
+    for member in previous:
+        if member not in current and member not in sections:
+            records.append({"entity": "member", "change": "removed", "key": member})
+    for member, value in current.items():
+        if member in sections:
+            continue
+        if member not in previous:
+            records.append({"entity": "member", "change": "added", "key": member, "value": value})
+        elif previous[member] != value:
+            records.append({"entity": "member", "change": "modified", "key": member, "value": value})
+
+    for section in sections:
+        section_records, matched = diff_elements(
+            SECTION_ENTITIES[section], section, previous[section], current[section], section_key(section))
+        records.extend(section_records)
+        if section != CONTESTS:
+            continue
+        for key, before, after in matched:
+            if isinstance(before, dict) and isinstance(after, dict) and nested_candidates(before, after):
+                candidate_records, _ = diff_elements(
+                    "candidate", CONTESTS, before[CANDIDATES], after[CANDIDATES], candidate_key, parent=key)
+                records.extend(candidate_records)
+    return records
+
+
+def _apply_elements(elements, records, key):
+    """
+    Applies the element records of one list, copying the elements it changes.
+    Returns: the new list
+    """
+    index = keyed(elements, key)
+    for record in records:
+        change = record.get("change")
+        if change == "removed":
+            index.pop(record["key"], None)
+        elif change == "added":
+            index[record["key"]] = copy.deepcopy(record["value"])
+        elif change == "modified":
+            if "value" in record:
+                index[record["key"]] = copy.deepcopy(record["value"])
+                continue
+            element = index[record["key"]] = copy.deepcopy(index[record["key"]])
+            element.update(copy.deepcopy(record["changed"]))
+            for field in record["dropped"]:
+                element.pop(field, None)
+        elif record["entity"] == "order":
+            index = OrderedDict((element_key, index[element_key]) for element_key in record["keys"])
+    return list(index.values())
+
+
+def apply_changes(previous, records):
+    """
+    Rebuilds a response from the previous snapshot and the changes since.
+    Takes:
+        - previous: the previous response, left unchanged
+        - records: change records returned by diff_documents
+    Returns: the new response
+    Raises: KeyError if the records do not apply to the previous snapshot
+    """
+    # Members are replaced whole and changed elements copied, so previous is never modified
+    document = dict(previous)
+    sections, candidates = OrderedDict(), OrderedDict()
+    for record in records:
+        if record["entity"] == "member":
+            if record["change"] == "removed":
+                document.pop(record["key"], None)
+            else:
+                document[record["key"]] = copy.deepcopy(record["value"])
+        elif record["entity"] == "candidate" or (record["entity"] == "order" and record.get("parent") is not None):
+            candidates.setdefault(record["parent"], []).append(record)
+        else:
+            sections.setdefault(record["section"], []).append(record)
+
+    for section, section_records in sections.items():
+        document[section] = _apply_elements(document[section], section_records, section_key(section))
+    if candidates:
+        contests = keyed(document[CONTESTS], contest_key)
+        for parent, candidate_records in candidates.items():
+            contest = contests[parent]
+            contests[parent] = dict(contest, **{CANDIDATES: _apply_elements(contest[CANDIDATES], candidate_records, candidate_key)})
+        document[CONTESTS] = list(contests.values())
+    return document
+
+
+def summarise(records):
+    """
+    Returns: dict of "entity:change" -> number of records, leaving out order records
+    """
+    return dict(Counter(f"{record['entity']}:{record['change']}" for record in records if record["entity"] != "order"))
+
+
+class SnapshotStore():
+    """
+    Loads voter info snapshots in every storage mode, and stores them as deltas
+    plus periodic checkpoints in "delta" storage mode.
+    Takes:
+        - client: CloudStorageClient
+        - bucket name on Google Cloud Storage
+        - checkpoint_every: snapshots from one checkpoint to the next
+    """
+
+    def __init__(self, client, bucket_name, checkpoint_every=CHECKPOINT_EVERY):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.checkpoint_every = checkpoint_every
+
+    @staticmethod
+    def checkpoint_name(geoid, date):
+        return f"{geoid}_{date}.json"
+
+    @staticmethod
+    def delta_name(geoid, date):
+        return f"{DELTA_PREFIX}{geoid}_{date}.json"
+
+    @staticmethod
+    def head_name(election_id, geoid):
+        return f"{HEAD_PREFIX}{election_id}/{geoid}.json"
+
+    def _download(self, blob_name):
+        doc = self.client.download_json(self.bucket_name, blob_name)
+        if doc is None:
+            raise KeyError(f"Snapshot gs://{self.bucket_name}/{blob_name} not found")
+        return doc
+
+    def load(self, blob_name):
+        """
+        Loads the response saved under a blob in any storage mode: a full json,
+        a ContentStore manifest, or a delta applied to the snapshots it builds on.
+        """
+        if blob_name.startswith(DELTA_PREFIX):
+            delta = self._download(blob_name)
+            return apply_changes(self.load(delta["base_blob"]), delta["changes"])
+        if blob_name.startswith(CONTENT_MANIFEST_PREFIX):
+            return ContentStore(self.client, self.bucket_name).assemble(self._download(blob_name))
+        return self._download(blob_name)
+
+    def load_delta(self, blob_name):
+        """
+        Returns: the stored delta {"base_date", "base_blob", "changes"}, or None if the blob is not a delta
+        """
+        if not blob_name.startswith(DELTA_PREFIX):
+            return None
+        return self._download(blob_name)
+
+    def head(self, election_id, geoid):
+        """
+        Returns: the latest snapshot of the division {"date", "blob_name", "chain"}, or None
+        """
+        return self.client.download_json(self.bucket_name, self.head_name(election_id, geoid))
+
+    def save(self, election_id, geoid, date, result, payload):
+        """
+        Saves a response as the changes since the division's previous snapshot,
+        or in full when there is none or the last checkpoint is checkpoint_every snapshots old.
+        Takes:
+            - election_id of the request, None saves a checkpoint outside any chain
+            - a geoid such as a county fips code
+            - date of the snapshot
+            - the data returned for the geoid
+            - payload: the canonical json of the data, as bytes
+        Returns: (name of the saved blob, base_date or None for a checkpoint)
+        Raises: IOError if the upload failed
+        """
+        head = self.head(election_id, geoid) if election_id is not None else None
+        base = None
+        # A snapshot saved again the same day is a checkpoint: its head may already be today's delta
+        if head is not None and head["date"] != str(date) and head["chain"] + 1 < self.checkpoint_every:
+            try:
+                base = self.load(head["blob_name"])
+            except Exception as error:
+                logging.error(f"Failed to load the previous snapshot of {geoid}, saving a checkpoint.")
+                logging.error(error)
+
+        if base is None:
+            blob_name, data, chain, base_date = self.checkpoint_name(geoid, date), payload, 0, None
+        else:
+            blob_name, chain, base_date = self.delta_name(geoid, date), head["chain"] + 1, head["date"]
+            data = {"base_date": base_date, "base_blob": head["blob_name"], "changes": diff_documents(base, result)}
+        if not self.client.upload_json(data, self.bucket_name, blob_name):
+            raise IOError(f"Failed to store snapshot gs://{self.bucket_name}/{blob_name}")
+
+        if election_id is not None:
+            head = {"date": str(date), "blob_name": blob_name, "chain": chain}
+            if not self.client.upload_json(head, self.bucket_name, self.head_name(election_id, geoid)):
+                logging.error(f"Failed to update the head of {election_id}:{geoid}, the next snapshot builds on an older one.")
+        logging.debug(f"Stored {'checkpoint' if base is None else 'delta'} gs://{self.bucket_name}/{blob_name}")
+        return blob_name, base_date
+
+    def changes(self, entry, previous):
+        """
+        Takes:
+            - entry: manifest entry of the snapshot
+            - previous: manifest entry of the previous snapshot of the division
+        Returns: the change records between the two, read from the delta when the snapshot is one
+        """
+        if entry.get("base_date") == previous["date"]:
+            return self.load_delta(entry["blob_name"])["changes"]
+        if entry.get("content_hash") and entry.get("content_hash") == previous.get("content_hash"):
+            return []
+        return diff_documents(self.load(previous["blob_name"]), self.load(entry["blob_name"]))
+
+    def election_changes(self, election_id, date, max_workers=16):
+        """
+        Diffs the snapshots of an election's divisions on a date with their previous snapshot.
+        Divisions inheriting another division's response are left out.
+        Takes:
+            - election_id as returned by Civic Information API
+            - date of the snapshots
+            - max_workers: divisions loaded concurrently
+        Returns: generator of (geo_id, previous date or None for a new division, records, error)
+        """
+        latest = dict()
+        for entry in ManifestIndex(self.client, self.bucket_name).entries(election_id):
+            if entry.get("inherited_from"):
+                continue
+            if entry["date"] == str(date):
+                latest.setdefault(entry["geo_id"], [None, None])[1] = entry
+            elif entry["date"] < str(date):
+                current = latest.setdefault(entry["geo_id"], [None, None])[0]
+                if current is None or entry["date"] > current["date"]:
+                    latest[entry["geo_id"]][0] = entry
+        pairs = [(previous, entry) for previous, entry in latest.values() if entry is not None]
+
+        def diff(pair):
+            previous, entry = pair
+            return None if previous is None else self.changes(entry, previous)
+
+        for (previous, entry), records, error in bounded_map(diff, pairs, max_workers):
+            yield entry["geo_id"], previous and previous["date"], records, error
+# End
@@ -9,11 +9,19 @@ import sys
 import os
 import logging
 import json
+import hashlib
 import datetime as dt
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from google.cloud import storage
+from src import utils_http
 from src.utils_cloud_storage import CloudStorageClient
+from src.content_store import ContentStore, canonical_json
+from src.voter_info_manifest import ManifestWriter
+from src.run_ledger import CompletionLedger
+from src.utils_cache import reference_cache
+from src.utils_rate_limit import RateLimiter, get_scheduler
+from src.utils_metrics import metrics
+from src.utils_json_stream import CanonicalJsonSink, DocumentSink, stream_document, CHUNK_SIZE
 
 
 class ReverseGeocode(): 
@@ -30,15 +38,16 @@ class ReverseGeocode():
         self._url = "https://maps.googleapis.com/maps/api/geocode/json?"
         self._api_key = os.environ['GOOGLE_GEOCODING_API_KEY']
     
-    def reverse_geocode(self, lat, long):
+    def reverse_geocode(self, lat, long, limiter=None):
         """
         Make a call to the api to return election info
+        Takes an optional RateLimiter acquired before each attempt.
         """
         payload = {
             "latlng": f"{lat},{long}",
             "key": self._api_key
         } 
-        response = requests.get(self._url, params=payload)
+        response = utils_http.get(self._url, params=payload, endpoint="geocode", limiter=limiter)
         try: 
             response.raise_for_status() 
             return response.json()
@@ -51,6 +60,12 @@ class ReverseGeocode():
             logging.error(error)
             raise
 
+def civic_scheduler(): 
+    """
+    Scheduler sharing the Civic Information API quota between all workers.
+    """
+    return get_scheduler("civicinfo")
+
 class VoterInfo():
     """
     Fetchs voter information from Google Civic Information API.
@@ -67,17 +82,28 @@ class VoterInfo():
     """
     
     def __init__(self):
-        self._url = "https://www.googleapis.com/civicinfo/v2/voterinfo"
+        # Base url can be pointed at a local stand-in for benchmarks
+        self._url = os.environ.get("GOOGLE_CIVIC_API_URL", "https://www.googleapis.com/civicinfo/v2") + "/voterinfo"
         self._api_key = os.environ['GOOGLE_CIVIC_API_KEY']
         self.date = dt.datetime.now().date()
         self.client = CloudStorageClient()
+        # "full" stores one json per division, "dedup" stores shared blobs and a manifest per division, 
+        # "delta" stores the changes since the previous day and a full checkpoint every few days
+        self.storage_mode = os.environ.get('VOTER_INFO_STORAGE_MODE', 'full')
+        # "json" parses responses whole, "stream" parses them section by section (see src/utils_json_stream.py)
+        self.parse_mode = os.environ.get('VOTER_INFO_PARSE_MODE', 'json')
+        # Saved responses are recorded in the manifest, written in batches by flush_manifest
+        self.manifest = ManifestWriter(self.client)
+        # geoid -> name of the blob saved today, which in "delta" storage mode is a delta or a checkpoint
+        self.saved = dict()
         self.path = "/tmp/"
         if not os.path.exists(self.path):
             os.mkdir(self.path)
     
-    def fetch_voter_info(self, address, election_id=None):
+    def fetch_voter_info(self, address, election_id=None, limiter=None):
         """
         Make a call to the api to return election info
+        Takes an optional RateLimiter acquired before each attempt.
         """
         payload = {
             "address": address, 
@@ -85,10 +111,45 @@ class VoterInfo():
             "returnAllAvailableData": True,
             "key": self._api_key
         } 
-        response = requests.get(self._url, params=payload)
+        response = utils_http.get(self._url, params=payload, endpoint="voterinfo", limiter=limiter)
         try: 
             response.raise_for_status() 
-            return response.json()
+            with metrics.timer("parse", endpoint="voterinfo"): 
+                return response.json()
+        except requests.exceptions.HTTPError as error:
+            # Error in request 
+            logging.error(f"Error: CivicInfo Api error for {address}")
+            logging.error(error)
+            raise
+        except requests.exceptions.RequestException as error:
+            # Catastrophic error 
+            logging.error(f"Fail: CivicInfo Api failed for {address}")
+            logging.error(error)
+            raise
+            
+    def fetch_voter_info_stream(self, address, election_id, sinks, limiter=None):
+        """
+        Make a call to the api and hand the response to sinks as it is parsed, 
+        without holding the whole response in memory. 
+        Takes: 
+            - address and election_id of the request
+            - sinks: list of src.utils_json_stream.JsonSink
+            - optional RateLimiter acquired before each attempt
+        Returns: the number of bytes read
+        """
+        payload = {
+            "address": address, 
+            "electionId": election_id,
+            "returnAllAvailableData": True,
+            "key": self._api_key
+        } 
+        response = utils_http.get(self._url, params=payload, endpoint="voterinfo", limiter=limiter, stream=True)
+        try: 
+            response.raise_for_status() 
+            with metrics.timer("parse", endpoint="voterinfo"): 
+                size = stream_document(response.iter_content(CHUNK_SIZE), sinks)
+            metrics.observe("bytes_received", size, endpoint="voterinfo")
+            return size
         except requests.exceptions.HTTPError as error:
             # Error in request 
             logging.error(f"Error: CivicInfo Api error for {address}")
@@ -99,79 +160,359 @@ class VoterInfo():
             logging.error(f"Fail: CivicInfo Api failed for {address}")
             logging.error(error)
             raise
+        finally: 
+            response.close()
             
-    def save_voter_info(self, geoid, result, bucket_name):
+    def fetch_division(self, address, election_id, geo_id, bucket_name, limiter=None, skip_completed=True, record_state=True):
+        """
+        Fetches voter information for a single division and saves it to storage.
+        Idempotent: divisions already saved today for the election are skipped.
+        Takes: 
+            - address of the geo division
+            - election_id as returned by Civic Information API
+            - geo_id such as a county fips code
+            - bucket name on Google Cloud Storage
+            - optional RateLimiter shared with other calls
+            - skip_completed: check the completion ledger before calling the API
+            - record_state: record the done or failed outcome of the division in the completion
+              ledger, False for callers recording the states of many divisions at once
+        Returns: the response, or None if the division was already completed. 
+        In "stream" parse mode, the response leaves out the location sections, 
+        which go straight to storage.
+        """
+        ledger = CompletionLedger(self.client, bucket_name)
+        if skip_completed and ledger.is_done(election_id, geo_id, self.date): 
+            logging.info(f"Skipping VoterInfo call: {election_id}:{geo_id} already completed for {self.date}")
+            metrics.increment("divisions", status="skipped")
+            return None
+        
+        try: 
+            response, blob_name = self._fetch_and_save(address, election_id, geo_id, bucket_name, limiter)
+        except Exception as error: 
+            if record_state: 
+                ledger.mark_failed(election_id, geo_id, self.date, error)
+            metrics.increment("divisions", status="failed")
+            raise
+        if record_state: 
+            ledger.mark_done(election_id, geo_id, self.date, blob_name)
+        metrics.increment("divisions", status="fetched")
+        return response
+
+    def _fetch_and_save(self, address, election_id, geo_id, bucket_name, limiter):
+        """
+        Returns: (response, name of the saved blob)
+        """
+        if self.parse_mode == 'stream' and self.storage_mode == 'full': 
+            # Contests are kept for the callers comparing them (see src/probe_sampler.py)
+            document, canonical = DocumentSink(keep=("contests",)), CanonicalJsonSink()
+            self.fetch_voter_info_stream(address, election_id, [document, canonical], limiter=limiter)
+            response = document.document
+            for sink in (document, canonical): 
+                sink.member('geoid', {"fips": geo_id})
+            blob_name = self.save_voter_info_stream(geo_id, canonical, bucket_name=bucket_name, election_id=election_id)
+        else: 
+            response = self.fetch_voter_info(address, election_id, limiter=limiter)
+            response['geoid'] = {"fips": geo_id}
+            blob_name = self.save_voter_info(geo_id, response, bucket_name=bucket_name, election_id=election_id)
+        if blob_name is None: 
+            raise IOError(f"Failed to save voter info for {election_id}:{geo_id}")
+        return response, blob_name
+
+    def fetch_voter_info_batch(self, divisions, bucket_name, max_workers=8, requests_per_second=5, limiter=None):
+        """
+        Fetches voter information for many divisions concurrently. 
+        Each result is saved to storage as soon as its call completes.
+        Takes: 
+            - divisions: iterable of dicts with 'address', 'election_id' and 'geo_id'
+            - bucket name on Google Cloud Storage
+            - max_workers: maximum number of calls in flight
+            - requests_per_second: request budget shared by all workers
+            - limiter: optional shared limiter used instead of a fixed requests_per_second, 
+              such as the Civic API scheduler
+        Returns: summary dict with the 'succeeded' and 'skipped' (already completed) geo_ids, 
+                 and 'failed' geo_ids mapped to the error
+        """
+        limiter = limiter or RateLimiter(requests_per_second)
+        summary = {"succeeded": [], "skipped": [], "failed": {}}
+
+        def run(division):
+            return self.fetch_division(
+                division['address'], 
+                division['election_id'], 
+                division['geo_id'], 
+                bucket_name,
+                limiter=limiter
+            )
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run, division): division for division in divisions}
+            for future in as_completed(futures):
+                division = futures[future]
+                key = f"{division['election_id']}:{division['geo_id']}"
+                try: 
+                    if future.result() is None: 
+                        summary["skipped"].append(division['geo_id'])
+                        continue
+                    summary["succeeded"].append(division['geo_id'])
+                    logging.debug(f"Completed VoterInfo call: {key}")
+                except Exception as error: 
+                    summary["failed"][division['geo_id']] = str(error)
+                    logging.error(f"Failed to retrieve data for {key}")
+                    logging.error(error)
+
+        self.flush_manifest()
+        logging.info(f"VoterInfo batch complete: {len(summary['succeeded'])} succeeded, {len(summary['skipped'])} skipped, {len(summary['failed'])} failed.")
+        return summary
+    
+    def flush_manifest(self): 
+        """
+        Writes the manifest entries of the responses saved since the last flush.
+        Call before the invocation returns.
+        """
+        return self.manifest.flush()
+
+    def blob_name(self, geoid): 
+        """
+        Returns: the name of the blob holding today's response for a geoid: the blob saved by
+        this instance if there is one, otherwise the name the current storage mode saves it under. 
+        None in "delta" storage mode until saved, as the response is stored as a delta or a checkpoint.
+        """
+        if geoid in self.saved: 
+            return self.saved[geoid]
+        if self.storage_mode == 'delta': 
+            return None
+        if self.storage_mode == 'dedup': 
+            return ContentStore.manifest_name(geoid, self.date)
+        return geoid + "_" + str(self.date) + '.json'
+    
+    def save_voter_info(self, geoid, result, bucket_name, election_id=None):
         """
         Takes: 
             - a geoid such as a county fips code or OCDid or other identifier as filename.
             - the data returned for the geoid
+            - election_id of the request, defaults to the election of the response
         Saves the file to the project bucket. 
+        In "dedup" storage mode, saves shared sections once and a manifest for the geoid.
+        In "delta" storage mode, saves the changes since the previous snapshot of the geoid, 
+        or the full response as a checkpoint (see src/voter_info_diff.py).
+        Records the saved response in the voter info manifest (see flush_manifest).
+        Returns: the name of the saved blob, or None if the upload failed
         """
-        blob_name = geoid + "_" + str(self.date) + '.json'
-        filepath = os.path.join(self.path, blob_name)
-        try: 
-            self.client.save_tmp_json(blob_name, result)
-            self.client.upload_file(filepath, bucket_name, blob_name)
-            logging.error(f"Successfully saved data for {geoid} to: gs://{bucket_name}/{blob_name}")
-        except Exception as error: 
-            logging.error(f"Error uploading data for {geoid} to gs://{bucket_name}/{bucket_name}.")
-            logging.error(error)
+        # Serialised once with sorted keys: the bytes uploaded are also the bytes hashed
+        with metrics.timer("serialise", bucket=bucket_name): 
+            payload = canonical_json(result).encode('utf-8')
+        if election_id is None: 
+            election_id = (result.get('election') or {}).get('id')
+        
+        base_date = None
+        if self.storage_mode == 'delta': 
+            # Imported when used: the diff loads nameparser, a cold start cost the other modes do not pay
+            from src.voter_info_diff import SnapshotStore, CHECKPOINT_EVERY
+            try: 
+                checkpoint_every = int(os.environ.get('VOTER_INFO_CHECKPOINT_EVERY', CHECKPOINT_EVERY))
+                store = SnapshotStore(self.client, bucket_name, checkpoint_every=checkpoint_every)
+                blob_name, base_date = store.save(election_id, geoid, self.date, result, payload)
+            except Exception as error: 
+                logging.error(f"Error uploading data for {geoid} to gs://{bucket_name}.")
+                logging.error(error)
+                return None
+        elif self.storage_mode == 'dedup': 
+            try: 
+                blob_name = ContentStore(self.client, bucket_name).save_voter_info(geoid, result, self.date)
+            except Exception as error: 
+                logging.error(f"Error uploading data for {geoid} to gs://{bucket_name}.")
+                logging.error(error)
+                return None
+        else: 
+            blob_name = self.blob_name(geoid)
+            if not self.client.upload_json(payload, bucket_name, blob_name): 
+                logging.error(f"Error uploading data for {geoid} to gs://{bucket_name}/{blob_name}.")
+                return None
+        
+        self.saved[geoid] = blob_name
+        logging.info(f"Successfully saved data for {geoid} to: gs://{bucket_name}/{blob_name}")
+        if election_id is not None: 
+            self.manifest.add(
+                bucket_name, 
+                election_id, 
+                geoid, 
+                self.date, 
+                blob_name, 
+                size=len(payload), 
+                content_hash=hashlib.sha256(payload).hexdigest(), 
+                base_date=base_date
+            )
+        return blob_name
+    
+    def save_voter_info_stream(self, geoid, sink, bucket_name, election_id): 
+        """
+        Saves a response streamed into a CanonicalJsonSink, in "full" storage mode. 
+        The blob and its manifest entry are the same as save_voter_info would write. 
+        Takes: 
+            - a geoid such as a county fips code
+            - the CanonicalJsonSink the response was streamed to
+            - bucket name on Google Cloud Storage
+            - election_id of the request
+        Returns: the name of the saved blob, or None if the upload failed
+        """
+        with metrics.timer("serialise", bucket=bucket_name): 
+            file, size, content_hash = sink.finish()
+        blob_name = self.blob_name(geoid)
+        with file: 
+            if not self.client.upload_compressed_json(file, bucket_name, blob_name): 
+                logging.error(f"Error uploading data for {geoid} to gs://{bucket_name}/{blob_name}.")
+                return None
+        
+        self.saved[geoid] = blob_name
+        logging.info(f"Successfully saved data for {geoid} to: gs://{bucket_name}/{blob_name}")
+        if election_id is not None: 
+            self.manifest.add(
+                bucket_name, 
+                election_id, 
+                geoid, 
+                self.date, 
+                blob_name, 
+                size=size, 
+                content_hash=content_hash
+            )
+        return blob_name
             
     def load_current_elections(self, bucket_name, blob_name): 
         """
         Load json file listing current elections. 
         Validates 'elections' data in file
+        Cached for warm invocations until the blob changes. 
         Takes: 
         - bucket name 
         - blob name of file 
         
-        Returns: election data as json list
+        Returns: election data as json list (shared, do not modify)
         """ 
-        filepath = os.path.join(self.path, blob_name)
+        return self._load_elections_document(bucket_name, blob_name)['elections']
+    
+    def load_election_changes(self, bucket_name, blob_name): 
+        """
+        Load the changes recorded by run_current_elections in the current elections file. 
+        Takes: 
+        - bucket name 
+        - blob name of file 
         
-        #load data from Google Cloud Storage  
-        self.client.download_file(filepath, bucket_name, blob_name)
-        data = self.client.load_tmp_json(filepath)
+        Returns: list of {"id": election_id, "reason": reason}, or None if the file records no changes
+        """ 
+        return self._load_elections_document(bucket_name, blob_name).get('changes')
+    
+    def _download_reference(self, bucket_name, blob_name, generation): 
+        """
+        Downloads a generation of a reference blob to a /tmp file of its own, so a failed 
+        download never leaves the file of an older generation to be parsed and cached in its place. 
+        Returns: the local filepath
+        Raises: IOError if the download failed, so nothing is cached
+        """
+        filepath = os.path.join(self.path, f"{generation}_{blob_name}" if generation else blob_name)
+        if not self.client.download_file(filepath, bucket_name, blob_name, generation=generation): 
+            if os.path.exists(filepath): 
+                os.remove(filepath)
+            raise IOError(f"Failed to download gs://{bucket_name}/{blob_name}")
+        return filepath
 
-        try: 
-            elections = data['elections']
-            logging.info("Successfully loaded current elections data.")
-            return elections
-        except KeyError as error: 
-            logging.error(f"There are no current elections stored in file: 'gs://' {bucket_name} + '/' + {blob_name}")
-            raise
-        except Exception as error: 
-            logging.error(f"Error loading current elections from file: 'gs://' {bucket_name} + '/' + {blob_name}")
-            logging.error(error)
-            raise
+    def _load_elections_document(self, bucket_name, blob_name): 
+        
+        def load(generation): 
+            #load data from Google Cloud Storage  
+            filepath = self._download_reference(bucket_name, blob_name, generation)
+            try: 
+                data = self.client.load_tmp_json(filepath)
+            finally: 
+                # Parsed into memory, the file is not needed again
+                os.remove(filepath)
+
+            try: 
+                if data is None: 
+                    raise ValueError(f"Unreadable json in {filepath}")
+                elections = data['elections']
+                logging.info("Successfully loaded current elections data.")
+                return data
+            except KeyError as error: 
+                logging.error(f"There are no current elections stored in file: 'gs://' {bucket_name} + '/' + {blob_name}")
+                raise
+            except Exception as error: 
+                logging.error(f"Error loading current elections from file: 'gs://' {bucket_name} + '/' + {blob_name}")
+                logging.error(error)
+                raise
+        
+        return reference_cache.get(self.client, bucket_name, blob_name, load)
             
     def load_address_locales(self, bucket_name, blob_name): 
-        filepath = os.path.join(self.path, blob_name)
+        """
+        Load csv file of addresses by locale. 
+        Cached for warm invocations until the blob changes. 
+        Takes: 
+        - bucket name 
+        - blob name of file 
+        
+        Returns: address data as DataFrame (shared, do not modify)
+        """ 
+        # pandas is only needed here, importing it at module level slows every cold start
+        import pandas as pd
 
-        #load temp file to gcp  
-        self.client.download_file(filepath, bucket_name, blob_name)
+        def load(generation): 
+            #load temp file to gcp  
+            filepath = self._download_reference(bucket_name, blob_name, generation)
 
-        #load address data
-        try: 
-            with open(filepath, 'rb') as file:
+            #load address data
+            try: 
                 data = pd.read_csv(filepath, encoding='utf-8')
-            logging.debug(f"Loaded address data from {filepath}")
-        except Exception as error: 
-            logging.error("Failed to load address data from /tmp/.")
+                logging.debug(f"Loaded address data from {filepath}")
+            except Exception as error: 
+                logging.error("Failed to load address data from /tmp/.")
+                logging.error(error)
+                raise
+            finally: 
+                os.remove(filepath)
 
-        try: 
-            #process data - ensure necessary columns available
-            addresses = data['address']
-            state_abbr = data['state_abbr']
-            data['fips'] = data['fips'].astype('str').str.zfill(5)
-            logging.info("Successfully loaded address lookup data.")
-            return data
-        except KeyError as error: 
-            logging.error(f"There are no current elections stored in file: 'gs://' {bucket_name} + '/' + {blob_name}")
-            raise
-        except Exception as error: 
-            logging.error(f"Error loading current elections from file: 'gs://' {bucket_name} + '/' + {blob_name}")
-            logging.error(error)
-            raise
+            try: 
+                #process data - ensure necessary columns available
+                addresses = data['address']
+                state_abbr = data['state_abbr']
+                data['fips'] = data['fips'].astype('str').str.zfill(5)
+                logging.info("Successfully loaded address lookup data.")
+                return data
+            except KeyError as error: 
+                logging.error(f"There are no current elections stored in file: 'gs://' {bucket_name} + '/' + {blob_name}")
+                raise
+            except Exception as error: 
+                logging.error(f"Error loading current elections from file: 'gs://' {bucket_name} + '/' + {blob_name}")
+                logging.error(error)
+                raise
+        
+        return reference_cache.get(self.client, bucket_name, blob_name, load)
+
+    def load_locale_store(self, bucket_name, blob_name): 
+        """
+        Load the indexed address locales store built by bin/build_locale_store.py.
+        Cached for warm invocations until the blob changes. 
+        Takes: 
+        - bucket name 
+        - blob name of the .npy store
+        
+        Returns: memory-mapped LocaleStore
+        """ 
+        # Imported here as it loads numpy, which run_voter_info does not need
+        from src.locale_store import LocaleStore
+
+        def load(generation): 
+            # A new generation gets its own file so an older store still mapped is never truncated
+            filepath = self._download_reference(bucket_name, blob_name, generation)
+            
+            try: 
+                store = LocaleStore.load(filepath)
+                logging.info(f"Successfully loaded {len(store)} address locales.")
+                return store
+            except Exception as error: 
+                logging.error(f"Error loading address locales from file: gs://{bucket_name}/{blob_name}")
+                logging.error(error)
+                raise
+        
+        return reference_cache.get(self.client, bucket_name, blob_name, load)
             
 # End
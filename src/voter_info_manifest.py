@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Append-only manifest of the voter info responses saved to the voter_info bucket.
+
+Response blobs are named {geoid}_{date}.json and carry no election id, so
+finding them means listing the whole bucket. Instead, save_voter_info records
+one entry per saved response:
+
+    {"election_id", "geo_id", "date", "blob_name", "size", "content_hash", "inherited_from", "base_date", "updated"}
+
+inherited_from is set for divisions that were not fetched and share the
+response of another division (see src/probe_sampler.py). base_date is set for
+responses stored as the changes since the snapshot of that date ("delta"
+storage mode, see src/voter_info_diff.py).
+
+Entries are buffered and written in batches as immutable shards, partitioned
+by election and date:
+
+    voter_info_manifest/{election_id}/{date}/{timestamp}-{uuid}.json
+
+(not to be confused with the per-division manifests/ of the "dedup" storage
+mode, see src/content_store.py).
+
+ManifestIndex answers "latest response per division" and "all divisions of an
+election" from the shards of one election instead of the responses. Every
+query lists the shards of the election (or day) and loads those it has not
+seen: shards never change once written, so parsed shards are cached in process
+and a repeated query only downloads shards added since.
+
+Single-division invocations of run_voter_info each write a shard of their own,
+so a partition can hold thousands and its first query loads them all.
+ManifestIndex.compact merges the shards of a partition into one. It runs as a
+separate step, before the daily consolidation (bin/consolidate_voter_info.py),
+never from queries, and only merges a partition all of whose listed shards it
+could read.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from google.api_core import exceptions
+
+MANIFEST_PREFIX = "voter_info_manifest/"
+# Listings retried when shards are removed by a compaction while a query reads them
+MAX_LISTINGS = 3
+
+# Parsed shards by (bucket, shard name), shared across warm invocations
+_shards = OrderedDict()
+_shards_lock = threading.Lock()
+MAX_SHARDS = 20000
+
+
+def partition_prefix(election_id, date=None):
+    if date is None:
+        return f"{MANIFEST_PREFIX}{election_id}/"
+    return f"{MANIFEST_PREFIX}{election_id}/{date}/"
+
+
+class ManifestWriter():
+    """
+    Buffers manifest entries and writes them to storage in batches,
+    one shard per partition per flush.
+    Takes:
+        - client: CloudStorageClient
+        - max_entries: buffered entries that trigger a flush
+    """
+
+    def __init__(self, client, max_entries=500):
+        self.client = client
+        self.max_entries = max_entries
+        self._buffer = dict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def add(self, bucket_name, election_id, geo_id, date, blob_name, size=None, content_hash=None, inherited_from=None,
+            base_date=None):
+        """
+        Buffers the entry of a saved response, flushing when the buffer is full.
+        """
+        entry = {
+            "election_id": str(election_id),
+            "geo_id": str(geo_id),
+            "date": str(date),
+            "blob_name": blob_name,
+            "size": size,
+            "content_hash": content_hash,
+            "inherited_from": inherited_from,
+            "base_date": base_date,
+            "updated": time.time(),
+        }
+        with self._lock:
+            self._buffer.setdefault((bucket_name, entry["election_id"], entry["date"]), []).append(entry)
+            self._size += 1
+            full = self._size >= self.max_entries
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered entries as one shard per partition.
+        Entries that fail to upload stay buffered for the next flush.
+        Returns: the number of entries written
+        """
+        with self._lock:
+            buffer, self._buffer, self._size = self._buffer, dict(), 0
+        written = 0
+        for (bucket_name, election_id, date), entries in buffer.items():
+            shard_name = f"{partition_prefix(election_id, date)}{int(time.time() * 1000)}-{uuid.uuid4().hex}.json"
+            if self.client.upload_json({"entries": entries}, bucket_name, shard_name, only_if_new=True):
+                written += len(entries)
+                continue
+            logging.error(f"Failed to write manifest shard gs://{bucket_name}/{shard_name}")
+            with self._lock:
+                self._buffer.setdefault((bucket_name, election_id, date), []).extend(entries)
+                self._size += len(entries)
+        return written
+
+
+class ManifestIndex():
+    """
+    Query API over the manifest shards of a bucket.
+    Takes:
+        - client: CloudStorageClient
+        - bucket name on Google Cloud Storage
+        - max_workers: concurrent shard downloads
+    """
+
+    def __init__(self, client, bucket_name, max_workers=8):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.max_workers = max_workers
+
+    def _load_shards(self, names):
+        """
+        Loads shards from the process cache or storage.
+        Returns: (dict of shard name -> entries of each shard read, names of the shards not found)
+        Raises: IOError if a shard could not be read for another reason than being missing
+        """
+        loaded, missing, wanted = dict(), [], []
+        with _shards_lock:
+            for name in names:
+                key = (self.bucket_name, name)
+                if key in _shards:
+                    _shards.move_to_end(key)
+                    loaded[name] = _shards[key]
+                else:
+                    wanted.append(name)
+        transfers = ((None, self.bucket_name, name) for name in wanted)
+        for result in self.client.download_many(transfers, self.max_workers):
+            if isinstance(result.error, exceptions.NotFound):
+                missing.append(result.blob_name)
+                continue
+            if not result.ok:
+                raise IOError(f"Failed to read manifest shard gs://{self.bucket_name}/{result.blob_name}: {result.error}")
+            entries = result.data.get("entries", [])
+            loaded[result.blob_name] = entries
+            with _shards_lock:
+                _shards[(self.bucket_name, result.blob_name)] = entries
+                while len(_shards) > MAX_SHARDS:
+                    _shards.popitem(last=False)
+        return loaded, missing
+
+    def shards(self, election_id, date=None):
+        return self.client.list_blob_names(self.bucket_name, prefix=partition_prefix(election_id, date))
+
+    def entries(self, election_id, date=None):
+        """
+        Returns: every entry of an election, or of one day of it, latest record per division and day
+        Raises: IOError if a shard could not be read
+        """
+        for _ in range(MAX_LISTINGS):
+            loaded, missing = self._load_shards(self.shards(election_id, date))
+            # Shards removed by a compaction since the listing: their entries are in a shard listed next time
+            if not missing:
+                break
+            logging.info(f"{len(missing)} manifest shards of {election_id} were compacted while read, listing again.")
+        else:
+            raise IOError(f"Manifest of election {election_id} kept changing while read, {len(missing)} shards missing")
+        latest = dict()
+        for entries in loaded.values():
+            for entry in entries:
+                key = (entry["geo_id"], entry["date"])
+                if key not in latest or entry["updated"] > latest[key]["updated"]:
+                    latest[key] = entry
+        return list(latest.values())
+
+    def latest(self, election_id):
+        """
+        Returns: dict of geo_id -> entry of the most recent response saved for the division
+        """
+        latest = dict()
+        for entry in self.entries(election_id):
+            current = latest.get(entry["geo_id"])
+            if current is None or (entry["date"], entry["updated"]) > (current["date"], current["updated"]):
+                latest[entry["geo_id"]] = entry
+        return latest
+
+    def divisions(self, election_id, date=None, include_inherited=True):
+        """
+        Returns: sorted geo_ids with a saved response for the election (and date),
+                 optionally leaving out the divisions inheriting another division's response
+        """
+        return sorted({
+            entry["geo_id"] for entry in self.entries(election_id, date)
+            if include_inherited or not entry.get("inherited_from")
+        })
+
+    def lookup(self, election_id, geo_id, date=None):
+        """
+        Returns: the entry of the division's response on the date, or its latest if no date, or None
+        """
+        if date is None:
+            return self.latest(election_id).get(str(geo_id))
+        return next((entry for entry in self.entries(election_id, date) if entry["geo_id"] == str(geo_id)), None)
+
+    def compact(self, election_id, date):
+        """
+        Merges the shards of a partition into one, then removes the merged shards.
+        Leaves the partition as it is unless every listed shard was read, so a
+        compaction running concurrently can duplicate entries, which entries()
+        resolves, but never lose them.
+        Returns: the number of shards merged
+        Raises: IOError if a shard could not be read
+        """
+        names = self.shards(election_id, date)
+        if len(names) < 2:
+            return 0
+        loaded, missing = self._load_shards(names)
+        if missing:
+            logging.warning(f"{len(missing)} manifest shards of {election_id} on {date} were removed while read, not compacting.")
+            return 0
+        latest = dict()
+        for entry in (entry for entries in loaded.values() for entry in entries):
+            if entry["geo_id"] not in latest or entry["updated"] > latest[entry["geo_id"]]["updated"]:
+                latest[entry["geo_id"]] = entry
+        return self._merge(election_id, date, list(loaded), list(latest.values()))
+
+    def _merge(self, election_id, date, names, entries):
+        """
+        Writes the entries of a partition as one shard and removes the shards they were read from.
+        Takes the names of the shards whose entries were all loaded into entries: only those are removed.
+        Returns: the number of shards merged
+        """
+        shard_name = f"{partition_prefix(election_id, date)}{int(time.time() * 1000)}-{uuid.uuid4().hex}.json"
+        if not self.client.upload_json({"entries": entries}, self.bucket_name, shard_name, only_if_new=True):
+            logging.error(f"Failed to compact manifest {partition_prefix(election_id, date)}")
+            return 0
+        with _shards_lock:
+            _shards[(self.bucket_name, shard_name)] = entries
+            while len(_shards) > MAX_SHARDS:
+                _shards.popitem(last=False)
+        for name in names:
+            self.client.delete_blob(self.bucket_name, name)
+            with _shards_lock:
+                _shards.pop((self.bucket_name, name), None)
+        logging.info(f"Compacted {len(names)} manifest shards of {election_id} on {date} into {shard_name}")
+        return len(names)
+# End
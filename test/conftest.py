@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Shared fixtures: storage is the in-memory fake of benchmarks/fakes.py,
+patched in as the client cached by src/utils_cloud_storage.py, and voter
+info responses come from its fake Civic Information API.
+"""
+import pytest
+
+from benchmarks.fakes import FakeCivicApi, FakeStorageClient, GENERAL_ELECTION, synthetic_address
+from src import run_ledger, utils_cloud_storage, voter_info_manifest
+from src.utils_cloud_storage import CloudStorageClient
+from src.voter_info_fetcher import VoterInfo
+
+
+@pytest.fixture
+def storage_client(monkeypatch):
+    """
+    CloudStorageClient over empty in-memory buckets.
+    """
+    FakeStorageClient.reset()
+    monkeypatch.setattr(utils_cloud_storage, "_client", FakeStorageClient())
+    yield CloudStorageClient()
+    FakeStorageClient.reset()
+
+
+@pytest.fixture(scope="session")
+def api():
+    """
+    Fake Civic Information API, called in process without its HTTP server.
+    """
+    return FakeCivicApi([GENERAL_ELECTION])
+
+
+@pytest.fixture
+def civic(monkeypatch, storage_client, api):
+    """
+    VoterInfo fetching from the fake API, in the storage mode of VOTER_INFO_STORAGE_MODE.
+    """
+    monkeypatch.setenv("GOOGLE_CIVIC_API_KEY", "fake")
+    monkeypatch.setattr(voter_info_manifest, "_shards", voter_info_manifest.OrderedDict())
+    monkeypatch.setattr(run_ledger, "_completed", run_ledger.OrderedDict())
+
+    def fetch_voter_info(self, address, election_id=None, limiter=None):
+        return api.voter_info(address, election_id)[1]
+
+    monkeypatch.setattr(VoterInfo, "fetch_voter_info", fetch_voter_info)
+    return VoterInfo()
+
+
+@pytest.fixture
+def divisions(api):
+    """
+    (geo_id, address) of the counties of Rhode Island.
+    """
+    return [(fips, synthetic_address(fips, name, usps)) for fips, (_, _, usps, name) in api.centroids.items() if usps == "RI"]
+# End
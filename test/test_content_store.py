@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the content-addressed storage of src/content_store.py.
+"""
+import pytest
+
+from src import content_store
+from src.content_store import ContentStore
+
+
+@pytest.fixture(autouse=True)
+def stored_hashes(monkeypatch):
+    monkeypatch.setattr(content_store, "_stored_hashes", content_store.OrderedDict())
+    return content_store._stored_hashes
+
+
+def test_put_stores_in_each_bucket(storage_client):
+    doc = {"office": "Governor"}
+    digest = ContentStore(storage_client, "first").put(doc)
+    assert ContentStore(storage_client, "second").put(doc) == digest
+    for bucket_name in ("first", "second"):
+        assert ContentStore(storage_client, bucket_name).get(digest) == doc
+
+
+def test_stored_hashes_are_bounded(storage_client, stored_hashes, monkeypatch):
+    monkeypatch.setattr(content_store, "MAX_STORED_HASHES", 3)
+    store = ContentStore(storage_client, "bucket")
+    digests = [store.put({"index": index}) for index in range(5)]
+    assert list(stored_hashes) == [("bucket", digest) for digest in digests[-3:]]
+
+
+def test_save_and_load_voter_info(storage_client):
+    store = ContentStore(storage_client, "bucket")
+    response = {
+        "election": {"id": "5000"},
+        "contests": [{"office": "Governor"}, {"office": "Senator"}],
+        "pollingLocations": [{"address": {"locationName": "B"}}, {"address": {"locationName": "A"}}],
+    }
+    store.save_voter_info("44007", response, "2020-11-03")
+    loaded = store.load_voter_info("44007", "2020-11-03")
+    assert loaded["contests"] == response["contests"]
+    # Unordered sections are normalised
+    assert sorted(loaded["pollingLocations"], key=str) == sorted(response["pollingLocations"], key=str)
+# End
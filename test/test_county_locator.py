@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the offline nearest-county lookup of src/county_locator.py over the bundled gazetteer.
+"""
+import numpy as np
+import pytest
+
+from src.county_locator import CountyLocator, EARTH_RADIUS_KM, nearest_unit_vectors, to_unit_vectors
+
+
+@pytest.fixture(scope="module")
+def locator():
+    return CountyLocator.from_gazetteer()
+
+
+def haversine_km(lat, long, lats, longs):
+    lat, long, lats, longs = map(np.radians, (lat, long, lats, longs))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((longs - long) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def test_gazetteer_is_loaded_with_padded_fips(locator):
+    assert len(locator) > 3000
+    assert all(len(geoid) == 5 for geoid in locator.geoids.tolist())
+    assert "35013" in locator.geoids.tolist()
+
+
+def test_reverse_geocode(locator):
+    providence = locator.reverse_geocode(41.824, -71.4128)
+    assert (providence["GEOID"], providence["USPS"], providence["NAME"]) == ("44007", "RI", "Providence County")
+    assert locator.reverse_geocode(39.29, -76.61)["NAME"] == "Baltimore city"
+    assert locator.reverse_geocode(32.3199, -106.7637)["NAME"] == "Doña Ana County"
+
+
+def test_lookup_is_vectorised(locator):
+    result = locator.lookup([41.824, 39.29], [-71.4128, -76.61])
+    assert result["GEOID"].tolist() == ["44007", "24510"]
+    assert (result["distance_km"] < 20).all()
+
+
+def test_nearest_matches_great_circle_distances(locator):
+    rng = np.random.RandomState(0)
+    lats, longs = rng.uniform(25, 49, 300), rng.uniform(-124, -67, 300)
+    # Chunks smaller than the queries and k > 1
+    indices, distances = nearest_unit_vectors(locator._points, to_unit_vectors(lats, longs), k=3, chunk_size=64)
+    for lat, long, row, row_distances in zip(lats, longs, indices, distances):
+        expected = haversine_km(lat, long, locator.lats, locator.longs)
+        assert row.tolist() == np.argsort(expected)[:3].tolist()
+        np.testing.assert_allclose(row_distances, np.sort(expected)[:3], rtol=1e-6, atol=1e-6)
+
+
+def test_k_is_capped_at_the_number_of_points():
+    points = to_unit_vectors([0.0, 0.0], [0.0, 1.0])
+    indices, distances = nearest_unit_vectors(points, to_unit_vectors([0.0], [0.9]), k=5)
+    assert indices.tolist() == [[1, 0]]
+    assert distances[0, 0] < distances[0, 1]
+# End
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the OCD division id resolution of src/division_resolver.py over the bundled gazetteer.
+"""
+import pytest
+
+from src.division_resolver import DivisionResolver, normalise_name, parse_ocd_id
+
+
+@pytest.fixture(scope="module")
+def resolver():
+    return DivisionResolver.from_gazetteer()
+
+
+def fips(resolver, ocd_id):
+    return resolver.resolve(ocd_id).fips
+
+
+def test_parse_ocd_id():
+    assert parse_ocd_id("ocd-division/country:us/state:MD/place:Baltimore") == [
+        ("country", "us"), ("state", "md"), ("place", "baltimore"),
+    ]
+    assert parse_ocd_id(None) == []
+
+
+def test_normalise_name():
+    assert normalise_name("St. Clair") == normalise_name("st._clair") == "stclair"
+    assert normalise_name("Doña Ana") == normalise_name("dona_ana") == "donaana"
+
+
+def test_country_and_state_cover_every_county(resolver):
+    country = resolver.resolve("ocd-division/country:us")
+    assert (country.state_abbr, country.fips, country.level) == (None, None, "country")
+    state = resolver.resolve("ocd-division/country:us/state:va")
+    assert (state.state_abbr, state.fips, state.level) == ("VA", None, "state")
+    assert resolver.resolve("ocd-division/country:us/district:dc").state_abbr == "DC"
+
+
+def test_baltimore_city_is_not_baltimore_county(resolver):
+    assert fips(resolver, "ocd-division/country:us/state:md/county:baltimore") == ("24005",)
+    assert fips(resolver, "ocd-division/country:us/state:md/place:baltimore") == ("24510",)
+    assert fips(resolver, "ocd-division/country:us/state:va/place:richmond") == ("51760",)
+    assert fips(resolver, "ocd-division/country:us/state:va/county:richmond") == ("51159",)
+
+
+def test_county_equivalents(resolver):
+    assert fips(resolver, "ocd-division/country:us/state:nm/county:doña_ana") == ("35013",)
+    assert fips(resolver, "ocd-division/country:us/state:nm/county:dona_ana") == ("35013",)
+    assert fips(resolver, "ocd-division/country:us/state:la/parish:orleans") == ("22071",)
+    assert fips(resolver, "ocd-division/country:us/state:ri/county:providence") == ("44007",)
+    assert fips(resolver, "ocd-division/country:us/state:ak/borough:anchorage") == ("02020",)
+
+
+def test_consolidated_cities_are_addressed_as_places(resolver):
+    assert fips(resolver, "ocd-division/country:us/state:pa/place:philadelphia") == ("42101",)
+    assert fips(resolver, "ocd-division/country:us/state:ca/place:san_francisco") == ("06075",)
+    # A place is not its namesake county
+    assert fips(resolver, "ocd-division/country:us/state:ca/place:los_angeles") is None
+
+
+def test_divisions_without_a_county_resolve_to_their_state(resolver):
+    district = resolver.resolve("ocd-division/country:us/state:ca/cd:12")
+    assert (district.state_abbr, district.fips, district.level) == ("CA", None, "state")
+    lower = resolver.resolve("ocd-division/country:us/state:ri/sldl:5")
+    assert (lower.state_abbr, lower.fips, lower.level) == ("RI", None, "state")
+
+
+def test_subdivisions_of_a_county_stay_in_the_county(resolver):
+    ward = resolver.resolve("ocd-division/country:us/state:md/place:baltimore/council_district:3")
+    assert (ward.fips, ward.level) == (("24510",), "county")
+# End
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the election change detection of src/election_fetcher.py and run_current_elections.
+"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fakes import FakeCivicApi, FakePublisher, FakeStorageClient, install_fakes
+from src.election_fetcher import diff_elections
+
+GENERAL = {"id": "5000", "name": "General", "electionDay": "2020-11-03", "ocdDivisionId": "ocd-division/country:us/state:ri"}
+RUNOFF = {"id": "5001", "name": "Runoff", "electionDay": "2020-12-01", "ocdDivisionId": "ocd-division/country:us/state:ga"}
+CONTEXT = SimpleNamespace(event_id="1", timestamp="2020-11-01T00:00:00Z")
+
+
+def test_diff_elections():
+    moved = dict(GENERAL, electionDay="2020-11-04")
+    assert diff_elections(None, [GENERAL]) == [{"id": "5000", "reason": "new"}]
+    assert diff_elections([GENERAL], [GENERAL]) == []
+    assert diff_elections([GENERAL], [moved]) == [{"id": "5000", "reason": "changed"}]
+    assert diff_elections([GENERAL, RUNOFF], [GENERAL]) == [{"id": "5001", "reason": "removed"}]
+
+
+@pytest.fixture
+def elections_api():
+    api = FakeCivicApi([GENERAL], latency=0.0).start()
+    with install_fakes(api, FakePublisher()):
+        yield api
+    api.stop()
+
+
+def current_elections():
+    blob = FakeStorageClient().bucket("current_elections").blob("current_elections.json")
+    return json.loads(blob.download_as_string())
+
+
+def test_full_mode_is_the_default(elections_api):
+    import main
+    main.run_current_elections(None, CONTEXT)
+    main.run_current_elections(None, CONTEXT)
+    assert current_elections()["changes"] == [{"id": "5000", "reason": "full"}]
+
+
+def test_incremental_mode_records_removed_elections(elections_api):
+    import main
+    bucket = FakeStorageClient().bucket("current_elections")
+    bucket.blob("current_elections.json").upload_from_string(json.dumps({"elections": [GENERAL, RUNOFF]}))
+    main.run_current_elections({"attributes": {"mode": "incremental"}}, CONTEXT)
+    document = current_elections()
+    assert [election["id"] for election in document["elections"]] == ["5000"]
+    assert document["changes"] == [{"id": "5001", "reason": "removed"}]
+
+# End
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the cached bulk reverse geocoding of src/geocode_pipeline.py.
+"""
+import csv
+import threading
+
+import pytest
+
+from src.county_locator import CountyLocator
+from src.geocode_pipeline import BulkGeocoder, GeocodeCache, coordinate_key, select_address
+
+
+class FakeGeocoder():
+    """
+    Answers with the coordinates as the address, failing for the keys in `failing`.
+    """
+
+    def __init__(self, failing=(), zero_results=()):
+        self.failing = set(failing)
+        self.zero_results = set(zero_results)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def reverse_geocode(self, lat, long, limiter=None):
+        key = f"{lat},{long}"
+        with self._lock:
+            self.calls.append(key)
+        if key in self.failing:
+            raise ConnectionError("reset")
+        if key in self.zero_results:
+            return {"status": "ZERO_RESULTS", "results": []}
+        return {"status": "OK", "results": [{"formatted_address": f"1 Main St, {key}, RI 02903, USA"}]}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = GeocodeCache(str(tmp_path / "geocode_cache.sqlite"))
+    yield cache
+    cache.close()
+
+
+def test_points_are_rounded_and_deduplicated(cache):
+    geocoder = FakeGeocoder()
+    responses = BulkGeocoder(geocoder, cache, precision=2).geocode([41.821, 41.8249, 41.5], [-71.411, -71.4139, -71.5])
+    assert sorted(geocoder.calls) == ["41.50,-71.50", "41.82,-71.41"]
+    assert set(responses) == {"41.82,-71.41", "41.50,-71.50"}
+
+
+def test_reruns_only_geocode_the_misses(cache):
+    lats, longs = [41.8, 41.5, 41.0], [-71.4, -71.5, -71.6]
+    failing = FakeGeocoder(failing=["41.5000,-71.5000"], zero_results=["41.0000,-71.6000"])
+    responses = BulkGeocoder(failing, cache).geocode(lats, longs)
+    assert set(responses) == {"41.8000,-71.4000", "41.0000,-71.6000"}
+    assert len(cache) == 2
+
+    rerun = FakeGeocoder()
+    responses = BulkGeocoder(rerun, cache).geocode(lats, longs)
+    assert rerun.calls == ["41.5000,-71.5000"]
+    assert len(responses) == 3
+
+
+def test_cache_persists_and_evicts_least_recently_used(tmp_path):
+    filepath = str(tmp_path / "geocode_cache.sqlite")
+    cache = GeocodeCache(filepath, max_entries=2)
+    for key in ("a", "b", "c"):
+        cache.put(key, {"status": "OK", "key": key})
+    cache.get_many(["a"])
+    cache.evict()
+    cache.close()
+    reopened = GeocodeCache(filepath)
+    assert sorted(reopened.get_many(["a", "b", "c"])) == ["a", "c"]
+    reopened.close()
+
+
+def test_select_address():
+    assert select_address(None) is None
+    assert select_address({"results": []}) is None
+    unnamed = {"results": [
+        {"formatted_address": "Unnamed Road, Foster, RI 02825, USA"},
+        {"formatted_address": "1 Main St, Foster, RI 02825, USA"},
+    ]}
+    assert select_address(unnamed) == "1 Main St, Foster, RI 02825, USA"
+    unnamed["results"][1]["formatted_address"] = "Foster, RI, USA"
+    assert select_address(unnamed) == "Unnamed Road, Foster, RI 02825, USA"
+
+
+def test_build_locales(cache, tmp_path):
+    locator = CountyLocator(["44001", "44007"], ["RI", "RI"], ["Bristol County", "Providence County"], [41.7, 41.87], [-71.28, -71.57])
+    geocoder = FakeGeocoder(failing=[coordinate_key(41.7, -71.28, 4)])
+    filepath = str(tmp_path / "addresses_county.csv")
+    assert BulkGeocoder(geocoder, cache).build_locales(locator, filepath) == 1
+    with open(filepath, encoding="utf-8", newline="") as file:
+        rows = {row["fips"]: row for row in csv.DictReader(file)}
+    assert rows["44001"]["address"] == ""
+    assert rows["44007"]["address"] == "1 Main St, 41.8700,-71.5700, RI 02903, USA"
+    assert rows["44007"]["state_abbr"] == "RI" and rows["44007"]["name"] == "Providence County"
+# End
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the indexed locale store of src/locale_store.py.
+"""
+import pytest
+
+from src.locale_store import LocaleStore
+
+LOCALES = [
+    ("44007", "ri", "1 Main St, Providence, RI"),
+    ("1001", "AL", "1 Main St, Prattville, AL"),
+    ("44001", "RI", "1 Main St, Bristol, RI"),
+    ("24510", "MD", "1 Main St, Baltimore, MD"),
+    ("01003", "AL", "1 Main St, Bay Minette, AL"),
+]
+
+
+@pytest.fixture
+def store():
+    return LocaleStore.from_records(LOCALES)
+
+
+def test_states_are_contiguous_slices(store):
+    assert store.states == {"AL": (0, 2), "MD": (2, 3), "RI": (3, 5)}
+    assert list(store.select("ri")) == [("44001", "1 Main St, Bristol, RI"), ("44007", "1 Main St, Providence, RI")]
+    assert store.count("AL") == 2 and store.count() == len(store) == 5
+    assert list(store.select("WY")) == [] and store.count("WY") == 0
+
+
+def test_lookup_pads_fips(store):
+    assert store.lookup(1001) == "1 Main St, Prattville, AL"
+    assert store.lookup("24510") == "1 Main St, Baltimore, MD"
+    assert store.lookup("24005") is None
+    assert store.lookup("99999") is None
+    assert list(store.select_fips(["44007", 1001, "24005"])) == [
+        ("01001", "1 Main St, Prattville, AL"), ("44007", "1 Main St, Providence, RI"),
+    ]
+
+
+def test_saved_store_is_memory_mapped(store, tmp_path):
+    filepath = str(tmp_path / "addresses_county.npy")
+    store.save(filepath)
+    loaded = LocaleStore.load(filepath)
+    assert not loaded.data.flags.writeable
+    assert list(loaded.select()) == list(store.select())
+
+
+def test_from_csv_skips_locales_without_an_address(tmp_path):
+    filepath = tmp_path / "addresses_county.csv"
+    filepath.write_text("fips,state_abbr,address\n44007,RI,1 Main St\n44001,RI,\n", encoding="utf-8")
+    assert list(LocaleStore.from_csv(str(filepath)).select()) == [("44007", "1 Main St")]
+# End
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the spatial index of polling sites of src/polling_index.py.
+"""
+import numpy as np
+import pytest
+
+from src.polling_index import PollingIndex, extract_sites, site_address
+
+STATEWIDE = {
+    "address": {"locationName": "State House", "line1": "82 Smith St", "city": "Providence", "state": "RI", "zip": "02903"},
+    "latitude": 41.8309, "longitude": -71.4148, "pollingHours": "8am - 4pm",
+}
+
+
+def response(name, lat, long):
+    return {
+        "pollingLocations": [
+            {"address": {"locationName": name, "line1": "1 Elm St", "city": "Town", "state": "RI"}, "latitude": lat, "longitude": long},
+            {"address": {"locationName": f"{name} Annex"}},
+        ],
+        "earlyVoteSites": [STATEWIDE],
+        "dropOffLocations": [{"name": f"{name} Box", "latitude": str(lat + 0.01), "longitude": str(long)}],
+    }
+
+
+@pytest.fixture
+def index():
+    return PollingIndex.from_responses([
+        (44001, response("Bristol School", 41.68, -71.27)),
+        ("44007", response("Providence School", 41.82, -71.41)),
+        ("44009", response("Westerly School", 41.38, -71.83)),
+    ])
+
+
+def test_site_address():
+    assert site_address(STATEWIDE["address"]) == "82 Smith St, Providence, RI 02903"
+    assert site_address({}) == ""
+
+
+def test_extract_sites():
+    sites = list(extract_sites(44001, response("Bristol School", 41.68, -71.27)))
+    assert [site[:3] for site in sites] == [
+        ("44001", "polling", "Bristol School"),
+        ("44001", "polling", "Bristol School Annex"),
+        ("44001", "early_vote", "State House"),
+        ("44001", "drop_off", "Bristol School Box"),
+    ]
+    assert sites[0][3] == "1 Elm St, Town, RI"
+    assert np.isnan(sites[1][5]) and np.isnan(sites[1][6])
+    assert sites[3][5:] == (41.69, -71.27)
+
+
+def test_sites_shared_by_counties_are_located_once(index):
+    assert len(index) == 12
+    # 3 counties x (polling, drop off) + one statewide site, the annexes have no location
+    assert len(index.located) == 7
+    assert len(index.select("44007")) == 4
+
+
+def test_nearest(index):
+    positions, distances = index.nearest([41.82, 41.38], [-71.41, -71.83], k=2)
+    assert positions.shape == distances.shape == (2, 2)
+    assert [site["name"] for site in index.records(positions[0])] == ["Providence School", "Providence School Box"]
+    assert index.records(positions[1])[0]["name"] == "Westerly School"
+    assert distances[0][0] < 0.01 and np.all(np.diff(distances, axis=1) >= 0)
+
+
+def test_nearest_counts_shared_sites_once(index):
+    positions, _ = index.nearest(41.82, -71.41, k=len(index))
+    names = [site["name"] for site in index.records(positions[0])]
+    assert len(names) == 7 and names.count("State House") == 1
+
+
+def test_nearest_of_a_kind(index):
+    positions, _ = index.nearest([41.82], [-71.41], k=3, kind="early_vote")
+    # Fewer columns than k when fewer sites of the kind are indexed
+    assert positions.shape == (1, 1)
+    assert index.records(positions[0])[0]["name"] == "State House"
+    positions, _ = index.nearest([41.82], [-71.41], k=2, kind="drop_off")
+    assert [site["name"] for site in index.records(positions[0])] == ["Providence School Box", "Bristol School Box"]
+
+
+def test_select(index):
+    assert [site["kind"] for site in index.select("44001")] == ["drop_off", "early_vote", "polling", "polling"]
+    annex = index.select(44001, kind="polling")[1]
+    assert annex["name"] == "Bristol School Annex" and annex["lat"] is None
+    assert index.select("44003") == []
+
+
+def test_save_and_load(index, tmp_path):
+    filepath = str(tmp_path / "index.npy")
+    index.save(filepath)
+    loaded = PollingIndex.load(filepath)
+    assert loaded.select("44009") == index.select("44009")
+    assert np.array_equal(loaded.located, index.located)
+# End
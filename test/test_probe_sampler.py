@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the probe-and-expand collection of src/probe_sampler.py, over a row
+of counties split by a congressional district line.
+"""
+import pytest
+
+from benchmarks.fakes import synthetic_address
+from src.county_locator import CountyLocator, to_unit_vectors
+from src.probe_sampler import ProbeSampler, contest_signature, farthest_point_sample
+from src.voter_info_fetcher import VoterInfo
+
+COUNTIES = 20
+
+
+def contests(index, boundary):
+    """
+    Governor statewide, a congressional seat that changes at the boundary and a county race.
+    """
+    district = 1 if index < boundary else 2
+    return [
+        {"office": "Governor", "district": {"id": "ocd-division/country:us/state:xx", "scope": "statewide"}},
+        {"office": "U.S. House", "district": {"id": f"ocd-division/country:us/state:xx/cd:{district}", "scope": "congressional"}},
+        {"office": "Sheriff", "district": {"id": f"county:{index}", "scope": "countywide"}},
+    ]
+
+
+@pytest.fixture
+def county_row():
+    """
+    (locator, divisions) of counties in a west-east row, 99000 to 99019.
+    """
+    geoids = [f"{99000 + index}" for index in range(COUNTIES)]
+    longs = [-100 + 0.2 * index for index in range(COUNTIES)]
+    locator = CountyLocator(geoids, ["XX"] * COUNTIES, [f"County {geoid}" for geoid in geoids], [40.0] * COUNTIES, longs)
+    return locator, [(geoid, synthetic_address(geoid, f"County {geoid}", "XX")) for geoid in geoids]
+
+
+@pytest.fixture
+def fetch(civic, monkeypatch):
+    """
+    Serves the contests of counties split at a boundary, recording the counties fetched.
+    """
+    fetched, settings = [], {"boundary": 13}
+
+    def fetch_voter_info(self, address, election_id=None, limiter=None):
+        geoid = address[-5:]
+        fetched.append(geoid)
+        return {"election": {"id": election_id}, "contests": contests(int(geoid) - 99000, settings["boundary"])}
+
+    monkeypatch.setattr(VoterInfo, "fetch_voter_info", fetch_voter_info)
+    return fetched, settings
+
+
+def test_signature_ignores_local_races_and_order():
+    first, second = contests(0, 5), contests(1, 5)
+    assert contest_signature({"contests": first}) == contest_signature({"contests": second[::-1]})
+    assert contest_signature({"contests": first}) != contest_signature({"contests": contests(9, 5)})
+    assert contest_signature(None) == contest_signature({"contests": []})
+
+
+def test_farthest_point_sample_spreads_probes():
+    points = to_unit_vectors([40.0] * COUNTIES, [-100 + 0.2 * index for index in range(COUNTIES)])
+    assert farthest_point_sample(points, 3) == [0, 19, 9]
+    assert farthest_point_sample(points, 0) == []
+    assert sorted(farthest_point_sample(points, 50)) == list(range(COUNTIES))
+
+
+def test_expansion_fetches_around_a_district_line(civic, county_row, fetch):
+    locator, divisions = county_row
+    fetched, settings = fetch
+    summary = ProbeSampler(civic, locator, "voter_info", min_probes=3, neighbours=2).run("5000", divisions)
+    assert not summary["failed"] and summary["rounds"] > 1
+    assert len(summary["fetched"]) + len(summary["inherited"]) == COUNTIES
+    assert len(fetched) == len(set(fetched)) == len(summary["fetched"]) < COUNTIES
+    # The counties on both sides of the line were fetched
+    assert {"99012", "99013"} <= set(summary["fetched"])
+    # Every county inherits the congressional seat it would have been given
+    for geoid, source in summary["inherited"].items():
+        expected = contest_signature({"contests": contests(int(geoid) - 99000, settings["boundary"])})
+        assert summary["fetched"][source] == expected
+
+
+def test_agreeing_neighbours_stop_after_the_probes(civic, county_row, fetch):
+    locator, divisions = county_row
+    fetched, settings = fetch
+    settings["boundary"] = COUNTIES
+    summary = ProbeSampler(civic, locator, "voter_info", min_probes=3, neighbours=2).run("5000", divisions)
+    assert summary["rounds"] == 1
+    assert sorted(summary["fetched"]) == ["99000", "99009", "99019"]
+    assert len(summary["inherited"]) == COUNTIES - 3
+
+
+def test_max_rounds_and_coverage(civic, county_row, fetch):
+    locator, divisions = county_row
+    fetched, settings = fetch
+    summary = ProbeSampler(civic, locator, "voter_info", min_probes=2, neighbours=2, max_rounds=1).run("5000", divisions)
+    assert summary["rounds"] == 1 and len(summary["fetched"]) == 2
+    # Another day, as the divisions are settled in the ledger for this one
+    civic.date = "2020-11-04"
+    summary = ProbeSampler(civic, locator, "voter_info", min_coverage=1.0).run("5000", divisions)
+    assert len(summary["fetched"]) == COUNTIES and not summary["inherited"]
+# End
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the run ledger of src/run_ledger.py, for division fetches and probe runs.
+"""
+import time
+
+import pytest
+
+from src import run_ledger
+from src.probe_sampler import ProbeSampler
+from src.run_ledger import CompletionLedger, RunLedger, LEDGER_PREFIX, DONE, FAILED, IN_FLIGHT, PENDING
+from src.voter_info_fetcher import VoterInfo
+
+DATE = "2020-11-03"
+
+
+@pytest.fixture(autouse=True)
+def completed(monkeypatch):
+    monkeypatch.setattr(run_ledger, "_completed", run_ledger.OrderedDict())
+
+
+def test_progress_of_a_run(storage_client):
+    RunLedger(storage_client, "voter_info").start("5000", DATE, [("44001", "a"), ("44003", "b"), ("44007", "c"), ("44009", "d")])
+    ledger = CompletionLedger(storage_client, "voter_info")
+    ledger.mark_done("5000", "44001", DATE, "44001_2020-11-03.json")
+    ledger.mark_failed("5000", "44003", DATE, IOError("upload failed"))
+    ledger.mark_in_flight("5000", "44007", DATE)
+    summary = RunLedger(storage_client, "voter_info").progress("5000", DATE)
+    assert summary["total"] == 4
+    assert (summary[DONE], summary[FAILED], summary[IN_FLIGHT], summary[PENDING]) == (1, 1, 1, 1)
+    assert summary["failures"] == {"OSError": 1}
+    assert RunLedger(storage_client, "voter_info").unfinished("5000", DATE) == [("44003", "b"), ("44009", "d")]
+    assert ledger.is_done("5000", "44001", DATE)
+
+
+def test_latest_record_wins_across_batches(storage_client):
+    RunLedger(storage_client, "voter_info").start("5000", DATE, [("44001", "a"), ("44003", "b")])
+    ledger = CompletionLedger(storage_client, "voter_info")
+    ledger.mark_failed("5000", "44001", DATE, IOError("upload failed"))
+    time.sleep(0.01)
+    assert ledger.mark_batch("5000", DATE, [{"geo_id": "44001", "status": DONE}, {"geo_id": 44003, "status": IN_FLIGHT}])
+    _, states = RunLedger(storage_client, "voter_info").states("5000", DATE)
+    assert {geo_id: state for geo_id, (state, record) in states.items()} == {"44001": DONE, "44003": IN_FLIGHT}
+
+
+def test_division_fetch_records_only_its_outcome(civic, divisions, storage_client):
+    geo_id, address = divisions[0]
+    civic.fetch_division(address, "5000", geo_id, "voter_info")
+    records = storage_client.list_blob_names("voter_info", prefix=f"{LEDGER_PREFIX}5000/")
+    assert records == [CompletionLedger.record_name("5000", geo_id, civic.date)]
+    assert CompletionLedger(storage_client, "voter_info").is_done("5000", geo_id, civic.date)
+
+
+def test_probe_runs_record_their_divisions_in_batches(civic, api, divisions, storage_client):
+    RunLedger(storage_client, "voter_info").start("5000", civic.date, divisions)
+    summary = ProbeSampler(civic, api.locator, "voter_info", min_probes=2, neighbours=2).run("5000", divisions)
+    assert summary["inherited"]
+
+    progress = RunLedger(storage_client, "voter_info").progress("5000", civic.date)
+    assert progress["total"] == progress[DONE] == len(divisions)
+    records = RunLedger(storage_client, "voter_info").records("5000", civic.date)
+    for geo_id, source in summary["inherited"].items():
+        assert records[geo_id]["inherited_from"] == source
+        assert records[geo_id]["blob_name"] == f"{source}_{civic.date}.json"
+    # The plan and two batches, no record per division
+    assert len(storage_client.list_blob_names("voter_info", prefix=f"{LEDGER_PREFIX}5000/")) == 3
+
+
+def test_redelivered_probe_runs_are_skipped(civic, api, divisions, storage_client, monkeypatch):
+    calls = []
+    fetch_voter_info = VoterInfo.fetch_voter_info
+
+    def counted(self, address, election_id=None, limiter=None):
+        calls.append(address)
+        return fetch_voter_info(self, address, election_id, limiter)
+
+    monkeypatch.setattr(VoterInfo, "fetch_voter_info", counted)
+    sampler = ProbeSampler(civic, api.locator, "voter_info", min_probes=2, neighbours=2)
+    assert not sampler.run("5000", divisions)["skipped"]
+    fetched, batches = len(calls), storage_client.list_blob_names("voter_info", prefix=f"{LEDGER_PREFIX}5000/")
+    summary = sampler.run("5000", divisions)
+    assert summary["skipped"] and not summary["fetched"]
+    assert len(calls) == fetched
+    assert storage_client.list_blob_names("voter_info", prefix=f"{LEDGER_PREFIX}5000/") == batches
+
+
+def test_probe_runs_skip_divisions_in_flight_elsewhere(civic, api, divisions, storage_client):
+    ledger = CompletionLedger(storage_client, "voter_info")
+    ledger.mark_batch("5000", civic.date, [{"geo_id": geo_id, "status": IN_FLIGHT} for geo_id, address in divisions])
+    sampler = ProbeSampler(civic, api.locator, "voter_info", min_probes=2, neighbours=2)
+    assert sampler.run("5000", divisions)["skipped"]
+    # Deliveries that died are not waited for
+    assert not ProbeSampler._settled({"status": IN_FLIGHT, "updated": time.time() - run_ledger.STALE_AFTER - 1})
+
+
+def test_probe_failures_are_recorded(civic, api, divisions, storage_client, monkeypatch):
+    fetch_voter_info = VoterInfo.fetch_voter_info
+
+    def failing(self, address, election_id=None, limiter=None):
+        if address.endswith("44007"):
+            raise ConnectionError("reset")
+        return fetch_voter_info(self, address, election_id, limiter)
+
+    monkeypatch.setattr(VoterInfo, "fetch_voter_info", failing)
+    RunLedger(storage_client, "voter_info").start("5000", civic.date, divisions)
+    ProbeSampler(civic, api.locator, "voter_info", min_coverage=1.0).run("5000", divisions)
+    ledger = RunLedger(storage_client, "voter_info")
+    assert ledger.progress("5000", civic.date)["failures"] == {"ConnectionError": 1}
+    assert [geo_id for geo_id, address in ledger.unfinished("5000", civic.date)] == ["44007"]
+# End
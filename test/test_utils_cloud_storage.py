@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of src/utils_cloud_storage.py against the in-memory storage of benchmarks/fakes.py.
+"""
+import pytest
+
+from benchmarks.fakes import FakeBlob, FakeBucket
+from src.utils_cloud_storage import CloudStorageClient, takes_preconditions
+
+
+class LegacyBlob(FakeBlob):
+    """
+    Blob of google-cloud-storage 1.26, whose uploads take no generation preconditions.
+    """
+
+    def upload_from_string(self, data, content_type="text/plain", client=None, predefined_acl=None):
+        super().upload_from_string(data, content_type=content_type)
+
+    def upload_from_file(self, file, content_type=None, client=None, predefined_acl=None):
+        self.upload_from_string(file.read(), content_type=content_type)
+
+
+@pytest.fixture(params=["current", "legacy"])
+def client(request, monkeypatch, storage_client):
+    if request.param == "legacy":
+        monkeypatch.setattr(FakeBucket, "blob", lambda bucket, name, generation=None, **kwargs: LegacyBlob(bucket, name, generation))
+    return storage_client
+
+
+def test_storage_client_is_cached(storage_client):
+    assert CloudStorageClient().client is storage_client.client
+
+
+def test_takes_preconditions():
+    assert takes_preconditions(FakeBlob)
+    assert not takes_preconditions(LegacyBlob)
+
+
+def test_only_if_new_does_not_overwrite(client):
+    assert client.upload_json({"version": 1}, "bucket", "blob.json", only_if_new=True)
+    assert client.upload_json({"version": 2}, "bucket", "blob.json", only_if_new=True)
+    assert client.download_json("bucket", "blob.json") == {"version": 1}
+
+
+def test_upload_overwrites_by_default(client):
+    assert client.upload_json({"version": 1}, "bucket", "blob.json")
+    assert client.upload_json({"version": 2}, "bucket", "blob.json")
+    assert client.download_json("bucket", "blob.json") == {"version": 2}
+# End
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the retries of src/utils_http.py against a stub session, and of the
+responses it reports to the rate limiter.
+"""
+import pytest
+
+from src import utils_http
+
+
+class StubResponse():
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b"{}"
+
+    def json(self):
+        return {}
+
+
+class StubSession():
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+class RecordingLimiter():
+
+    def __init__(self):
+        self.recorded = []
+
+    def acquire(self):
+        pass
+
+    def record(self, rate_limited):
+        self.recorded.append(rate_limited)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils_http.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def stub(monkeypatch, responses):
+    session = StubSession(responses)
+    monkeypatch.setattr(utils_http, "get_session", lambda: session)
+    return session
+
+
+def test_retry_after_is_capped_at_max_backoff(monkeypatch, sleeps):
+    stub(monkeypatch, [StubResponse(429, {"Retry-After": "86400"}), StubResponse(200)])
+    response = utils_http.get("http://test", max_backoff=8)
+    assert response.status_code == 200
+    assert sleeps == [8]
+
+
+def test_retry_after_is_capped_at_the_deadline(monkeypatch, sleeps):
+    stub(monkeypatch, [StubResponse(503, {"Retry-After": "30"}), StubResponse(200)])
+    utils_http.get("http://test", max_backoff=60, deadline=5)
+    assert len(sleeps) == 1 and 0 < sleeps[0] <= 5
+
+
+def test_no_retry_past_the_deadline(monkeypatch, sleeps):
+    session = stub(monkeypatch, [StubResponse(503), StubResponse(200)])
+    response = utils_http.get("http://test", deadline=0)
+    assert response.status_code == 503
+    assert session.calls == 1 and sleeps == []
+
+
+def test_retry_after_date_in_the_past_is_no_delay():
+    response = StubResponse(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+    assert utils_http.retry_after_delay(response) == 0.0
+
+
+def test_only_rate_limits_and_successes_are_recorded(monkeypatch, sleeps):
+    stub(monkeypatch, [StubResponse(500), StubResponse(429), StubResponse(200)])
+    limiter = RecordingLimiter()
+    assert utils_http.get("http://test", limiter=limiter).status_code == 200
+    assert limiter.recorded == [True, False]
+
+
+def test_client_errors_are_not_recorded(monkeypatch, sleeps):
+    stub(monkeypatch, [StubResponse(404)])
+    limiter = RecordingLimiter()
+    assert utils_http.get("http://test", limiter=limiter).status_code == 404
+    assert limiter.recorded == []
+# End
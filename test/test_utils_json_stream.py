@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the incremental json parse of src/utils_json_stream.py.
+"""
+import gzip
+import hashlib
+import json
+
+import pytest
+
+from src.content_store import canonical_json
+from src.utils_json_stream import CallbackSink, CanonicalJsonSink, DocumentSink, stream_document
+
+DOCUMENT = {
+    "kind": "civicinfo#voterInfoResponse",
+    "election": {"id": "5000", "name": "Élection générale"},
+    "pollingLocations": [
+        {"address": {"locationName": "École 1"}, "latitude": -41.8250, "longitude": 71.4125e0},
+        {"address": {"locationName": "Hall 2"}, "latitude": 41.5, "longitude": -71.25},
+    ],
+    "earlyVoteSites": [],
+    "contests": [{"office": "Governor", "numberElected": 1}],
+    "precinctId": 123456789,
+    "mailOnly": False,
+}
+
+
+def chunked(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 1 << 16])
+def test_document_is_parsed_whatever_the_chunk_size(size):
+    data = json.dumps(DOCUMENT, indent=2, ensure_ascii=False).encode("utf-8")
+    sink = DocumentSink(keep=("pollingLocations", "earlyVoteSites", "contests"))
+    assert stream_document(chunked(data, size), [sink]) == len(data)
+    assert sink.document == DOCUMENT
+    assert sink.counts == {"pollingLocations": 2, "earlyVoteSites": 0, "contests": 1}
+
+
+def test_canonical_sink_matches_canonical_json():
+    sink = CanonicalJsonSink(spool_size=16)
+    stream_document(chunked(json.dumps(DOCUMENT).encode("utf-8"), 5), [sink])
+    file, size, digest = sink.finish()
+    data = gzip.decompress(file.read())
+    expected = canonical_json(DOCUMENT).encode("utf-8")
+    assert data == expected
+    assert size == len(expected)
+    assert digest == hashlib.sha256(expected).hexdigest()
+
+
+def test_document_sink_leaves_out_sections_not_kept():
+    sink = DocumentSink()
+    stream_document([json.dumps(DOCUMENT).encode("utf-8")], [sink])
+    assert "pollingLocations" not in sink.document
+    assert sink.document["election"] == DOCUMENT["election"]
+    assert sink.counts["pollingLocations"] == 2
+
+
+def test_callback_sink_gets_the_elements_of_its_section():
+    names = []
+    sink = CallbackSink("pollingLocations", lambda element: names.append(element["address"]["locationName"]))
+    stream_document([json.dumps(DOCUMENT).encode("utf-8")], [sink])
+    assert names == ["École 1", "Hall 2"]
+
+
+def test_sections_that_are_not_arrays_are_members():
+    sink = DocumentSink()
+    stream_document([b'{"contests": null}'], [sink])
+    assert sink.document == {"contests": None}
+    assert sink.counts == {}
+
+
+def test_empty_object():
+    sink = DocumentSink()
+    stream_document([b" { } "], [sink])
+    assert sink.document == {}
+
+
+@pytest.mark.parametrize("data", [b'[{"kind": "x"}]', b'{"kind": "x"', b''])
+def test_invalid_documents_raise(data):
+    with pytest.raises(ValueError):
+        stream_document(chunked(data, 4), [DocumentSink()])
+# End
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the shared request budget of src/utils_rate_limit.py.
+"""
+import logging
+import sys
+import types
+
+import pytest
+
+from src import utils_rate_limit
+from src.utils_rate_limit import AdaptiveRateLimiter, LocalTokenStore, RedisTokenStore, get_scheduler
+
+
+@pytest.fixture
+def schedulers(monkeypatch):
+    monkeypatch.setattr(utils_rate_limit, "_schedulers", dict())
+    monkeypatch.delenv("RATE_LIMIT_REDIS_HOST", raising=False)
+
+
+def test_bucket_grants_its_capacity_then_waits():
+    store = LocalTokenStore()
+    assert [store.take("api", rate=1, capacity=3) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert 0 < store.take("api", rate=1, capacity=3) <= 1
+
+
+def test_rate_limit_cuts_the_rate_once_per_cooldown():
+    limiter = AdaptiveRateLimiter(LocalTokenStore(), "api", initial_rate=8, min_rate=1, cooldown=60)
+    limiter.record(True)
+    limiter.record(True)
+    assert limiter.rate == 4
+
+
+def test_rate_stays_within_bounds():
+    limiter = AdaptiveRateLimiter(LocalTokenStore(), "api", initial_rate=2, min_rate=1, max_rate=3, increase=10, cooldown=0)
+    limiter.record(False)
+    assert limiter.rate == 3
+    for _ in range(5):
+        limiter.record(True)
+    assert limiter.rate == 1
+
+
+def test_local_fallback_is_logged(schedulers, caplog):
+    with caplog.at_level(logging.WARNING):
+        scheduler = get_scheduler("civic_api")
+    assert isinstance(scheduler.store, LocalTokenStore)
+    assert "global budget is not enforced" in caplog.text
+    assert get_scheduler("civic_api") is scheduler
+
+
+def test_missing_redis_falls_back_to_local(schedulers, monkeypatch, caplog):
+    monkeypatch.setenv("RATE_LIMIT_REDIS_HOST", "localhost")
+    monkeypatch.setitem(sys.modules, "redis", None)
+    with caplog.at_level(logging.WARNING):
+        scheduler = get_scheduler("civic_api")
+    assert isinstance(scheduler.store, LocalTokenStore)
+    assert "redis package is missing" in caplog.text
+
+
+@pytest.fixture
+def unreachable_redis(monkeypatch):
+    """
+    redis package whose server cannot be reached. Returns the number of calls made to it.
+    """
+    module = types.ModuleType("redis")
+    module.exceptions = types.SimpleNamespace(
+        ConnectionError=type("ConnectionError", (Exception,), {}),
+        TimeoutError=type("TimeoutError", (Exception,), {}),
+    )
+    calls = []
+
+    class Redis():
+
+        def __init__(self, **kwargs):
+            pass
+
+        def unreachable(self, *args, **kwargs):
+            calls.append(args)
+            raise module.exceptions.ConnectionError("Error 111 connecting to 10.0.0.3:6379")
+
+        hget = unreachable
+
+        def register_script(self, script):
+            return self.unreachable
+
+    module.Redis = Redis
+    monkeypatch.setitem(sys.modules, "redis", module)
+    return calls
+
+
+def test_unreachable_redis_degrades_to_local(unreachable_redis, caplog):
+    limiter = AdaptiveRateLimiter(RedisTokenStore("10.0.0.3", retry_after=60), "api", initial_rate=10, burst=2)
+    with caplog.at_level(logging.WARNING):
+        limiter.acquire()
+        limiter.record(False)
+        limiter.record(True)
+    assert "rate limiting per instance" in caplog.text
+    # Redis is not tried again before retry_after
+    assert len(unreachable_redis) == 1
+    # The local store adapted the rate: (10 + 0.5 / 10) * 0.5
+    assert limiter.rate == pytest.approx(5.025)
+# End
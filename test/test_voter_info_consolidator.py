@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the consolidated tables of src/voter_info_consolidator.py.
+"""
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+from src import voter_info_manifest
+from src.voter_info_consolidator import VoterInfoConsolidator
+from src.voter_info_manifest import ManifestWriter
+
+DATE = "2020-11-03"
+
+
+def response(geoid):
+    return {
+        "election": {"id": "5000"},
+        "contests": [{"office": "Governor", "candidates": [{"name": f"Candidate {geoid}", "party": "Independent"}]}],
+        "pollingLocations": [{"address": {"locationName": f"School {geoid}", "city": "Providence"}}],
+        "state": [{"name": "Rhode Island", "electionAdministrationBody": {"name": "Board of Elections"}}],
+    }
+
+
+@pytest.fixture
+def saved(storage_client):
+    for geoid in ("44001", "44007"):
+        storage_client.upload_json(response(geoid), "voter_info", f"{geoid}_{DATE}.json")
+    return storage_client
+
+
+def download(client, blob_name):
+    return gzip.decompress(client.client.bucket("voter_info").blob(blob_name).download_as_string()).decode("utf-8")
+
+
+def test_ndjson_is_one_file_per_election(saved, tmp_path):
+    consolidator = VoterInfoConsolidator(saved, "voter_info")
+    counts = consolidator.consolidate(DATE, directory=str(tmp_path))
+    assert counts == {("5000", "contests"): 2, ("5000", "candidates"): 2, ("5000", "polling_locations"): 2, ("5000", "officials"): 2}
+    assert saved.list_blob_names("voter_info", prefix="consolidated/") == [f"consolidated/5000/{DATE}.jsonl.gz"]
+    rows = [json.loads(line) for line in download(saved, f"consolidated/5000/{DATE}.jsonl.gz").splitlines()]
+    candidates = [row for row in rows if row["table"] == "candidates"]
+    assert sorted(row["name"] for row in candidates) == ["Candidate 44001", "Candidate 44007"]
+    assert all(row["election_id"] == "5000" and row["date"] == DATE for row in rows)
+
+
+def test_csv_is_one_file_per_table(saved, tmp_path):
+    consolidator = VoterInfoConsolidator(saved, "voter_info", output_format="csv")
+    consolidator.consolidate(DATE, directory=str(tmp_path))
+    assert saved.list_blob_names("voter_info", prefix="consolidated/") == [
+        f"consolidated/5000/{DATE}/{table}.csv.gz" for table in ("candidates", "contests", "officials", "polling_locations")
+    ]
+    rows = list(csv.DictReader(io.StringIO(download(saved, f"consolidated/5000/{DATE}/polling_locations.csv.gz"))))
+    assert sorted(row["location_name"] for row in rows) == ["School 44001", "School 44007"]
+
+
+def test_inherited_divisions_get_the_rows_of_their_source(saved, tmp_path, monkeypatch):
+    monkeypatch.setattr(voter_info_manifest, "_shards", voter_info_manifest.OrderedDict())
+    writer = ManifestWriter(saved)
+    for geoid in ("44001", "44007"):
+        writer.add("voter_info", "5000", geoid, DATE, f"{geoid}_{DATE}.json")
+    writer.add("voter_info", "5000", "44003", DATE, f"44001_{DATE}.json", inherited_from="44001")
+    writer.flush()
+
+    consolidator = VoterInfoConsolidator(saved, "voter_info")
+    assert consolidator.list_geoids(DATE, "5000") == ["44001", "44007"]
+    counts = consolidator.consolidate(DATE, election_id="5000", directory=str(tmp_path))
+    assert counts[("5000", "candidates")] == 3
+    rows = [json.loads(line) for line in download(saved, f"consolidated/5000/{DATE}.jsonl.gz").splitlines()]
+    candidates = {row["geoid"]: row for row in rows if row["table"] == "candidates"}
+    assert candidates["44003"]["name"] == "Candidate 44001"
+    assert {geoid: row["inherited_from"] for geoid, row in candidates.items()} == {"44001": "", "44003": "44001", "44007": ""}
+# End
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the day over day changes of src/voter_info_diff.py, the "delta"
+storage mode built on them, and probe inheritance in that mode.
+"""
+import copy
+import datetime as dt
+
+import pytest
+
+from benchmarks.fakes import GENERAL_ELECTION, synthetic_address
+from src.content_store import canonical_json
+from src.probe_sampler import ProbeSampler
+from src.voter_info_diff import SnapshotStore, apply_changes, diff_documents, summarise
+from src.voter_info_manifest import ManifestIndex
+
+DAYS = [dt.date(2020, 11, 1) + dt.timedelta(days=day) for day in range(4)]
+
+
+@pytest.fixture(autouse=True)
+def delta_mode(monkeypatch):
+    monkeypatch.setenv("VOTER_INFO_STORAGE_MODE", "delta")
+
+
+def response(api, fips, name="Providence County"):
+    return api.voter_info(synthetic_address(fips, name, "RI"), GENERAL_ELECTION["id"])[1]
+
+
+def edited(previous, question=1):
+    current = copy.deepcopy(previous)
+    current["contests"][0]["candidates"].pop()
+    current["contests"].append({"referendumTitle": f"Question {question}", "district": {"scope": "statewide"}})
+    current["pollingLocations"][0]["pollingHours"] = f"6am - {question + 8}pm"
+    current["pollingLocations"].reverse()
+    current.pop("earlyVoteSites", None)
+    return current
+
+
+def test_apply_changes_rebuilds_the_response(api):
+    previous = response(api, "44007")
+    current = edited(previous)
+    records = diff_documents(previous, current)
+    assert canonical_json(apply_changes(previous, records)) == canonical_json(current)
+    # The previous snapshot is left as it was
+    assert canonical_json(previous) == canonical_json(response(api, "44007"))
+    counts = summarise(records)
+    assert counts["candidate:removed"] == 1
+    assert counts["contest:added"] == 1
+    assert counts["polling_location:modified"] == 1
+
+
+def test_unchanged_response_has_no_changes(api):
+    previous = response(api, "44007")
+    assert diff_documents(previous, copy.deepcopy(previous)) == []
+
+
+def test_snapshots_are_deltas_between_checkpoints(storage_client, api):
+    store = SnapshotStore(storage_client, "voter_info", checkpoint_every=3)
+    responses = [response(api, "44007")]
+    for question in range(1, len(DAYS)):
+        responses.append(edited(responses[-1], question))
+    saved = []
+    for date, result in zip(DAYS, responses):
+        saved.append(store.save("5000", "44007", date, result, canonical_json(result).encode("utf-8")))
+    assert saved == [
+        (store.checkpoint_name("44007", DAYS[0]), None),
+        (store.delta_name("44007", DAYS[1]), str(DAYS[0])),
+        (store.delta_name("44007", DAYS[2]), str(DAYS[1])),
+        (store.checkpoint_name("44007", DAYS[3]), None),
+    ]
+    for (blob_name, _), result in zip(saved, responses):
+        assert canonical_json(store.load(blob_name)) == canonical_json(result)
+    assert store.head("5000", "44007") == {"date": str(DAYS[3]), "blob_name": saved[3][0], "chain": 0}
+
+
+def test_inherited_divisions_point_at_the_saved_blobs(civic, api, divisions):
+    store = SnapshotStore(civic.client, "voter_info")
+    for date in DAYS[:2]:
+        civic.date, civic.saved = date, dict()
+        sampler = ProbeSampler(civic, api.locator, "voter_info", min_probes=2, neighbours=2)
+        summary = sampler.run(GENERAL_ELECTION["id"], divisions)
+        assert summary["inherited"] and not summary["failed"]
+
+        entries = ManifestIndex(civic.client, "voter_info").entries(GENERAL_ELECTION["id"], date)
+        assert len(entries) == len(divisions)
+        for entry in entries:
+            source = entry["inherited_from"] or entry["geo_id"]
+            assert entry["blob_name"] == civic.saved[source]
+            assert store.load(entry["blob_name"])["geoid"] == {"fips": source}
+    # The second day's probes were saved as deltas
+    assert all(blob_name.startswith("deltas/") for blob_name in civic.saved.values())
+
+
+def test_delta_blob_name_is_unknown_until_saved(civic):
+    assert civic.blob_name("44007") is None
+# End
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the reference data loaders of src/voter_info_fetcher.py.
+"""
+import os
+
+import pytest
+
+from src.utils_cache import reference_cache
+from src.utils_cloud_storage import CloudStorageClient
+
+
+@pytest.fixture
+def references(civic, monkeypatch, tmp_path):
+    monkeypatch.setattr(civic, "path", str(tmp_path))
+    reference_cache.clear()
+    yield civic
+    reference_cache.clear()
+
+
+def test_failed_download_is_not_cached(references, storage_client, monkeypatch, tmp_path):
+    storage_client.upload_json({"elections": [{"id": "1"}]}, "elections", "current_elections.json")
+    assert references.load_current_elections("elections", "current_elections.json") == [{"id": "1"}]
+
+    storage_client.upload_json({"elections": [{"id": "2"}]}, "elections", "current_elections.json")
+    download_file = CloudStorageClient.download_file
+    monkeypatch.setattr(CloudStorageClient, "download_file", lambda self, *args, **kwargs: False)
+    with pytest.raises(IOError):
+        references.load_current_elections("elections", "current_elections.json")
+
+    monkeypatch.setattr(CloudStorageClient, "download_file", download_file)
+    assert references.load_current_elections("elections", "current_elections.json") == [{"id": "2"}]
+    assert os.listdir(tmp_path) == []
+
+
+def test_generations_are_downloaded_to_files_of_their_own(references, storage_client, monkeypatch):
+    storage_client.upload_json({"elections": []}, "elections", "current_elections.json")
+    filepaths = []
+    download_file = CloudStorageClient.download_file
+
+    def recording(self, filepath, *args, **kwargs):
+        filepaths.append(filepath)
+        return download_file(self, filepath, *args, **kwargs)
+
+    monkeypatch.setattr(CloudStorageClient, "download_file", recording)
+    references.load_current_elections("elections", "current_elections.json")
+    storage_client.upload_json({"elections": []}, "elections", "current_elections.json")
+    references.load_current_elections("elections", "current_elections.json")
+    assert len(set(filepaths)) == 2
+# End
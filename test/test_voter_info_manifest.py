@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+# Copyright 2020 99 Antennas LLC
+
+"""
+Tests of the voter info manifest of src/voter_info_manifest.py.
+"""
+import pytest
+from google.api_core import exceptions
+
+from benchmarks.fakes import FakeBlob
+from src import voter_info_manifest
+from src.content_store import MANIFEST_PREFIX as CONTENT_MANIFEST_PREFIX
+from src.voter_info_manifest import ManifestIndex, ManifestWriter, MANIFEST_PREFIX, partition_prefix
+
+DATE = "2020-11-03"
+
+
+@pytest.fixture(autouse=True)
+def shards(monkeypatch):
+    monkeypatch.setattr(voter_info_manifest, "_shards", voter_info_manifest.OrderedDict())
+
+
+def write(client, geo_ids, date=DATE, **kwargs):
+    """
+    Writes a shard per division, as single-division invocations of run_voter_info do.
+    """
+    for geo_id in geo_ids:
+        writer = ManifestWriter(client)
+        writer.add("voter_info", "5000", geo_id, date, f"{geo_id}_{date}.json", **kwargs)
+        assert writer.flush() == 1
+
+
+def test_prefix_is_distinct_from_the_content_store():
+    assert not MANIFEST_PREFIX.startswith(CONTENT_MANIFEST_PREFIX)
+    assert not CONTENT_MANIFEST_PREFIX.startswith(MANIFEST_PREFIX)
+
+
+def test_writer_batches_per_partition(storage_client):
+    writer = ManifestWriter(storage_client, max_entries=10)
+    for geo_id in ("44001", "44003", "44007"):
+        writer.add("voter_info", "5000", geo_id, DATE, f"{geo_id}_{DATE}.json")
+    writer.add("voter_info", "5000", "44001", "2020-11-02", f"44001_2020-11-02.json")
+    assert writer.flush() == 4
+    assert len(storage_client.list_blob_names("voter_info", prefix=partition_prefix("5000", DATE))) == 1
+    assert len(storage_client.list_blob_names("voter_info", prefix=partition_prefix("5000"))) == 2
+
+
+def test_queries(storage_client):
+    write(storage_client, ["44001", "44007"], date="2020-11-02")
+    write(storage_client, ["44001"])
+    write(storage_client, ["44003"], inherited_from="44001")
+    index = ManifestIndex(storage_client, "voter_info")
+    assert index.divisions("5000", DATE) == ["44001", "44003"]
+    assert index.divisions("5000", DATE, include_inherited=False) == ["44001"]
+    assert index.lookup("5000", "44007")["date"] == "2020-11-02"
+    assert index.lookup("5000", "44001")["blob_name"] == f"44001_{DATE}.json"
+    assert index.lookup("5000", "44007", DATE) is None
+
+
+def test_queries_do_not_compact(storage_client):
+    write(storage_client, ["44001", "44003", "44007"])
+    index = ManifestIndex(storage_client, "voter_info")
+    assert index.divisions("5000", DATE) == ["44001", "44003", "44007"]
+    assert len(index.shards("5000", DATE)) == 3
+
+
+@pytest.fixture
+def flaky(monkeypatch):
+    """
+    Fails the next download of the shards added to the returned set, as a transient error would.
+    """
+    failing = set()
+    download_as_string = FakeBlob.download_as_string
+
+    def flaky_download(blob, **kwargs):
+        if blob.name in failing:
+            failing.discard(blob.name)
+            raise exceptions.ServiceUnavailable("try again")
+        return download_as_string(blob, **kwargs)
+
+    monkeypatch.setattr(FakeBlob, "download_as_string", flaky_download)
+    return failing
+
+
+def test_unreadable_shard_fails_the_query(storage_client, flaky):
+    write(storage_client, ["44001", "44003"])
+    index = ManifestIndex(storage_client, "voter_info")
+    flaky.add(index.shards("5000", DATE)[0])
+    with pytest.raises(IOError):
+        index.divisions("5000", DATE)
+    assert index.divisions("5000", DATE) == ["44001", "44003"]
+
+
+def test_compaction_never_loses_entries(storage_client, flaky):
+    geo_ids = [str(44000 + number).zfill(5) for number in range(1, 71)]
+    write(storage_client, geo_ids)
+    index = ManifestIndex(storage_client, "voter_info")
+    flaky.add(index.shards("5000", DATE)[35])
+    with pytest.raises(IOError):
+        index.compact("5000", DATE)
+    assert index.compact("5000", DATE) == 70
+    assert len(index.shards("5000", DATE)) == 1
+    assert index.divisions("5000", DATE) == geo_ids
+
+
+def test_query_lists_again_after_a_concurrent_compaction(storage_client, monkeypatch):
+    write(storage_client, ["44001", "44003", "44007"])
+    index = ManifestIndex(storage_client, "voter_info")
+    stale = index.shards("5000", DATE)
+    ManifestIndex(storage_client, "voter_info").compact("5000", DATE)
+    listings = iter([stale])
+    shards = ManifestIndex.shards
+    monkeypatch.setattr(ManifestIndex, "shards", lambda self, *args: next(listings, None) or shards(self, *args))
+    assert index.divisions("5000", DATE) == ["44001", "44003", "44007"]
+
+
+def test_compaction_skips_a_partition_changed_while_read(storage_client, monkeypatch):
+    write(storage_client, ["44001", "44003", "44007"])
+    shards = ManifestIndex.shards
+    # A shard listed, then removed by another compaction before it is read
+    monkeypatch.setattr(ManifestIndex, "shards", lambda self, *args: shards(self, *args) + [partition_prefix("5000", DATE) + "gone.json"])
+    assert ManifestIndex(storage_client, "voter_info").compact("5000", DATE) == 0
+    assert len(shards(ManifestIndex(storage_client, "voter_info"), "5000", DATE)) == 3
+
+
+def test_compact(storage_client):
+    write(storage_client, ["44001", "44003", "44001"])
+    index = ManifestIndex(storage_client, "voter_info")
+    assert len(index.shards("5000", DATE)) == 3
+    assert index.compact("5000", DATE) == 3
+    assert len(index.shards("5000", DATE)) == 1
+    assert index.divisions("5000", DATE) == ["44001", "44003"]
+# End